@@ -1,4 +1,5 @@
 import { NextRequest, NextResponse } from 'next/server'
+import { Prisma } from '@prisma/client'
 import { prisma } from '@/lib/prisma'
 import { verifyToken } from '@/lib/jwt'
 import { sendTelegramNotification } from '@/lib/telegram'
@@ -46,7 +47,8 @@ async function processUserNotifications(userId: string) {
     }
 
     // 1. Lesson Reminders (45 min window)
-    if (settings.lessonReminders) {
+    // With BOT_LESSON_REMINDERS=1 the Telegram bot sends them (bot/reminders.py)
+    if (settings.lessonReminders && process.env.BOT_LESSON_REMINDERS !== '1') {
         const reminderWindowStart = now
         const reminderWindowEnd = new Date(now.getTime() + 45 * 60 * 1000)
 
@@ -85,19 +87,26 @@ async function processUserNotifications(userId: string) {
                     ? `🔔 **Напоминание о занятии**\n\n👨‍🏫 Преподаватель: ${teacherName}\n📚 Предмет: ${subjectName}\n🕒 Время: ${timeStr}`
                     : `🔔 **Скоро занятие**\n\n${lesson.studentId ? '👤 Ученик' : '👥 Группа'}: ${entityName}\n📚 Предмет: ${subjectName}\n🕒 Время: ${timeStr}\n⏳ Длительность: ${lesson.duration} мин`
 
-                await prisma.notification.create({
-                    data: {
-                        userId,
-                        title: 'Скоро занятие',
-                        message: isStudent
-                            ? `${subjectName} с преподавателем ${teacherName} начнется в ${timeStr}`
-                            : `${subjectName} с ${lesson.studentId ? 'учеником' : 'группой'} ${entityName} начнется в ${timeStr}`,
-                        type: 'lesson_reminder',
-                        data: JSON.stringify({ key: notificationKey, lessonId: lesson.id }),
-                        link: isStudent ? `/student/lessons/${lesson.id}` : `/lessons/${lesson.id}`,
-                        isRead: !settings.deliveryWeb
-                    }
-                })
+                try {
+                    await prisma.notification.create({
+                        data: {
+                            userId,
+                            title: 'Скоро занятие',
+                            message: isStudent
+                                ? `${subjectName} с преподавателем ${teacherName} начнется в ${timeStr}`
+                                : `${subjectName} с ${lesson.studentId ? 'учеником' : 'группой'} ${entityName} начнется в ${timeStr}`,
+                            type: 'lesson_reminder',
+                            data: JSON.stringify({ key: notificationKey, lessonId: lesson.id }),
+                            dedupeKey: notificationKey,
+                            link: isStudent ? `/student/lessons/${lesson.id}` : `/lessons/${lesson.id}`,
+                            isRead: !settings.deliveryWeb
+                        }
+                    })
+                } catch (e) {
+                    // Recorded (and sent) by the bot or another run in the meantime
+                    if (e instanceof Prisma.PrismaClientKnownRequestError && e.code === 'P2002') continue
+                    throw e
+                }
                 await sendTelegramNotification(userId, message, 'lessonReminders')
                 notificationsCreated.push('reminder')
             }
@@ -0,0 +1,143 @@
+"""DB micro-benchmarks for every bot/db.py function against synthetic data.
+
+Needs a throwaway Postgres (never production) with the app schema applied:
+
+    createdb tuterra_bench
+    DATABASE_URL=postgres://localhost/tuterra_bench npx prisma db push --schema prisma/schema.prisma --skip-generate
+
+Then, from bot/:
+
+    export BENCH_DATABASE_URL=postgres://localhost/tuterra_bench
+    python -m benchmarks.dbbench load --scale small        # or medium / large, --tutors N ...
+    python -m benchmarks.dbbench run --out before.json
+    python -m benchmarks.dbbench run --out after.json
+    python -m benchmarks.dbbench compare before.json after.json
+
+`run` reports, per function, latency percentiles, statements sent to the
+server per call and rows returned per call, and saves them as JSON together
+with the dataset's row counts and the server version.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from dataclasses import replace
+from datetime import datetime
+import asyncpg
+from queries import REGISTRY
+from benchmarks.dbbench.generate import SCALES, TABLES, load, clear
+from benchmarks.dbbench.suite import CASES, SAMPLES, CountingPool, run_case
+
+
+def _database_url():
+    url = os.getenv("BENCH_DATABASE_URL")
+    if not url:
+        # Deliberately no DATABASE_URL fallback: `load` truncates tables
+        sys.exit("Set BENCH_DATABASE_URL to a throwaway database")
+    return url
+
+
+async def cmd_load(args):
+    scale = SCALES[args.scale]
+    overrides = {k: getattr(args, k) for k in ("tutors", "students_per_tutor", "lessons_per_tutor") if getattr(args, k)}
+    scale = replace(scale, **overrides)
+    conn = await asyncpg.connect(_database_url())
+    try:
+        if await conn.fetchval('SELECT COUNT(*) FROM "User"'):
+            if not args.truncate:
+                sys.exit("Database is not empty; pass --truncate to replace its data")
+            await clear(conn)
+        print(f"Loading {scale} (seed {args.seed})")
+        started = datetime.now()
+        counts = await load(
+            conn, scale, seed=args.seed,
+            progress=lambda done, counts: print(f"  {done}/{scale.tutors} tutors, {counts['Lesson']} lessons", end="\r")
+        )
+        print(f"\nLoaded in {datetime.now() - started}: {counts}")
+    finally:
+        await conn.close()
+
+
+async def cmd_run(args):
+    pool = await asyncpg.create_pool(_database_url(), min_size=1, max_size=2, **REGISTRY.pool_kwargs())
+    try:
+        async with pool.acquire() as conn:
+            counts = {table: await conn.fetchval(f'SELECT COUNT(*) FROM "{table}"') for table in TABLES}
+            version = await conn.fetchval("SHOW server_version")
+            samples = {name: list(await conn.fetch(sql, args.samples)) for name, sql in SAMPLES.items()}
+        counting = CountingPool(pool)
+        results = {}
+        print(f"{'function':<30}{'calls':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'trips':>7}{'rows':>9}")
+        for case in CASES:
+            if args.only and case.name not in args.only:
+                continue
+            if not samples[case.sample]:
+                print(f"{case.name:<30}no sample rows, skipped")
+                continue
+            r = results[case.name] = await run_case(counting, case, samples[case.sample], args.iterations)
+            if not r["calls"]:
+                print(f"{case.name:<30}all {r['errors']} calls failed")
+                continue
+            print(f"{case.name:<30}{r['calls']:>6}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}"
+                  f"{r['round_trips']:>7}{r['rows']:>9}")
+    finally:
+        await pool.close()
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                "meta": {
+                    "started_at": datetime.now().isoformat(timespec="seconds"),
+                    "server_version": version,
+                    "iterations": args.iterations,
+                    "prepared_statements": REGISTRY.prepared,
+                    "dataset": counts
+                },
+                "results": results
+            }, f, indent=2, ensure_ascii=False)
+        print(f"Saved to {args.out}")
+
+
+def cmd_compare(args):
+    with open(args.before) as f:
+        before = json.load(f)["results"]
+    with open(args.after) as f:
+        after = json.load(f)["results"]
+    print(f"{'function':<30}{'p50 ms':>18}{'p95 ms':>18}{'trips':>12}{'rows':>16}")
+    for name in [name for name in before if name in after]:
+        a, b = before[name], after[name]
+        if not a.get("calls") or not b.get("calls"):
+            continue
+        cell = lambda key, width: f"{a[key]}→{b[key]}".rjust(width)
+        change = (b["p50_ms"] - a["p50_ms"]) / a["p50_ms"] * 100 if a["p50_ms"] else 0
+        print(f"{name:<30}{cell('p50_ms', 18)}{cell('p95_ms', 18)}{cell('round_trips', 12)}{cell('rows', 16)}"
+              f"  {change:+.0f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.dbbench")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("load", help="generate and load the synthetic dataset")
+    p.add_argument("--scale", choices=SCALES, default="small")
+    p.add_argument("--tutors", type=int)
+    p.add_argument("--students-per-tutor", type=int)
+    p.add_argument("--lessons-per-tutor", type=int)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--truncate", action="store_true", help="replace existing data")
+    p = sub.add_parser("run", help="benchmark the db.py functions")
+    p.add_argument("--iterations", type=int, default=200)
+    p.add_argument("--samples", type=int, default=100, help="distinct keys per function")
+    p.add_argument("--only", nargs="*", help="function names to run")
+    p.add_argument("--out", help="save results as JSON")
+    p = sub.add_parser("compare", help="compare two saved runs")
+    p.add_argument("before")
+    p.add_argument("after")
+    args = parser.parse_args()
+    if args.command == "compare":
+        cmd_compare(args)
+    else:
+        asyncio.run(cmd_load(args) if args.command == "load" else cmd_run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""The db.py functions under test and the runner that measures them.
+
+Each case calls a real db.py function through a pool wrapper that counts,
+per call, the statements sent to the server (round trips) and the rows they
+returned. Caches are flushed before every call, so figures are for the
+database path. Functions that write run inside a transaction that is rolled
+back when the connection is released, which leaves the dataset unchanged;
+their latency includes that BEGIN/ROLLBACK, their round trip count doesn't.
+Arguments cycle through keys sampled deterministically from the dataset.
+"""
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+import db
+import localtime
+
+
+class Counter:
+    def __init__(self):
+        self.round_trips = 0
+        self.rows = 0
+
+
+class CountingConnection:
+    """Forwards to an asyncpg connection, counting statements and rows."""
+
+    def __init__(self, conn, counter):
+        self._conn = conn
+        self._counter = counter
+
+    async def fetch(self, *args, **kwargs):
+        rows = await self._conn.fetch(*args, **kwargs)
+        self._counter.round_trips += 1
+        self._counter.rows += len(rows)
+        return rows
+
+    async def fetchrow(self, *args, **kwargs):
+        row = await self._conn.fetchrow(*args, **kwargs)
+        self._counter.round_trips += 1
+        self._counter.rows += row is not None
+        return row
+
+    async def fetchval(self, *args, **kwargs):
+        value = await self._conn.fetchval(*args, **kwargs)
+        self._counter.round_trips += 1
+        self._counter.rows += value is not None
+        return value
+
+    async def execute(self, *args, **kwargs):
+        result = await self._conn.execute(*args, **kwargs)
+        self._counter.round_trips += 1
+        return result
+
+    async def executemany(self, *args, **kwargs):
+        result = await self._conn.executemany(*args, **kwargs)
+        self._counter.round_trips += 1
+        return result
+
+    def transaction(self, **kwargs):
+        self._counter.round_trips += 2  # BEGIN and COMMIT/ROLLBACK
+        return self._conn.transaction(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class CountingPool:
+    def __init__(self, pool):
+        self._pool = pool
+        self.counter = Counter()
+        self.rollback = False
+
+    def acquire(self):
+        return _CountingAcquire(self)
+
+
+class _CountingAcquire:
+    def __init__(self, owner):
+        self._owner = owner
+        self._conn = None
+        self._tx = None
+
+    async def __aenter__(self):
+        self._conn = await self._owner._pool.acquire()
+        if self._owner.rollback:
+            self._tx = self._conn.transaction()
+            await self._tx.start()
+        return CountingConnection(self._conn, self._owner.counter)
+
+    async def __aexit__(self, *exc):
+        try:
+            if self._tx is not None:
+                await self._tx.rollback()
+        finally:
+            await self._owner._pool.release(self._conn)
+
+
+# Keys the cases draw their arguments from. md5 ordering picks the same,
+# evenly spread rows on every run over the same dataset.
+SAMPLES = {
+    "teachers": 'SELECT id, timezone FROM "User" WHERE role = \'teacher\' ORDER BY md5(id) LIMIT $1',
+    "student_users": '''
+        SELECT u.id, u.timezone FROM "User" u
+        WHERE u.role = 'student' AND EXISTS (SELECT 1 FROM "Student" st WHERE st."linkedUserId" = u.id)
+        ORDER BY md5(u.id) LIMIT $1
+    ''',
+    "telegram_ids": 'SELECT "telegramId" FROM "User" WHERE "telegramId" IS NOT NULL ORDER BY md5(id) LIMIT $1',
+    "emails": '''
+        SELECT email, "telegramId" FROM "User"
+        WHERE email IS NOT NULL AND "telegramId" IS NOT NULL ORDER BY md5(id) LIMIT $1
+    ''',
+    "link_codes": '''
+        SELECT vc.code, u."telegramId" FROM "VerificationCode" vc JOIN "User" u ON u.id = vc."userId"
+        WHERE vc.type = 'TELEGRAM_LINK' ORDER BY md5(vc.id) LIMIT $1
+    ''',
+    "students": 'SELECT id, "ownerId" FROM "Student" ORDER BY md5(id) LIMIT $1',
+    "lessons": 'SELECT id, date, "ownerId" FROM "Lesson" ORDER BY md5(id) LIMIT $1',
+    "group_lessons": '''
+        SELECT id, "ownerId" FROM "Lesson" WHERE "groupId" IS NOT NULL ORDER BY md5(id) LIMIT $1
+    ''',
+    "payments": 'SELECT "lessonId", "studentId" FROM "LessonPayment" ORDER BY md5(id) LIMIT $1',
+    "requests": 'SELECT id FROM "LessonRequest" ORDER BY md5(id) LIMIT $1',
+    "request_lessons": '''
+        SELECT l.id, st."linkedUserId" FROM "Lesson" l JOIN "Student" st ON st.id = l."studentId"
+        WHERE st."linkedUserId" IS NOT NULL ORDER BY md5(l.id) LIMIT $1
+    ''',
+}
+
+
+@dataclass
+class Case:
+    name: str
+    sample: str
+    call: object  # (pool, sample row) -> awaitable
+    write: bool = False
+
+
+def _today(tz):
+    return localtime.local_today(tz)
+
+
+CASES = [
+    Case("get_user_by_telegram_id", "telegram_ids", lambda p, s: db.get_user_by_telegram_id(p, s[0])),
+    # Relinking a user to the Telegram id they already have keeps "telegramId" unique
+    Case("link_user_telegram", "emails", lambda p, s: db.link_user_telegram(p, s[0], s[1], s[1]), write=True),
+    Case("verify_telegram_code", "link_codes",
+         lambda p, s: db.verify_telegram_code(p, s[0], s[1], s[1]), write=True),
+    Case("get_dashboard_stats", "teachers", lambda p, s: db.get_dashboard_stats(p, s[0], s[1])),
+    Case("get_student_dashboard_stats", "student_users", lambda p, s: db.get_student_dashboard_stats(p, s[0], s[1])),
+    Case("get_student_ids", "student_users", lambda p, s: db.get_student_ids(p, s[0])),
+    Case("get_student_scope", "student_users", lambda p, s: db.get_student_scope(p, s[0])),
+    Case("get_lessons_by_date", "teachers", lambda p, s: db.get_lessons_by_date(p, s[0], _today(s[1]), s[1])),
+    Case("get_student_lessons_by_date", "student_users",
+         lambda p, s: db.get_student_lessons_by_date(p, s[0], _today(s[1]), s[1])),
+    Case("get_lesson_by_id", "lessons", lambda p, s: db.get_lesson_by_id(p, s[0])),
+    Case("get_group_lesson_payments", "group_lessons", lambda p, s: db.get_group_lesson_payments(p, s[0])),
+    Case("get_all_students", "teachers", lambda p, s: db.get_all_students(p, s[0])),
+    Case("get_students_page", "teachers", lambda p, s: db.get_students_page(p, s[0])),
+    Case("get_student_details", "students", lambda p, s: db.get_student_details(p, s[0])),
+    Case("get_unpaid_lessons", "teachers", lambda p, s: db.get_unpaid_lessons(p, s[0])),
+    Case("get_unpaid_lessons_page", "teachers", lambda p, s: db.get_unpaid_lessons_page(p, s[0])),
+    Case("get_lesson_request", "requests", lambda p, s: db.get_lesson_request(p, s[0])),
+    Case("get_lessons_in_window", "teachers", lambda p, s: db.get_lessons_in_window(
+        p, localtime.utc_now(), localtime.utc_now() + timedelta(hours=6))),
+    Case("get_lessons_changed_since", "teachers", lambda p, s: db.get_lessons_changed_since(
+        p, localtime.utc_now() - timedelta(days=1))),
+    Case("get_reminder_recipients", "lessons",
+         lambda p, s: db.get_reminder_recipients(p, s[0], s[1], f"reminder_{s[0]}")),
+    Case("record_reminders", "lessons", lambda p, s: db.record_reminders(
+        p, s[0], f"reminder_{s[0]}", [(s[2], "Скоро занятие", f"/lessons/{s[0]}", False)]), write=True),
+    Case("apply_change", "lessons", lambda p, s: db.apply_change(
+        p, {"t": "Lesson", "old": None, "new": {"id": s[0], "ownerId": s[2]}})),
+    Case("toggle_lesson_paid", "lessons", lambda p, s: db.toggle_lesson_paid(p, s[0], True), write=True),
+    Case("toggle_lesson_cancel", "lessons", lambda p, s: db.toggle_lesson_cancel(p, s[0], True), write=True),
+    Case("toggle_student_payment", "payments",
+         lambda p, s: db.toggle_student_payment(p, s[0], s[1], True), write=True),
+    Case("settle_student_debts", "students", lambda p, s: db.settle_student_debts(p, s[0], s[1]), write=True),
+    Case("settle_group_lesson", "group_lessons", lambda p, s: db.settle_group_lesson(p, s[0], s[1]), write=True),
+    Case("create_lesson_request", "request_lessons",
+         lambda p, s: db.create_lesson_request(p, s[0], s[1], "cancel"), write=True),
+    Case("approve_lesson_request", "requests", lambda p, s: db.approve_lesson_request(p, s[0]), write=True),
+    Case("reject_lesson_request", "requests", lambda p, s: db.reject_lesson_request(p, s[0]), write=True),
+]
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def run_case(pool, case, samples, iterations, warmup=5):
+    timings, round_trips, rows, errors = [], [], [], 0
+    pool.rollback = case.write
+    for i in range(warmup + iterations):
+        sample = samples[i % len(samples)]
+        db.flush_caches()
+        pool.counter = Counter()
+        started = time.perf_counter()
+        try:
+            await case.call(pool, sample)
+        except Exception:
+            errors += 1
+            continue
+        elapsed = time.perf_counter() - started
+        if i >= warmup:
+            timings.append(elapsed)
+            round_trips.append(pool.counter.round_trips)
+            rows.append(pool.counter.rows)
+    pool.rollback = False
+    if not timings:
+        return {"calls": 0, "errors": errors}
+    timings.sort()
+    return {
+        "calls": len(timings),
+        "errors": errors,
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(timings, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+        "max_ms": round(timings[-1] * 1000, 3),
+        "round_trips": round(sum(round_trips) / len(round_trips), 2),
+        "rows": round(sum(rows) / len(rows), 2),
+        "max_rows": max(rows)
+    }
@@ -0,0 +1,109 @@
+"""A local stand-in for the Telegram Bot API, for benchmarks and load tests.
+
+Serves /bot<token>/<method> on the running asyncio loop (tornado) and answers
+the methods the bot uses with plausible payloads. It can add a fixed latency
+and enforce Telegram-like flood limits, answering 429 with retry_after when
+more than `global_rate` calls/sec overall or `chat_rate` sends/sec to one
+chat arrive. Every call is recorded in `calls`.
+
+Point the bot at it with TELEGRAM_API_BASE_URL=http://127.0.0.1:<port>/bot
+"""
+import asyncio
+import json
+import time
+from collections import defaultdict, deque
+import tornado.web
+
+CHAT_METHODS = ("sendMessage", "editMessageText", "editMessageReplyMarkup")
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, global_rate=None, chat_rate=None, retry_after=1):
+        self.latency = latency
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.retry_after = retry_after
+        self.calls = []  # (monotonic time, method, chat_id, status)
+        self.flood_errors = 0
+        self._recent = deque()
+        self._recent_by_chat = defaultdict(deque)
+        self._message_id = 0
+        self._server = None
+
+    def start(self, port=0, address="127.0.0.1"):
+        app = tornado.web.Application([(r"/bot([^/]+)/(\w+)", _Handler, {"api": self})])
+        self._server = app.listen(port, address)
+        self.port = next(iter(self._server._sockets.values())).getsockname()[1]
+        return f"http://{address}:{self.port}/bot"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    def count(self, method=None):
+        return sum(1 for _, m, _, _ in self.calls if method is None or m == method)
+
+    def _flooded(self, now, method, chat_id):
+        window = self._recent
+        while window and now - window[0] >= 1:
+            window.popleft()
+        if self.global_rate is not None and len(window) >= self.global_rate:
+            return True
+        if self.chat_rate is not None and method in CHAT_METHODS and chat_id is not None:
+            chat_window = self._recent_by_chat[chat_id]
+            while chat_window and now - chat_window[0] >= 1:
+                chat_window.popleft()
+            if len(chat_window) >= self.chat_rate:
+                return True
+            chat_window.append(now)
+        window.append(now)
+        return False
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "U"}}
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            self._message_id += 1
+            chat_id = params.get("chat_id")
+            return {
+                "message_id": int(params.get("message_id") or self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id) if chat_id is not None else 0, "type": "private"},
+                "text": params.get("text", "")
+            }
+        if method == "getUpdates":
+            return []
+        return True
+
+
+class _Handler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    async def post(self, token, method):
+        api = self.api
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(self.request.body or b"{}")
+        else:
+            params = {k: self.get_argument(k) for k in self.request.arguments}
+        chat_id = params.get("chat_id")
+        if api.latency:
+            await asyncio.sleep(api.latency)
+        now = time.monotonic()
+        if api._flooded(now, method, chat_id):
+            api.flood_errors += 1
+            api.calls.append((now, method, chat_id, 429))
+            self.set_status(429)
+            self.write({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {api.retry_after}",
+                "parameters": {"retry_after": api.retry_after}
+            })
+            return
+        api.calls.append((now, method, chat_id, 200))
+        self.write({"ok": True, "result": api.result(method, params)})
+
+    get = post
@@ -0,0 +1,261 @@
+"""End-to-end throughput of the bot's real handlers.
+
+Builds the Application from main.py exactly as production does and replays
+an Update stream through it: the handlers from main.py, the update processor,
+the rate limiter and the caches, against a local Postgres and the fake Bot
+API (benchmarks/fake_bot_api.py) in this process. Reports updates/sec,
+latency percentiles per handler and Bot API calls per update.
+
+The synthetic stream gives users from the dataset a session each, with their
+updates in order: /start, main menu, schedule, today, tomorrow, a lesson card,
+finance and the "📅 Расписание" reply button. Sessions of different users
+interleave. Load the dataset with `python -m benchmarks.dbbench load` first.
+Only read paths are exercised, so the dataset is left as it was.
+A recorded stream (JSON lines of Update objects, as returned by getUpdates)
+can be replayed instead with --replay; its users must exist in the database.
+
+    BENCH_DATABASE_URL=postgres://localhost/tuterra_bench python -m benchmarks.handlers \\
+        [--users 200] [--rounds 3] [--api-latency 0.03] [--rate 0] [--out handlers.json]
+
+The fake Bot API shares the event loop with the bot, so its own CPU time is
+included in the figures; use --api-latency to model Telegram's response time.
+The outbound rate limits are lifted so the figures show handler capacity;
+--telegram-limits keeps the production ones (then a user's session is paced
+by SEND_CHAT_RATE and the total by SEND_GLOBAL_RATE).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from telegram import Update
+from benchmarks.fake_bot_api import FakeBotAPI
+
+TOKEN = "123:fake"
+
+USERS_SQL = '''
+    SELECT u."telegramId", u.role, COALESCE(
+        (SELECT l.id FROM "Lesson" l WHERE l."ownerId" = u.id ORDER BY l.date DESC LIMIT 1),
+        (SELECT l.id FROM "Lesson" l JOIN "Student" st ON st.id = l."studentId"
+         WHERE st."linkedUserId" = u.id ORDER BY l.date DESC LIMIT 1)
+    ) AS lesson_id
+    FROM "User" u
+    WHERE u."telegramId" IS NOT NULL
+    ORDER BY md5(u.id)
+    LIMIT $1
+'''
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def _ids(self):
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    def message(self, user_id, text):
+        update_id, message_id = self._ids()
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith('/') else []
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": message_id, "date": int(time.time()), "text": text, "entities": entities,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench"}
+            }
+        }
+
+    def callback(self, user_id, data):
+        update_id, message_id = self._ids()
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id), "chat_instance": str(user_id), "data": data,
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+                "message": {
+                    "message_id": message_id, "date": int(time.time()), "text": "…",
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "Fake"}
+                }
+            }
+        }
+
+
+def session(factory, user_id, lesson_id):
+    updates = [
+        factory.message(user_id, "/start"),
+        factory.callback(user_id, "menu_main"),
+        factory.callback(user_id, "menu_schedule"),
+        factory.callback(user_id, "sched_today"),
+        factory.callback(user_id, "sched_tomorrow"),
+    ]
+    if lesson_id:
+        updates.append(factory.callback(user_id, f"l_{lesson_id}"))
+    updates += [
+        factory.callback(user_id, "menu_finance"),
+        factory.message(user_id, "📅 Расписание"),
+    ]
+    return updates
+
+
+def synthetic_stream(users, rounds, seed=42):
+    """Sessions of all users, interleaved at random but in order per user."""
+    rnd = random.Random(seed)
+    factory = UpdateFactory()
+    queues = [session(factory, int(tg), lesson_id) for _ in range(rounds) for tg, _, lesson_id in users]
+    stream = []
+    while queues:
+        i = rnd.randrange(len(queues))
+        stream.append(queues[i].pop(0))
+        if not queues[i]:
+            queues[i] = queues[-1]
+            queues.pop()
+    return stream
+
+
+def instrument(app, timings):
+    def timed(name, callback):
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                timings[name].append(time.perf_counter() - started)
+        return wrapper
+
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = timed(handler.callback.__name__, handler.callback)
+
+
+async def run(args):
+    api = FakeBotAPI(latency=args.api_latency)
+    base_url = api.start()
+    # main.py and db.py read their settings at import time
+    os.environ.update({
+        "DATABASE_URL": args.database_url,
+        "TELEGRAM_API_BASE_URL": base_url,
+        "REMINDERS_ENABLED": "0",
+        "DB_CHANGE_LISTENER": "0",
+        "STATE_BACKEND": "memory",
+    })
+    if not args.telegram_limits:
+        os.environ.update({"SEND_GLOBAL_RATE": "1000000", "SEND_CHAT_RATE": "1000000"})
+    import main as bot_main
+
+    app = bot_main.build_application(TOKEN)
+    timings = defaultdict(list)
+    errors = []
+    instrument(app, timings)
+
+    async def on_error(update, context):
+        errors.append(context.error)
+
+    app.add_error_handler(on_error)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    try:
+        if args.replay:
+            with open(args.replay) as f:
+                raw = [json.loads(line) for line in f if line.strip()]
+        else:
+            async with app.bot_data['pool'].acquire() as conn:
+                users = await conn.fetch(USERS_SQL, args.users)
+            if not users:
+                sys.exit("No users with a telegramId in the database; run benchmarks.dbbench load first")
+            raw = synthetic_stream(users, args.rounds, args.seed)
+        updates = [Update.de_json(data, app.bot) for data in raw]
+        calls_before = len(api.calls)
+
+        started = time.perf_counter()
+        for update in updates:
+            await app.update_queue.put(update)
+            if args.rate:
+                await asyncio.sleep(1 / args.rate)
+        await app.stop()  # returns once every queued update has been handled
+        elapsed = time.perf_counter() - started
+    finally:
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+        api.stop()
+
+    calls = api.calls[calls_before:]
+    methods = defaultdict(int)
+    for _, method, _, _ in calls:
+        methods[method] += 1
+    handlers = {}
+    for name, values in sorted(timings.items()):
+        values.sort()
+        handlers[name] = {
+            "calls": len(values),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3)
+        }
+    result = {
+        "updates": len(updates),
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(len(updates) / elapsed, 1),
+        "api_calls_per_update": round(len(calls) / len(updates), 2),
+        "api_calls": dict(methods),
+        "errors": len(errors),
+        "handlers": handlers,
+        "settings": {
+            "concurrent_updates": bot_main.CONCURRENT_UPDATES,
+            "api_latency_s": args.api_latency,
+            "rate": args.rate,
+            "telegram_limits": args.telegram_limits,
+            "source": args.replay or f"synthetic: {args.users} users x {args.rounds} rounds"
+        }
+    }
+
+    print(f"{result['updates']} updates in {result['elapsed_s']}s: {result['updates_per_s']} updates/s, "
+          f"{result['api_calls_per_update']} Bot API calls/update {dict(methods)}, errors={len(errors)}")
+    print(f"{'handler':<28}{'calls':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, h in handlers.items():
+        print(f"{name:<28}{h['calls']:>7}{h['p50_ms']:>9}{h['p95_ms']:>9}{h['p99_ms']:>9}{h['max_ms']:>9}")
+    if errors:
+        print(f"First error: {errors[0]!r}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"Saved to {args.out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.handlers")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=3, help="sessions per user")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--replay", help="JSON lines of recorded updates instead of the synthetic stream")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per fake Bot API call")
+    parser.add_argument("--rate", type=float, default=0, help="updates/sec to feed; 0 = all at once")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the production outbound rate limits")
+    parser.add_argument("--out", help="save results as JSON")
+    args = parser.parse_args()
+    args.database_url = os.getenv("BENCH_DATABASE_URL")
+    if not args.database_url:
+        sys.exit("Set BENCH_DATABASE_URL to the benchmark database")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Keyboard render cost per update: building markups vs the cached factory.
+
+Each simulated update renders what a typical screen sends: the main menu,
+a back-button keyboard, a date picker and a time picker for one lesson out
+of a working set of `lessons` distinct lessons.
+
+    python -m benchmarks.keyboards [updates] [lessons]
+"""
+import sys
+import time
+import keyboards
+from keyboards import (
+    _build_main_menu_keyboard, _build_date_picker, _build_time_picker,
+    main_menu_keyboard, back_markup, generate_date_picker, generate_time_picker
+)
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import localtime
+
+TZ = "Europe/Moscow"
+
+
+def render_built(lesson_id, today, date_str):
+    _build_main_menu_keyboard('teacher')
+    InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='menu_main')]])
+    _build_date_picker(lesson_id, 'rs', today)
+    _build_time_picker(lesson_id, date_str, 'rs')
+
+
+def render_cached(lesson_id, today, date_str):
+    main_menu_keyboard('teacher')
+    back_markup()
+    generate_date_picker(lesson_id, 'rs', TZ)
+    generate_time_picker(lesson_id, date_str, 'rs')
+
+
+def run(render, updates, lessons):
+    today = localtime.local_today(TZ)
+    date_str = today.isoformat()
+    ids = [f"lesson{i}" for i in range(lessons)]
+    started = time.perf_counter()
+    for i in range(updates):
+        render(ids[i % lessons], today, date_str)
+    return (time.perf_counter() - started) / updates
+
+
+def main(updates, lessons):
+    built = run(render_built, updates, lessons)
+    cached = run(render_cached, updates, lessons)
+    print(f"updates={updates} lessons={lessons}")
+    print(f"built : {built * 1e6:8.1f} us/update")
+    print(f"cached: {cached * 1e6:8.1f} us/update ({built / cached:.1f}x)")
+    for name, info in keyboards.cache_stats().items():
+        print(f"  {name}: {info}")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*(args + [20000, 500][len(args):]))
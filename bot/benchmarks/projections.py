@@ -0,0 +1,109 @@
+"""Wide rows vs per-screen projections for the bot's hot lookups.
+
+Compares the old `SELECT *` / `l.*` queries, copied into a dict the way the
+handlers used to, against the projected queries from db.py returning row
+types from rows.py. Reports per-call latency and the memory retained per row.
+
+Run from bot/ against a database with some data (never production):
+
+    BENCH_DATABASE_URL=postgres://... python -m benchmarks.projections [rounds]
+"""
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+import asyncpg
+from dotenv import load_dotenv
+from db import Q_USER_BY_TELEGRAM_ID, Q_STUDENTS_BY_OWNER, Q_LESSON_BY_ID, Q_LESSON_REQUEST
+
+load_dotenv()
+
+WIDE = {
+    'user_by_telegram_id': 'SELECT * FROM "User" WHERE "telegramId" = $1',
+    'students_by_owner': 'SELECT * FROM "Student" WHERE "ownerId" = $1 ORDER BY name ASC',
+    'lesson_by_id': '''
+        SELECT l.*, s.name as "subjectName", st.name as "studentName", sg.name as "groupName", u.name as "teacherName"
+        FROM "Lesson" l
+        LEFT JOIN "Subject" s ON l."subjectId" = s.id
+        LEFT JOIN "Student" st ON l."studentId" = st.id
+        LEFT JOIN "Group" sg ON l."groupId" = sg.id
+        LEFT JOIN "User" u ON l."ownerId" = u.id
+        WHERE l.id = $1
+    ''',
+    'lesson_request': '''
+        SELECT lr.*, l.date as "lessonDate", s.name as "subjectName",
+               st.name as "studentName", sg.name as "groupName", u.name as "requesterName"
+        FROM "LessonRequest" lr
+        JOIN "Lesson" l ON lr."lessonId" = l.id
+        LEFT JOIN "Subject" s ON l."subjectId" = s.id
+        LEFT JOIN "Student" st ON l."studentId" = st.id
+        LEFT JOIN "Group" sg ON l."groupId" = sg.id
+        LEFT JOIN "User" u ON lr."userId" = u.id
+        WHERE lr.id = $1
+    '''
+}
+
+NARROW = {q.name: q for q in (Q_USER_BY_TELEGRAM_ID, Q_STUDENTS_BY_OWNER, Q_LESSON_BY_ID, Q_LESSON_REQUEST)}
+
+SAMPLES = {
+    'user_by_telegram_id': 'SELECT "telegramId" FROM "User" WHERE "telegramId" IS NOT NULL LIMIT $1',
+    'students_by_owner': 'SELECT DISTINCT "ownerId" FROM "Student" LIMIT $1',
+    'lesson_by_id': 'SELECT id FROM "Lesson" ORDER BY date DESC LIMIT $1',
+    'lesson_request': 'SELECT id FROM "LessonRequest" ORDER BY "createdAt" DESC LIMIT $1'
+}
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def run_variant(conn, keys, rounds, wide_sql=None, narrow=None):
+    """Fetch every key `rounds` times, keeping each result as a handler would."""
+    kept, timings, rows = [], [], 0
+    tracemalloc.start()
+    for _ in range(rounds):
+        for key in keys:
+            started = time.perf_counter()
+            if wide_sql is not None:
+                result = [dict(r) for r in await conn.fetch(wide_sql, key)]
+            else:
+                result = await narrow.fetch(conn, key)
+            timings.append(time.perf_counter() - started)
+            rows += len(result)
+            kept.append(result)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings.sort()
+    return {
+        "calls": len(timings),
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(timings, 0.95) * 1000, 3),
+        "bytes_per_row": round(retained / rows) if rows else 0
+    }
+
+
+async def main(rounds):
+    url = os.getenv("BENCH_DATABASE_URL") or os.getenv("DATABASE_URL")
+    if not url:
+        sys.exit("Set BENCH_DATABASE_URL (or DATABASE_URL)")
+    conn = await asyncpg.connect(url)
+    try:
+        print(f"{'query':<22}{'variant':<8}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'B/row':>9}")
+        for name, sample_sql in SAMPLES.items():
+            keys = [r[0] for r in await conn.fetch(sample_sql, 50)]
+            if not keys:
+                print(f"{name:<22}no sample rows, skipped")
+                continue
+            # Warm both statements so neither variant pays for Parse/Describe
+            await run_variant(conn, keys[:1], 1, wide_sql=WIDE[name])
+            await run_variant(conn, keys[:1], 1, narrow=NARROW[name])
+            for variant, kwargs in (("wide", {"wide_sql": WIDE[name]}), ("narrow", {"narrow": NARROW[name]})):
+                r = await run_variant(conn, keys, rounds, **kwargs)
+                print(f"{name:<22}{variant:<8}{r['calls']:>7}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['bytes_per_row']:>9}")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
@@ -0,0 +1,74 @@
+"""Outbound send queue against the fake Bot API with flood limits on.
+
+A bulk broadcast (one message to each of `chats` chats) is started, then
+interactive replies arrive for a few chats while it drains. Run once with
+the bot's OutboundRateLimiter and once without any limiter, and compare
+flood errors and per-class latency.
+
+    python -m benchmarks.send_queue [chats] [interactive]
+"""
+import asyncio
+import logging
+import sys
+import time
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from send_queue import OutboundRateLimiter, PRIORITY_BULK
+from benchmarks.fake_bot_api import FakeBotAPI
+
+TOKEN = "123:fake"
+
+
+def summary(latencies):
+    if not latencies:
+        return "n=0"
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return f"n={len(latencies)} p50={pick(0.5):.0f}ms p95={pick(0.95):.0f}ms max={latencies[-1] * 1000:.0f}ms"
+
+
+async def send(bot, chat_id, text, out, rate_limit_args):
+    started = time.perf_counter()
+    kwargs = {"rate_limit_args": rate_limit_args} if rate_limit_args is not None else {}
+    try:
+        await bot.send_message(chat_id, text, **kwargs)
+        out.append(time.perf_counter() - started)
+    except RetryAfter:
+        out.append(None)
+
+
+async def scenario(limiter, chats, interactive):
+    # Telegram-like limits: ~30 calls/sec overall, short bursts per chat
+    api = FakeBotAPI(latency=0.005, global_rate=30, chat_rate=3)
+    base_url = api.start()
+    bot = ExtBot(TOKEN, base_url=base_url, rate_limiter=limiter)
+    bulk, replies = [], []
+    async with bot:
+        started = time.perf_counter()
+        broadcast = [
+            asyncio.create_task(send(bot, 1000 + i, "Напоминание", bulk, PRIORITY_BULK if limiter else None))
+            for i in range(chats)
+        ]
+        await asyncio.sleep(0.2)
+        for i in range(interactive):
+            await send(bot, 1 + i % 3, "Ответ", replies, None)
+        await asyncio.gather(*broadcast)
+        elapsed = time.perf_counter() - started
+    api.stop()
+    name = "OutboundRateLimiter" if limiter else "no limiter"
+    print(f"--- {name}: {elapsed:.1f}s, 429 responses from API: {api.flood_errors}")
+    print(f"  bulk        {summary([x for x in bulk if x is not None])}, failed={bulk.count(None)}")
+    print(f"  interactive {summary([x for x in replies if x is not None])}, failed={replies.count(None)}")
+    if limiter:
+        print(f"  limiter     {limiter.stats()}")
+
+
+async def main(chats, interactive):
+    await scenario(None, chats, interactive)
+    await scenario(OutboundRateLimiter(), chats, interactive)
+
+
+if __name__ == "__main__":
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+    args = [int(a) for a in sys.argv[1:3]]
+    asyncio.run(main(*(args + [120, 10][len(args):])))
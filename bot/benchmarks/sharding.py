@@ -0,0 +1,102 @@
+"""Throughput of the multi-worker mode (sharding.py) by worker count.
+
+Synthetic callback-query updates from `chats` chats are routed through
+ShardedRunner into real worker processes. Each worker runs an Application
+with ChatOrderedUpdateProcessor and a handler doing the CPU-bound part of a
+typical screen: building its keyboards from scratch and serialising the
+reply the way a Bot API request would be. No DB or network is involved, so
+the numbers show how update processing scales across cores (workers beyond
+the number of cores can't help). The fake Bot API only answers getMe.
+
+    python -m benchmarks.sharding [updates] [chats] [workers ...]
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from telegram import Update
+from telegram.ext import ApplicationBuilder, CallbackQueryHandler
+from keyboards import _build_main_menu_keyboard, _build_date_picker, _build_time_picker
+from sharding import ShardedRunner
+from update_processor import ChatOrderedUpdateProcessor
+from benchmarks.fake_bot_api import FakeBotAPI
+import localtime
+
+TOKEN = "123:fake"
+TZ = "Europe/Moscow"
+
+
+async def render_screen(update, context):
+    today = localtime.local_today(TZ)
+    lesson_id = update.callback_query.data
+    markups = (
+        _build_main_menu_keyboard('teacher'),
+        _build_date_picker(lesson_id, 'rs', today),
+        _build_time_picker(lesson_id, today.isoformat(), 'rs')
+    )
+    for markup in markups:
+        json.dumps({"chat_id": update.effective_chat.id, "text": lesson_id, "reply_markup": markup.to_dict()})
+
+
+def build_bench_application():
+    app = (
+        ApplicationBuilder().token(TOKEN).base_url(os.environ["BENCH_API_URL"]).updater(None)
+        .concurrent_updates(ChatOrderedUpdateProcessor(16)).build()
+    )
+    app.add_handler(CallbackQueryHandler(render_screen))
+    return app
+
+
+def make_updates(count, chats):
+    return [
+        Update.de_json({
+            "update_id": i,
+            "callback_query": {
+                "id": str(i), "chat_instance": "bench", "data": f"lesson{i % 50}",
+                "from": {"id": 1000 + i % chats, "is_bot": False, "first_name": "U"},
+                "message": {
+                    "message_id": 1, "date": 0,
+                    "chat": {"id": 1000 + i % chats, "type": "private"}
+                }
+            }
+        }, None)
+        for i in range(count)
+    ]
+
+
+async def run(workers, updates):
+    runner = ShardedRunner(workers, "benchmarks.sharding:build_bench_application")
+    runner.start_workers()
+    await runner.wait_ready()
+    started = time.perf_counter()
+    for update in updates:
+        await runner.route(update)
+    await runner.stop_workers()
+    elapsed = time.perf_counter() - started
+    processed = sum(s["processed"] for s in runner.worker_stats.values() if s)
+    return elapsed, processed, runner.routed
+
+
+async def main(count, chats, worker_counts):
+    api = FakeBotAPI()
+    os.environ["BENCH_API_URL"] = api.start()
+    updates = make_updates(count, chats)
+    print(f"{count} updates from {chats} chats, {os.cpu_count()} CPUs")
+    baseline = None
+    for workers in worker_counts:
+        elapsed, processed, routed = await run(workers, updates)
+        rate = processed / elapsed
+        baseline = baseline or rate
+        print(f"  workers={workers}: {rate:.0f} updates/s ({rate / baseline:.2f}x), "
+              f"processed={processed}, per worker={routed}")
+    api.stop()
+
+
+if __name__ == "__main__":
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    args = [int(a) for a in sys.argv[1:]]
+    count, chats = (args + [20000, 500][len(args):])[:2]
+    asyncio.run(main(count, chats, args[2:] or [1, 2, 4]))
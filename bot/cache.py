@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        return self._data.pop(key, (None, None))[1]
+
+    def invalidate_where(self, predicate):
+        stale = [key for key, (_, value) in self._data.items() if predicate(value)]
+        for key in stale:
+            del self._data[key]
+        return len(stale)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class StaleWhileRevalidateCache:
+    """Per-key async cache: fresh for `fresh_ttl`, then served stale (up to
+    `stale_ttl`) whenever a refresh takes longer than `refresh_timeout`.
+
+    Entries carry a `version` (e.g. the user's local date); a version change
+    is treated as a miss, which is how daily figures roll over at midnight.
+    """
+
+    def __init__(self, maxsize=1024, fresh_ttl=60, stale_ttl=900, refresh_timeout=0.5):
+        self.maxsize = maxsize
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.refresh_timeout = refresh_timeout
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (stored_at, version, value)
+        self._refreshing = {}  # (key, version) -> asyncio.Task
+
+    async def get(self, key, version, loader):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] == version:
+            age = time.monotonic() - entry[0]
+            if age < self.fresh_ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if age < self.stale_ttl:
+                task = self._refresh(key, version, loader)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(task), self.refresh_timeout)
+                except Exception as e:
+                    if not isinstance(e, asyncio.TimeoutError):
+                        logging.warning(f"Cache refresh failed for {key}, serving stale: {e}")
+                    self.stale_hits += 1
+                    return entry[2]
+        self.misses += 1
+        return await asyncio.shield(self._refresh(key, version, loader))
+
+    def _refresh(self, key, version, loader):
+        # Concurrent callers for the same key and version share one load; a
+        # caller asking for a new version (after midnight) never joins a load
+        # of the old one
+        task = self._refreshing.get((key, version))
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, version, loader))
+            task.add_done_callback(_consume_exception)
+            self._refreshing[(key, version)] = task
+        return task
+
+    async def _load(self, key, version, loader):
+        task = asyncio.current_task()
+        started = time.monotonic()
+        try:
+            value = await loader()
+            # An invalidation during the load detaches this task, and a newer
+            # version stored meanwhile wins; in both cases don't store the result
+            entry = self._data.get(key)
+            current = entry is None or entry[1] == version or entry[0] < started
+            if self._refreshing.get((key, version)) is task and current:
+                self._data[key] = (time.monotonic(), version, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+            return value
+        finally:
+            if self._refreshing.get((key, version)) is task:
+                del self._refreshing[(key, version)]
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self._data.pop(key, None)
+        if self._refreshing:
+            keys = set(keys)
+            for loading in [k for k in self._refreshing if k[0] in keys]:
+                del self._refreshing[loading]
+
+    def clear(self):
+        self._data.clear()
+        self._refreshing.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data), "hits": self.hits,
+            "stale_hits": self.stale_hits, "misses": self.misses
+        }
+
+
+def _consume_exception(task):
+    if not task.cancelled():
+        task.exception()
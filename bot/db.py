@@ -1,450 +1,901 @@
 import os
+import json
+import uuid
 import asyncpg
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
-import pytz
+from cache import TTLCache, StaleWhileRevalidateCache
+from queries import REGISTRY, query
+from pool import InstrumentedPool
+from slow_queries import SlowQueryLog
+import localtime
+from rows import UserRow, StudentRow, LessonRow, LessonRequestRow, StudentScopeRow
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Users resolved by Telegram id, shared by every handler. Entries are dropped
+# by the linking flows below; anything else that changes a User (e.g. the web
+# app) should call invalidate_user(), otherwise the TTL bounds staleness.
+USER_CACHE = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "300"))
+)
+
+# Dashboard/finance figures keyed by User.id. Write paths below invalidate the
+# owner and linked students of the lesson they touch.
+STATS_CACHE = StaleWhileRevalidateCache(
+    maxsize=int(os.getenv("STATS_CACHE_SIZE", "10000")),
+    fresh_ttl=float(os.getenv("STATS_CACHE_TTL", "60")),
+    stale_ttl=float(os.getenv("STATS_CACHE_STALE_TTL", "900")),
+    refresh_timeout=float(os.getenv("STATS_REFRESH_TIMEOUT", "0.5"))
+)
+
+# Student scope (linked Student ids + their group ids) keyed by User.id.
+# Dropped by apply_change() on Student and _GroupToStudent changes; the TTL
+# bounds staleness when the change listener is off.
+SCOPE_CACHE = TTLCache(
+    maxsize=int(os.getenv("STUDENT_SCOPE_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("STUDENT_SCOPE_CACHE_TTL", "300"))
+)
+
+def _env_number(name, default, cast=float):
+    value = os.getenv(name)
+    return cast(value) if value not in (None, "") else default
+
 async def get_db_pool():
-    return await asyncpg.create_pool(DATABASE_URL)
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=_env_number("DB_POOL_MIN_SIZE", 10, int),
+        max_size=_env_number("DB_POOL_MAX_SIZE", 10, int),
+        max_queries=_env_number("DB_POOL_MAX_QUERIES", 50000, int),
+        max_inactive_connection_lifetime=_env_number("DB_POOL_MAX_INACTIVE_LIFETIME", 300.0),
+        command_timeout=_env_number("DB_COMMAND_TIMEOUT", None),
+        **REGISTRY.pool_kwargs()
+    )
+    if REGISTRY.prepared:
+        async with pool.acquire() as conn:
+            await REGISTRY.validate_connection(conn)
+    return InstrumentedPool(pool, acquire_timeout=_env_number("DB_POOL_ACQUIRE_TIMEOUT", 10.0))
+
+def start_slow_query_log(pool):
+    """Log statements slower than DB_SLOW_QUERY_MS with their plans (off when unset)."""
+    threshold_ms = _env_number("DB_SLOW_QUERY_MS", 0.0)
+    if not threshold_ms:
+        return None
+    REGISTRY.slow_log = SlowQueryLog(
+        pool,
+        path=os.getenv("DB_SLOW_QUERY_LOG", "slow_queries.log"),
+        threshold=threshold_ms / 1000,
+        interval=_env_number("DB_SLOW_QUERY_INTERVAL", 300.0),
+        explain=os.getenv("DB_SLOW_QUERY_EXPLAIN", "1") == "1"
+    )
+    return REGISTRY.slow_log
+
+async def stop_slow_query_log():
+    slow_log, REGISTRY.slow_log = REGISTRY.slow_log, None
+    if slow_log is not None:
+        await slow_log.close()
+
+def get_query_stats():
+    """Per-statement execution counts and timings, keyed by query name."""
+    return REGISTRY.stats()
+
+def invalidate_user(telegram_id=None, user_id=None):
+    """Drop cached users by Telegram id and/or User.id (external invalidation hook)."""
+    if telegram_id is not None:
+        USER_CACHE.invalidate(str(telegram_id))
+    if user_id is not None:
+        USER_CACHE.invalidate_where(lambda user: user['id'] == user_id)
+
+Q_USER_BY_TELEGRAM_ID = query('user_by_telegram_id', f'''
+    SELECT {UserRow.select_list('u')} FROM "User" u WHERE u."telegramId" = $1
+''', UserRow)
 
 async def get_user_by_telegram_id(pool, telegram_id):
+    key = str(telegram_id)
+    user = USER_CACHE.get(key)
+    if user is not None:
+        return user
     async with pool.acquire() as conn:
-        return await conn.fetchrow('SELECT * FROM "User" WHERE "telegramId" = $1', str(telegram_id))
+        user = await Q_USER_BY_TELEGRAM_ID.fetchrow(conn, key)
+    # Unlinked users are not cached so a fresh link is picked up immediately
+    if user is not None:
+        USER_CACHE.set(key, user)
+    return user
+
+# Link + enable Telegram delivery in one statement; returns the linked user
+Q_LINK_TELEGRAM_BY_EMAIL = query('link_telegram_by_email', f'''
+    WITH linked AS (
+        UPDATE "User" u SET "telegramId" = $1, "telegramChatId" = $2
+        WHERE u.email = $3
+        RETURNING {UserRow.select_list('u')}
+    ), settings AS (
+        UPDATE "NotificationSettings" ns SET "deliveryTelegram" = true
+        FROM linked WHERE ns."userId" = linked.id
+    )
+    SELECT * FROM linked
+''', UserRow)
 
 async def link_user_telegram(pool, email, telegram_id, chat_id):
     async with pool.acquire() as conn:
-        user = await conn.fetchrow('SELECT * FROM "User" WHERE email = $1', email)
-        if not user:
-            return None
-        await conn.execute(
-            'UPDATE "User" SET "telegramId" = $1, "telegramChatId" = $2 WHERE email = $3',
-            str(telegram_id), str(chat_id), email
-        )
-        # Enable Telegram delivery in settings
-        await conn.execute(
-            'UPDATE "NotificationSettings" SET "deliveryTelegram" = true WHERE "userId" = $1',
-            user['id']
+        user = await Q_LINK_TELEGRAM_BY_EMAIL.fetchrow(conn, str(telegram_id), str(chat_id), email)
+    if not user:
+        return None
+    invalidate_user(telegram_id=telegram_id, user_id=user['id'])
+    return user
+
+# Consume a valid code, link the user and enable Telegram delivery in one
+# statement (and so one transaction); returns the linked user
+Q_REDEEM_TELEGRAM_CODE = query('redeem_telegram_code', f'''
+    WITH code AS (
+        DELETE FROM "VerificationCode"
+        WHERE id = (
+            SELECT id FROM "VerificationCode"
+            WHERE code = $1 AND type = 'TELEGRAM_LINK' AND "expiresAt" >= $4
+            ORDER BY "createdAt" DESC
+            LIMIT 1
+            FOR UPDATE
         )
-        return user
+        RETURNING "userId"
+    ), linked AS (
+        UPDATE "User" u SET "telegramId" = $2, "telegramChatId" = $3
+        FROM code WHERE u.id = code."userId"
+        RETURNING {UserRow.select_list('u')}
+    ), settings AS (
+        UPDATE "NotificationSettings" ns SET "deliveryTelegram" = true
+        FROM code WHERE ns."userId" = code."userId"
+    )
+    SELECT * FROM linked
+''', UserRow)
 
 async def verify_telegram_code(pool, code, telegram_id, chat_id):
+    # "expiresAt" is stored as naive UTC
     async with pool.acquire() as conn:
-        print(f"DEBUG: Searching for code: {code}")
-        # Find valid code
-        record = await conn.fetchrow("""
-            SELECT * FROM "VerificationCode" 
-            WHERE code = $1 AND type = 'TELEGRAM_LINK'
-        """, code)
-        
-        if not record:
-            return None
-            
-        # Ensure timezone-aware comparison (DB returns naive UTC usually, or aware UTC)
-        expires_at = record['expiresAt']
-        if expires_at.tzinfo is None:
-            expires_at = expires_at.replace(tzinfo=pytz.utc)
-            
-        now_utc = datetime.now(pytz.utc)
-        
-        if expires_at < now_utc:
-             return None
-        
-        user_id = record['userId']
-        
-        # Link user
-        await conn.execute("""
-            UPDATE "User" SET "telegramId" = $1, "telegramChatId" = $2 WHERE id = $3
-        """, str(telegram_id), str(chat_id), user_id)
-        
-        # Enable Telegram delivery in settings
-        await conn.execute(
-            'UPDATE "NotificationSettings" SET "deliveryTelegram" = true WHERE "userId" = $1',
-            user_id
-        )
-
-        # Delete used code
-        await conn.execute('DELETE FROM "VerificationCode" WHERE id = $1', record['id'])
-        
-        # Return user
-        return await conn.fetchrow('SELECT * FROM "User" WHERE id = $1', user_id)
+        user = await Q_REDEEM_TELEGRAM_CODE.fetchrow(conn, code, str(telegram_id), str(chat_id), localtime.utc_now())
+    if not user:
+        return None
+    invalidate_user(telegram_id=telegram_id, user_id=user['id'])
+    return user
 
 # --- Dashboard & Stats ---
+def invalidate_stats(*user_ids):
+    STATS_CACHE.invalidate(*user_ids)
+
+def _lesson_audience(lesson_id):
+    # Users whose dashboards include the lesson: the teacher and linked students.
+    # Selected by write statements so invalidation costs no extra round trip.
+    # Individual and group students are separate branches so each is an index
+    # lookup; an OR between them in one join makes Postgres scan "Student".
+    return f'''ARRAY(
+        SELECT l."ownerId" FROM "Lesson" l WHERE l.id = {lesson_id}
+        UNION
+        SELECT st."linkedUserId" FROM "Lesson" l
+        JOIN "Student" st ON st.id = l."studentId"
+        WHERE l.id = {lesson_id} AND st."linkedUserId" IS NOT NULL
+        UNION
+        SELECT st."linkedUserId" FROM "Lesson" l
+        JOIN "_GroupToStudent" gs ON gs."A" = l."groupId"
+        JOIN "Student" st ON st.id = gs."B"
+        WHERE l.id = {lesson_id} AND st."linkedUserId" IS NOT NULL
+    )'''
+
+def _stats_version(kind, user_tz):
+    # Daily figures roll over when the user's local date changes
+    return (kind, user_tz, localtime.local_today(user_tz))
+
 async def get_dashboard_stats(pool, user_id, user_tz="Europe/Moscow"):
+    return await STATS_CACHE.get(
+        user_id, _stats_version('teacher', user_tz),
+        lambda: _query_dashboard_stats(pool, user_id, user_tz)
+    )
+
+async def get_student_dashboard_stats(pool, user_id, user_tz="Europe/Moscow"):
+    return await STATS_CACHE.get(
+        user_id, _stats_version('student', user_tz),
+        lambda: _query_student_dashboard_stats(pool, user_id, user_tz)
+    )
+
+Q_DASHBOARD_STATS = query('dashboard_stats', '''
+    WITH month_lessons AS (
+        SELECT l.id, l.date, l.price, l."isPaid", l."groupId"
+        FROM "Lesson" l
+        WHERE l."ownerId" = $1
+          AND l.date >= $4
+          AND l."isCanceled" = false
+    ),
+    paid_counts AS (
+        SELECT lp."lessonId", COUNT(*) AS paid
+        FROM "LessonPayment" lp
+        JOIN month_lessons ml ON ml.id = lp."lessonId"
+        WHERE lp."hasPaid" = true
+        GROUP BY lp."lessonId"
+    ),
+    income AS (
+        SELECT ml.date,
+               CASE WHEN ml."groupId" IS NOT NULL THEN COALESCE(pc.paid, 0) * ml.price
+                    ELSE ml.price END AS amount
+        FROM month_lessons ml
+        LEFT JOIN paid_counts pc ON pc."lessonId" = ml.id
+        WHERE ml."isPaid" = true OR pc.paid IS NOT NULL
+    )
+    SELECT
+        (SELECT COUNT(*) FROM "Student" WHERE "ownerId" = $1) AS students,
+        (SELECT COUNT(*) FROM "Lesson"
+         WHERE "ownerId" = $1 AND date >= $2 AND date < $3 AND "isCanceled" = false) AS lessons_today,
+        (SELECT COALESCE(SUM(amount), 0)::bigint FROM income WHERE date >= $2 AND date < $3) AS income_today,
+        (SELECT COALESCE(SUM(amount), 0)::bigint FROM income) AS income_month
+''')
+
+async def _query_dashboard_stats(pool, user_id, user_tz):
+    today = localtime.local_today(user_tz)
+    today_start_utc, today_end_utc = localtime.day_window(user_tz, today)
+    sync_month_start = localtime.month_start(user_tz, today)
+
     async with pool.acquire() as conn:
-        # Students count
-        students = await conn.fetchval('SELECT COUNT(*) FROM "Student" WHERE "ownerId" = $1', user_id)
-        
-        # Today's lessons
-        tz = pytz.timezone(user_tz)
-        now_local = datetime.now(tz)
-        today_start = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
-        today_end = today_start + timedelta(days=1)
-        
-        # Convert to UTC for DB query (Postgres TIMESTAMP is usually naive UTC)
-        today_start_utc = today_start.astimezone(pytz.utc).replace(tzinfo=None)
-        today_end_utc = today_end.astimezone(pytz.utc).replace(tzinfo=None)
-        
-        lessons_today = await conn.fetchval(
-            'SELECT COUNT(*) FROM "Lesson" WHERE "ownerId" = $1 AND date >= $2 AND date < $3 AND "isCanceled" = false', 
-            user_id, today_start_utc, today_end_utc
-        )
-        
-        # Calculate income (sync with web app logic)
-        sync_month_start = today_start.replace(day=1).astimezone(pytz.utc).replace(tzinfo=None)
-        
-        # Fetch lessons in current month
-        lessons = await conn.fetch('''
-            SELECT l.id, l.price, l."isPaid", l."groupId", l.date
-            FROM "Lesson" l
-            WHERE l."ownerId" = $1 
-              AND l.date >= $2 
-              AND l."isCanceled" = false
-              AND (
-                  l."isPaid" = true 
-                  OR EXISTS (SELECT 1 FROM "LessonPayment" lp WHERE lp."lessonId" = l.id AND lp."hasPaid" = true)
-              )
-        ''', user_id, sync_month_start)
-        
-        income_month = 0
-        income_today = 0
-        
-        for lesson in lessons:
-            # Check if this lesson is today (using UTC comparison for simplicity or convert back)
-            is_today = today_start_utc <= lesson['date'] < today_end_utc
-            
-            l_income = 0
-            if lesson['groupId']:
-                paid_count = await conn.fetchval(
-                    'SELECT COUNT(*) FROM "LessonPayment" WHERE "lessonId" = $1 AND "hasPaid" = true',
-                    lesson['id']
-                )
-                l_income = (paid_count or 0) * lesson['price']
-            else:
-                l_income = lesson['price']
-            
-            income_month += l_income
-            if is_today:
-                income_today += l_income
-        
-        return {
-            "students": students,
-            "lessons_today": lessons_today,
-            "income": income_month,
-            "income_today": income_today
-        }
+        # Income (sync with web app logic): individual lessons count their price once,
+        # group lessons count price per paid LessonPayment. Everything in one round trip.
+        row = await Q_DASHBOARD_STATS.fetchrow(conn, user_id, today_start_utc, today_end_utc, sync_month_start)
+
+    return {
+        "students": row['students'],
+        "lessons_today": row['lessons_today'],
+        "income": row['income_month'],
+        "income_today": row['income_today']
+    }
+
+Q_STUDENT_SCOPE = query('student_scope', '''
+    SELECT
+        ARRAY(SELECT id FROM "Student" WHERE "linkedUserId" = $1) AS "studentIds",
+        ARRAY(
+            SELECT DISTINCT gs."A" FROM "_GroupToStudent" gs
+            JOIN "Student" st ON st.id = gs."B"
+            WHERE st."linkedUserId" = $1
+        ) AS "groupIds"
+''', StudentScopeRow)
+
+async def get_student_scope(pool, user_id):
+    key = str(user_id)
+    scope = SCOPE_CACHE.get(key)
+    if scope is None:
+        async with pool.acquire() as conn:
+            scope = await Q_STUDENT_SCOPE.fetchrow(conn, key)
+        SCOPE_CACHE.set(key, scope)
+    return scope
 
 async def get_student_ids(pool, user_id):
-    async with pool.acquire() as conn:
-        rows = await conn.fetch('SELECT id FROM "Student" WHERE "linkedUserId" = $1', str(user_id))
-        return [row['id'] for row in rows]
+    return list((await get_student_scope(pool, user_id)).studentIds)
 
-async def get_student_dashboard_stats(pool, user_id, user_tz="Europe/Moscow"):
-    student_ids = await get_student_ids(pool, user_id)
-    if not student_ids:
+# Today, upcoming and debt in one pass over the scope's lessons. Group debt
+# counts the price once per unpaid LessonPayment of the user's students,
+# including lessons of groups they have since left. Every branch of the OR is
+# a plain `= ANY(array)` so the three index lookups (studentId, groupId, id)
+# combine in a BitmapOr; an `IN (subquery)` branch would force a full scan.
+Q_STUDENT_DASHBOARD = query('student_dashboard', '''
+    WITH unpaid AS (
+        SELECT lp."lessonId", COUNT(*) AS n
+        FROM "LessonPayment" lp
+        WHERE lp."studentId" = ANY($1) AND lp."hasPaid" = false
+        GROUP BY lp."lessonId"
+    ),
+    lessons AS (
+        SELECT l.date, l.price, l."isPaid", u.n,
+               l."studentId" = ANY($1) AS own,
+               l."studentId" = ANY($1) OR l."groupId" = ANY($2) AS in_scope
+        FROM "Lesson" l
+        LEFT JOIN unpaid u ON u."lessonId" = l.id
+        WHERE l."isCanceled" = false
+          AND (l."studentId" = ANY($1) OR l."groupId" = ANY($2)
+               OR l.id = ANY(ARRAY(SELECT "lessonId" FROM unpaid)))
+    )
+    SELECT
+        COUNT(*) FILTER (WHERE in_scope AND date >= $3 AND date < $4) AS lessons_today,
+        COUNT(*) FILTER (WHERE in_scope AND date >= $5) AS upcoming,
+        (COALESCE(SUM(price) FILTER (WHERE own AND "isPaid" = false AND date < $5), 0)
+         + COALESCE(SUM(price * n) FILTER (WHERE date < $5), 0))::bigint AS debt
+    FROM lessons
+''')
+
+async def _query_student_dashboard_stats(pool, user_id, user_tz):
+    scope = await get_student_scope(pool, user_id)
+    if not scope.studentIds:
         return {"lessons_today": 0, "debt": 0, "upcoming": 0}
-        
+
+    today_start_utc, today_end_utc = localtime.today_window(user_tz)
+    now_utc = localtime.utc_now()
+
     async with pool.acquire() as conn:
-        tz = pytz.timezone(user_tz)
-        now_local = datetime.now(tz)
-        today_start = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
-        today_end = today_start + timedelta(days=1)
-        
-        today_start_utc = today_start.astimezone(pytz.utc).replace(tzinfo=None)
-        today_end_utc = today_end.astimezone(pytz.utc).replace(tzinfo=None)
-        now_utc = datetime.now(pytz.utc).replace(tzinfo=None)
-
-        # Today's lessons (individual + group)
-        lessons_today = await conn.fetchval('''
-            SELECT COUNT(*) FROM "Lesson" l
-            WHERE l."isCanceled" = false 
-              AND l.date >= $1 AND l.date < $2
-              AND (
-                  l."studentId" = ANY($3)
-                  OR l."groupId" IN (SELECT "A" FROM "_GroupToStudent" WHERE "B" = ANY($3))
-              )
-        ''', today_start_utc, today_end_utc, student_ids)
-
-        # Debt calculation
-        debt_amount = await conn.fetchval('''
-            SELECT SUM(price) FROM (
-                SELECT l.price FROM "Lesson" l
-                WHERE l."studentId" = ANY($1) AND l."isPaid" = false AND l."isCanceled" = false AND l.date < $2
-                UNION ALL
-                SELECT l.price FROM "LessonPayment" lp
-                JOIN "Lesson" l ON lp."lessonId" = l.id
-                WHERE lp."studentId" = ANY($1) AND lp."hasPaid" = false AND l."isCanceled" = false AND l.date < $2
-            ) as t
-        ''', student_ids, now_utc)
-
-        # Upcoming total
-        upcoming = await conn.fetchval('''
-            SELECT COUNT(*) FROM "Lesson" l
-            WHERE l."isCanceled" = false 
-              AND l.date >= $1
-              AND (
-                  l."studentId" = ANY($2)
-                  OR l."groupId" IN (SELECT "A" FROM "_GroupToStudent" WHERE "B" = ANY($2))
-              )
-        ''', now_utc, student_ids)
-
-        return {
-            "lessons_today": lessons_today or 0,
-            "debt": debt_amount or 0,
-            "upcoming": upcoming or 0
-        }
+        row = await Q_STUDENT_DASHBOARD.fetchrow(
+            conn, scope.studentIds, scope.groupIds, today_start_utc, today_end_utc, now_utc
+        )
+
+    return {
+        "lessons_today": row['lessons_today'],
+        "debt": row['debt'],
+        "upcoming": row['upcoming']
+    }
 
 # --- Lessons ---
-async def get_lessons_by_date(pool, user_id, date: datetime, user_tz="Europe/Moscow"):
-    tz = pytz.timezone(user_tz)
-    # Ensure date is local
-    if date.tzinfo is None:
-        date = tz.localize(date)
-    
-    start = date.replace(hour=0, minute=0, second=0, microsecond=0)
-    end = start + timedelta(days=1)
-    
-    # Convert to UTC for DB
-    start_utc = start.astimezone(pytz.utc).replace(tzinfo=None)
-    end_utc = end.astimezone(pytz.utc).replace(tzinfo=None)
-    
+Q_LESSONS_BY_DATE = query('lessons_by_date', '''
+    SELECT l.id, l.date, s.name as "subjectName", sg.name as "groupName", st.name as "studentName",
+           l."groupId", l."studentId", l."isPaid", l."isCanceled", l.price
+    FROM "Lesson" l
+    LEFT JOIN "Subject" s ON l."subjectId" = s.id
+    LEFT JOIN "Group" sg ON l."groupId" = sg.id
+    LEFT JOIN "Student" st ON l."studentId" = st.id
+    WHERE l."ownerId" = $1 AND l.date >= $2 AND l.date < $3
+    ORDER BY l.date ASC
+''')
+
+async def get_lessons_by_date(pool, user_id, date, user_tz="Europe/Moscow"):
+    # `date` is a local calendar date (or a datetime in the user's timezone)
+    start_utc, end_utc = localtime.day_window(user_tz, localtime.local_date(date, user_tz))
     async with pool.acquire() as conn:
-        return await conn.fetch('''
-            SELECT l.id, l.date, s.name as "subjectName", sg.name as "groupName", st.name as "studentName", 
-                   l."groupId", l."studentId", l."isPaid", l."isCanceled", l.price
-            FROM "Lesson" l
-            LEFT JOIN "Subject" s ON l."subjectId" = s.id
-            LEFT JOIN "Group" sg ON l."groupId" = sg.id
-            LEFT JOIN "Student" st ON l."studentId" = st.id
-            WHERE l."ownerId" = $1 AND l.date >= $2 AND l.date < $3
-            ORDER BY l.date ASC
-        ''', user_id, start_utc, end_utc)
-
-async def get_student_lessons_by_date(pool, user_id, date: datetime, user_tz="Europe/Moscow"):
-    student_ids = await get_student_ids(pool, user_id)
-    if not student_ids: return []
-    
-    tz = pytz.timezone(user_tz)
-    if date.tzinfo is None: date = tz.localize(date)
-    start = date.replace(hour=0, minute=0, second=0, microsecond=0)
-    end = start + timedelta(days=1)
-    
-    start_utc = start.astimezone(pytz.utc).replace(tzinfo=None)
-    end_utc = end.astimezone(pytz.utc).replace(tzinfo=None)
-    
+        return await Q_LESSONS_BY_DATE.fetch(conn, user_id, start_utc, end_utc)
+
+Q_STUDENT_LESSONS_BY_DATE = query('student_lessons_by_date', '''
+    SELECT l.id, l.date, s.name as "subjectName", sg.name as "groupName", u.name as "teacherName",
+           l."groupId", l."studentId", l."isPaid", l."isCanceled", l.price
+    FROM "Lesson" l
+    LEFT JOIN "Subject" s ON l."subjectId" = s.id
+    LEFT JOIN "Group" sg ON l."groupId" = sg.id
+    LEFT JOIN "User" u ON l."ownerId" = u.id
+    WHERE (l."studentId" = ANY($1) OR l."groupId" = ANY($2))
+    AND l.date >= $3 AND l.date < $4
+    ORDER BY l.date ASC
+''')
+
+async def get_student_lessons_by_date(pool, user_id, date, user_tz="Europe/Moscow"):
+    scope = await get_student_scope(pool, user_id)
+    if not scope.studentIds: return []
+
+    start_utc, end_utc = localtime.day_window(user_tz, localtime.local_date(date, user_tz))
     async with pool.acquire() as conn:
-        return await conn.fetch('''
-            SELECT l.id, l.date, s.name as "subjectName", sg.name as "groupName", u.name as "teacherName", 
-                   l."groupId", l."studentId", l."isPaid", l."isCanceled", l.price
-            FROM "Lesson" l
-            LEFT JOIN "Subject" s ON l."subjectId" = s.id
-            LEFT JOIN "Group" sg ON l."groupId" = sg.id
-            LEFT JOIN "User" u ON l."ownerId" = u.id
-            WHERE (
-                l."studentId" = ANY($1)
-                OR l."groupId" IN (SELECT "A" FROM "_GroupToStudent" WHERE "B" = ANY($1))
-            )
-            AND l.date >= $2 AND l.date < $3
-            ORDER BY l.date ASC
-        ''', student_ids, start_utc, end_utc)
+        return await Q_STUDENT_LESSONS_BY_DATE.fetch(conn, scope.studentIds, scope.groupIds, start_utc, end_utc)
+
+Q_LESSON_BY_ID = query('lesson_by_id', f'''
+    SELECT {LessonRow.select_list('l')}, s.name as "subjectName", st.name as "studentName", sg.name as "groupName", u.name as "teacherName"
+    FROM "Lesson" l
+    LEFT JOIN "Subject" s ON l."subjectId" = s.id
+    LEFT JOIN "Student" st ON l."studentId" = st.id
+    LEFT JOIN "Group" sg ON l."groupId" = sg.id
+    LEFT JOIN "User" u ON l."ownerId" = u.id
+    WHERE l.id = $1
+''', LessonRow)
 
 async def get_lesson_by_id(pool, lesson_id):
     async with pool.acquire() as conn:
-        return await conn.fetchrow('''
-            SELECT l.*, s.name as "subjectName", st.name as "studentName", sg.name as "groupName", u.name as "teacherName"
-            FROM "Lesson" l
-            LEFT JOIN "Subject" s ON l."subjectId" = s.id
-            LEFT JOIN "Student" st ON l."studentId" = st.id
-            LEFT JOIN "Group" sg ON l."groupId" = sg.id
-            LEFT JOIN "User" u ON l."ownerId" = u.id
-            WHERE l.id = $1
-        ''', lesson_id)
+        return await Q_LESSON_BY_ID.fetchrow(conn, lesson_id)
+
+Q_GROUP_LESSON_PAYMENTS = query('group_lesson_payments', '''
+    SELECT lp."studentId", st.name as "studentName", lp."hasPaid"
+    FROM "LessonPayment" lp
+    JOIN "Student" st ON lp."studentId" = st.id
+    WHERE lp."lessonId" = $1
+    ORDER BY st.name ASC
+''')
 
 async def get_group_lesson_payments(pool, lesson_id):
     async with pool.acquire() as conn:
-        return await conn.fetch('''
-            SELECT lp."studentId", st.name as "studentName", lp."hasPaid"
-            FROM "LessonPayment" lp
-            JOIN "Student" st ON lp."studentId" = st.id
-            WHERE lp."lessonId" = $1
-            ORDER BY st.name ASC
-        ''', lesson_id)
+        return await Q_GROUP_LESSON_PAYMENTS.fetch(conn, lesson_id)
+
+# Lesson flag + the student's own LessonPayment (individual lessons) together
+Q_SET_LESSON_PAID = query('set_lesson_paid', f'''
+    WITH lesson AS (
+        UPDATE "Lesson" SET "isPaid" = $1 WHERE id = $2
+        RETURNING id, "studentId"
+    ), payment AS (
+        UPDATE "LessonPayment" lp SET "hasPaid" = $1
+        FROM lesson WHERE lp."lessonId" = lesson.id AND lp."studentId" = lesson."studentId"
+    )
+    SELECT {_lesson_audience('$2')} AS audience
+''')
 
 async def toggle_lesson_paid(pool, lesson_id, status: bool):
     async with pool.acquire() as conn:
-        # Update lesson status
-        await conn.execute('UPDATE "Lesson" SET "isPaid" = $1 WHERE id = $2', status, lesson_id)
-        # Also update LessonPayment if it's an individual lesson
-        await conn.execute('''
-            UPDATE "LessonPayment" 
-            SET "hasPaid" = $1 
-            WHERE "lessonId" = $2 AND "studentId" = (SELECT "studentId" FROM "Lesson" WHERE id = $2)
-        ''', status, lesson_id)
+        audience = await Q_SET_LESSON_PAID.fetchval(conn, status, lesson_id)
+    invalidate_stats(*audience)
+
+Q_SET_STUDENT_PAYMENT = query('set_student_payment', f'''
+    WITH payment AS (
+        UPDATE "LessonPayment" SET "hasPaid" = $1 WHERE "lessonId" = $2 AND "studentId" = $3
+    )
+    SELECT {_lesson_audience('$2')} AS audience
+''')
 
 async def toggle_student_payment(pool, lesson_id, student_id, status: bool):
     async with pool.acquire() as conn:
-        await conn.execute('UPDATE "LessonPayment" SET "hasPaid" = $1 WHERE "lessonId" = $2 AND "studentId" = $3', status, lesson_id, student_id)
+        audience = await Q_SET_STUDENT_PAYMENT.fetchval(conn, status, lesson_id, student_id)
+    invalidate_stats(*audience)
+
+Q_SET_LESSON_CANCELED = query('set_lesson_canceled', f'''
+    WITH lesson AS (
+        UPDATE "Lesson" SET "isCanceled" = $1, "updatedAt" = NOW() AT TIME ZONE 'UTC' WHERE id = $2
+    )
+    SELECT {_lesson_audience('$2')} AS audience
+''')
 
 async def toggle_lesson_cancel(pool, lesson_id, status: bool):
     async with pool.acquire() as conn:
-        await conn.execute('UPDATE "Lesson" SET "isCanceled" = $1 WHERE id = $2', status, lesson_id)
+        audience = await Q_SET_LESSON_CANCELED.fetchval(conn, status, lesson_id)
+    invalidate_stats(*audience)
+
+# --- Bulk payments ---
+# Settle every past unpaid lesson of a student: individual lessons (plus their own
+# LessonPayment) and the student's share of group lessons. Group lessons whose
+# last unpaid share this was are marked paid too, as the web app does.
+Q_SETTLE_STUDENT_DEBTS = query('settle_student_debts', '''
+    WITH lessons AS (
+        UPDATE "Lesson" l SET "isPaid" = true
+        WHERE l."studentId" = $1 AND l."ownerId" = $2
+          AND l."isPaid" = false AND l."isCanceled" = false AND l.date < $3
+        RETURNING l.id, l.price
+    ), own_payments AS (
+        UPDATE "LessonPayment" lp SET "hasPaid" = true
+        FROM lessons WHERE lp."lessonId" = lessons.id AND lp."studentId" = $1
+    ), group_payments AS (
+        UPDATE "LessonPayment" lp SET "hasPaid" = true
+        FROM "Lesson" l
+        WHERE lp."lessonId" = l.id AND lp."studentId" = $1 AND lp."hasPaid" = false
+          AND l."ownerId" = $2 AND l."groupId" IS NOT NULL
+          AND l."studentId" IS DISTINCT FROM $1
+          AND l."isCanceled" = false AND l.date < $3
+        RETURNING l.id, l.price
+    ), group_lessons AS (
+        UPDATE "Lesson" l SET "isPaid" = true
+        FROM group_payments gp
+        WHERE l.id = gp.id
+          AND NOT EXISTS (
+              SELECT 1 FROM "LessonPayment" o
+              WHERE o."lessonId" = l.id AND o."hasPaid" = false AND o."studentId" <> $1
+          )
+    )
+    SELECT
+        (SELECT COUNT(*) FROM lessons) + (SELECT COUNT(*) FROM group_payments) AS count,
+        (SELECT COALESCE(SUM(price), 0) FROM lessons)::bigint
+            + (SELECT COALESCE(SUM(price), 0) FROM group_payments)::bigint AS amount,
+        ARRAY(
+            SELECT "ownerId" FROM "Student" WHERE id = $1
+            UNION
+            SELECT "linkedUserId" FROM "Student" WHERE id = $1 AND "linkedUserId" IS NOT NULL
+        ) AS audience
+''')
+
+async def settle_student_debts(pool, student_id, owner_id):
+    async with pool.acquire() as conn:
+        row = await Q_SETTLE_STUDENT_DEBTS.fetchrow(conn, student_id, owner_id, localtime.utc_now())
+    invalidate_stats(*row['audience'])
+    return {"count": row['count'], "amount": row['amount']}
+
+Q_SETTLE_GROUP_LESSON = query('settle_group_lesson', f'''
+    WITH payments AS (
+        UPDATE "LessonPayment" lp SET "hasPaid" = true
+        FROM "Lesson" l
+        WHERE lp."lessonId" = $1 AND l.id = lp."lessonId" AND l."ownerId" = $2
+          AND lp."hasPaid" = false
+        RETURNING l.price
+    ), lesson AS (
+        UPDATE "Lesson" SET "isPaid" = true
+        WHERE id = $1 AND "ownerId" = $2 AND "groupId" IS NOT NULL
+    )
+    SELECT
+        (SELECT COUNT(*) FROM payments) AS count,
+        (SELECT COALESCE(SUM(price), 0) FROM payments)::bigint AS amount,
+        {_lesson_audience('$1')} AS audience
+''')
+
+async def settle_group_lesson(pool, lesson_id, owner_id):
+    async with pool.acquire() as conn:
+        row = await Q_SETTLE_GROUP_LESSON.fetchrow(conn, lesson_id, owner_id)
+    invalidate_stats(*row['audience'])
+    return {"count": row['count'], "amount": row['amount']}
 
 # --- Students ---
+Q_STUDENTS_BY_OWNER = query('students_by_owner', f'''
+    SELECT {StudentRow.select_list('st')} FROM "Student" st WHERE st."ownerId" = $1 ORDER BY st.name ASC
+''', StudentRow)
+
 async def get_all_students(pool, user_id):
     async with pool.acquire() as conn:
-        return await conn.fetch('SELECT * FROM "Student" WHERE "ownerId" = $1 ORDER BY name ASC', user_id)
+        return await Q_STUDENTS_BY_OWNER.fetch(conn, user_id)
+
+def _page(rows, limit, cursor, direction):
+    # Keyset pages are fetched with limit + 1 rows to detect whether more exist;
+    # "prev" pages are read in reverse order and flipped back here.
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if cursor is None:
+        return rows, False, has_more
+    if direction == 'prev':
+        rows.reverse()
+        return rows, has_more, True
+    return rows, True, has_more
+
+def _students_page_sql(op=None):
+    cursor = f'AND (name, id) {op} (SELECT name, id FROM "Student" WHERE id = $3)' if op else ''
+    order = 'DESC' if op == '<' else 'ASC'
+    return f'''
+    SELECT id, name FROM "Student"
+    WHERE "ownerId" = $1 {cursor}
+    ORDER BY name {order}, id {order}
+    LIMIT $2
+'''
+
+Q_STUDENTS_PAGE = query('students_page', _students_page_sql())
+Q_STUDENTS_PAGE_AFTER = query('students_page_after', _students_page_sql('>'))
+Q_STUDENTS_PAGE_BEFORE = query('students_page_before', _students_page_sql('<'))
+
+async def get_students_page(pool, user_id, cursor=None, direction='next', limit=15):
+    """One page of (id, name) ordered by name; `cursor` is the id of the first
+    (direction='prev') or last (direction='next') student of the current page.
+    Returns (rows, has_prev, has_next)."""
+    async with pool.acquire() as conn:
+        if cursor is None:
+            rows = await Q_STUDENTS_PAGE.fetch(conn, user_id, limit + 1)
+        elif direction == 'prev':
+            rows = await Q_STUDENTS_PAGE_BEFORE.fetch(conn, user_id, limit + 1, cursor)
+        else:
+            rows = await Q_STUDENTS_PAGE_AFTER.fetch(conn, user_id, limit + 1, cursor)
+    return _page(rows, limit, cursor, direction)
+
+Q_STUDENT_CARD = query('student_card', '''
+    SELECT st.*,
+           ARRAY(
+               SELECT s.name FROM "Subject" s
+               INNER JOIN "_StudentToSubject" sts ON sts."B" = s.id
+               WHERE sts."A" = st.id
+           ) AS "_subjects",
+           ARRAY(
+               SELECT g.name FROM "Group" g
+               INNER JOIN "_GroupToStudent" gts ON gts."A" = g.id
+               WHERE gts."B" = st.id
+           ) AS "_groups",
+           stats.total AS "_total", stats.unpaid AS "_unpaid", stats.debt AS "_debt"
+    FROM "Student" st
+    CROSS JOIN LATERAL (
+        SELECT COUNT(*) AS total,
+               COUNT(*) FILTER (WHERE t.unpaid) AS unpaid,
+               SUM(t.price) FILTER (WHERE t.unpaid) AS debt
+        FROM (
+            SELECT l.price, (l."isPaid" = false AND l."isCanceled" = false AND l.date < NOW()) AS unpaid
+            FROM "Lesson" l
+            WHERE l."studentId" = st.id
+            UNION ALL
+            SELECT l.price, (lp."hasPaid" = false AND l."isCanceled" = false AND l.date < NOW())
+            FROM "LessonPayment" lp
+            JOIN "Lesson" l ON lp."lessonId" = l.id
+            WHERE lp."studentId" = st.id
+        ) as t
+    ) stats
+    WHERE st.id = $1
+''')
 
 async def get_student_details(pool, student_id):
     async with pool.acquire() as conn:
-        student = await conn.fetchrow('SELECT * FROM "Student" WHERE id = $1', student_id)
-        if not student: return None
-        
-        # Get subjects
-        subjects = await conn.fetch('''
-            SELECT s.name FROM "Subject" s
-            INNER JOIN "_StudentToSubject" sts ON sts."B" = s.id
-            WHERE sts."A" = $1
-        ''', student_id)
-        
-        # Get groups
-        groups = await conn.fetch('''
-            SELECT g.name FROM "Group" g
-            INNER JOIN "_GroupToStudent" gts ON gts."A" = g.id
-            WHERE gts."B" = $1
-        ''', student_id)
-        
-        # Stats
-        total_lessons = await conn.fetchval('''
-            SELECT COUNT(*) FROM (
-                SELECT id FROM "Lesson" WHERE "studentId" = $1
-                UNION ALL
-                SELECT "lessonId" FROM "LessonPayment" WHERE "studentId" = $1
-            ) as t
-        ''', student_id)
-        
-        unpaid_count = await conn.fetchval('''
-            SELECT COUNT(*) FROM (
-                SELECT l.id FROM "Lesson" l 
-                WHERE l."studentId" = $1 AND l."isPaid" = false AND l."isCanceled" = false AND l.date < NOW()
-                UNION ALL
-                SELECT lp."lessonId" FROM "LessonPayment" lp
-                JOIN "Lesson" l ON lp."lessonId" = l.id
-                WHERE lp."studentId" = $1 AND lp."hasPaid" = false AND l."isCanceled" = false AND l.date < NOW()
-            ) as t
-        ''', student_id)
-        
-        debt_amount = await conn.fetchval('''
-            SELECT SUM(price) FROM (
-                SELECT l.price FROM "Lesson" l
-                WHERE l."studentId" = $1 AND l."isPaid" = false AND l."isCanceled" = false AND l.date < NOW()
-                UNION ALL
-                SELECT l.price FROM "LessonPayment" lp
-                JOIN "Lesson" l ON lp."lessonId" = l.id
-                WHERE lp."studentId" = $1 AND lp."hasPaid" = false AND l."isCanceled" = false AND l.date < NOW()
-            ) as t
-        ''', student_id)
-        
-        return {
-            "info": dict(student),
-            "subjects": [s['name'] for s in subjects],
-            "groups": [g['name'] for g in groups],
-            "stats": {
-                "total": total_lessons or 0,
-                "unpaid": unpaid_count or 0,
-                "debt": debt_amount or 0
-            }
+        # Whole card in one statement: names are aggregated, and the lesson stats
+        # come from a single pass over individual lessons + group payments.
+        row = await Q_STUDENT_CARD.fetchrow(conn, student_id)
+    if not row: return None
+
+    info = {k: v for k, v in row.items() if not k.startswith('_')}
+    return {
+        "info": info,
+        "subjects": list(row['_subjects']),
+        "groups": list(row['_groups']),
+        "stats": {
+            "total": row['_total'] or 0,
+            "unpaid": row['_unpaid'] or 0,
+            "debt": row['_debt'] or 0
         }
+    }
 
 # --- Finance ---
-async def get_unpaid_lessons(pool, user_id, limit=20):
-    async with pool.acquire() as conn:
-        return await conn.fetch('''
-            SELECT * FROM (
-                -- Individual lessons
-                SELECT l.id, l.date, s.name as "subjectName", st.name as "studentName", 
-                       NULL as "groupName", l."groupId", l.price, l."studentId"
-                FROM "Lesson" l
-                LEFT JOIN "Subject" s ON l."subjectId" = s.id
-                LEFT JOIN "Student" st ON l."studentId" = st.id
-                WHERE l."ownerId" = $1 
-                  AND l."isPaid" = false 
-                  AND l."isCanceled" = false 
-                  AND l."studentId" IS NOT NULL
-                  AND l."groupId" IS NULL
-                  AND l.date < NOW()
-
-                UNION ALL
-
-                -- Group lesson payments
-                SELECT l.id, l.date, s.name as "subjectName", st.name as "studentName", 
-                       sg.name as "groupName", l."groupId", l.price, lp."studentId"
-                FROM "LessonPayment" lp
-                JOIN "Lesson" l ON lp."lessonId" = l.id
-                JOIN "Student" st ON lp."studentId" = st.id
-                LEFT JOIN "Subject" s ON l."subjectId" = s.id
-                LEFT JOIN "Group" sg ON l."groupId" = sg.id
-                WHERE l."ownerId" = $1
-                  AND lp."hasPaid" = false
-                  AND l."isCanceled" = false
-                  AND l."groupId" IS NOT NULL
-                  AND l.date < NOW()
-            ) as unpaid
-            ORDER BY date DESC
+def _unpaid_page_sql(op=None):
+    # Newest first, keyed on (date, lesson id, student id); a group lesson appears
+    # once per unpaid student. The cursor is applied inside both branches so each
+    # one walks the ("ownerId", date) index and stops after one page.
+    cursor = (
+        f'AND (l.date, l.id, {{student}}) {op} ((SELECT date FROM "Lesson" WHERE id = $3), $3, $4)'
+        if op else ''
+    )
+    order = 'ASC' if op == '>' else 'DESC'
+    individual = cursor.format(student='l."studentId"')
+    group = cursor.format(student='lp."studentId"')
+    return f'''
+    SELECT * FROM (
+        (
+            -- Individual lessons
+            SELECT l.id, l.date, st.name as "studentName", NULL as "groupName", l.price, l."studentId"
+            FROM "Lesson" l
+            LEFT JOIN "Student" st ON l."studentId" = st.id
+            WHERE l."ownerId" = $1
+              AND l."isPaid" = false
+              AND l."isCanceled" = false
+              AND l."studentId" IS NOT NULL
+              AND l."groupId" IS NULL
+              AND l.date < NOW()
+              {individual}
+            ORDER BY l.date {order}, l.id {order}, l."studentId" {order}
+            LIMIT $2
+        )
+
+        UNION ALL
+
+        (
+            -- Group lesson payments
+            SELECT l.id, l.date, st.name as "studentName", sg.name as "groupName", l.price, lp."studentId"
+            FROM "LessonPayment" lp
+            JOIN "Lesson" l ON lp."lessonId" = l.id
+            JOIN "Student" st ON lp."studentId" = st.id
+            LEFT JOIN "Group" sg ON l."groupId" = sg.id
+            WHERE l."ownerId" = $1
+              AND lp."hasPaid" = false
+              AND l."isCanceled" = false
+              AND l."groupId" IS NOT NULL
+              AND l.date < NOW()
+              {group}
+            ORDER BY l.date {order}, l.id {order}, lp."studentId" {order}
             LIMIT $2
-        ''', user_id, limit)
+        )
+    ) as unpaid
+    ORDER BY date {order}, id {order}, "studentId" {order}
+    LIMIT $2
+'''
+
+Q_UNPAID_PAGE = query('unpaid_page', _unpaid_page_sql())
+Q_UNPAID_PAGE_OLDER = query('unpaid_page_older', _unpaid_page_sql('<'))
+Q_UNPAID_PAGE_NEWER = query('unpaid_page_newer', _unpaid_page_sql('>'))
+
+async def get_unpaid_lessons_page(pool, user_id, cursor=None, direction='next', limit=15):
+    """One page of unpaid lessons, newest first. `cursor` is the (lesson id,
+    student id) of the first (direction='prev') or last (direction='next') row
+    of the current page. Returns (rows, has_prev, has_next)."""
+    async with pool.acquire() as conn:
+        if cursor is None:
+            rows = await Q_UNPAID_PAGE.fetch(conn, user_id, limit + 1)
+        elif direction == 'prev':
+            rows = await Q_UNPAID_PAGE_NEWER.fetch(conn, user_id, limit + 1, *cursor)
+        else:
+            rows = await Q_UNPAID_PAGE_OLDER.fetch(conn, user_id, limit + 1, *cursor)
+    return _page(rows, limit, cursor, direction)
+
+async def get_unpaid_lessons(pool, user_id, limit=20):
+    rows, _, _ = await get_unpaid_lessons_page(pool, user_id, limit=limit)
+    return rows
 
 # --- Lesson Requests ---
+Q_LESSON_REQUEST = query('lesson_request', f'''
+    SELECT {LessonRequestRow.select_list('lr')}, l.date as "lessonDate", s.name as "subjectName",
+           st.name as "studentName", sg.name as "groupName", u.name as "requesterName"
+    FROM "LessonRequest" lr
+    JOIN "Lesson" l ON lr."lessonId" = l.id
+    LEFT JOIN "Subject" s ON l."subjectId" = s.id
+    LEFT JOIN "Student" st ON l."studentId" = st.id
+    LEFT JOIN "Group" sg ON l."groupId" = sg.id
+    LEFT JOIN "User" u ON lr."userId" = u.id
+    WHERE lr.id = $1
+''', LessonRequestRow)
+
 async def get_lesson_request(pool, request_id):
     async with pool.acquire() as conn:
-        return await conn.fetchrow('''
-            SELECT lr.*, l.date as "lessonDate", s.name as "subjectName", 
-                   st.name as "studentName", sg.name as "groupName", u.name as "requesterName"
-            FROM "LessonRequest" lr
-            JOIN "Lesson" l ON lr."lessonId" = l.id
-            LEFT JOIN "Subject" s ON l."subjectId" = s.id
-            LEFT JOIN "Student" st ON l."studentId" = st.id
-            LEFT JOIN "Group" sg ON l."groupId" = sg.id
-            LEFT JOIN "User" u ON lr."userId" = u.id
-            WHERE lr.id = $1
-        ''', request_id)
+        return await Q_LESSON_REQUEST.fetchrow(conn, request_id)
+
+# Requests are resolved only while still pending, so a double tap (or two
+# teachers' devices) can't approve or reject the same request twice.
+Q_APPROVE_REQUEST = query('approve_request', f'''
+    WITH req AS (
+        UPDATE "LessonRequest" SET status = 'approved'
+        WHERE id = $1 AND status = 'pending'
+        RETURNING *
+    ), lesson AS (
+        UPDATE "Lesson" l SET
+            "isCanceled" = CASE WHEN req.type = 'cancel' THEN true ELSE l."isCanceled" END,
+            date = CASE WHEN req.type = 'cancel' THEN l.date ELSE req."newDate" END,
+            status = CASE WHEN req.type = 'cancel' THEN 'canceled' ELSE 'confirmed' END,
+            "updatedAt" = NOW() AT TIME ZONE 'UTC'
+        FROM req
+        WHERE l.id = req."lessonId"
+          AND (req.type = 'cancel' OR (req.type = 'reschedule' AND req."newDate" IS NOT NULL))
+    )
+    SELECT req.*, {_lesson_audience('req."lessonId"')} AS "_audience"
+    FROM req
+''')
 
 async def approve_lesson_request(pool, request_id):
     async with pool.acquire() as conn:
-        lr = await conn.fetchrow('SELECT * FROM "LessonRequest" WHERE id = $1', request_id)
-        if not lr: return None
-        
-        await conn.execute('UPDATE "LessonRequest" SET status = $1 WHERE id = $2', 'approved', request_id)
-        
-        if lr['type'] == 'cancel':
-            await conn.execute('UPDATE "Lesson" SET "isCanceled" = true, status = $1 WHERE id = $2', 'canceled', lr['lessonId'])
-        elif lr['type'] == 'reschedule' and lr['newDate']:
-            await conn.execute('UPDATE "Lesson" SET date = $1, status = $2 WHERE id = $3', lr['newDate'], 'confirmed', lr['lessonId'])
-        
-        return lr
+        row = await Q_APPROVE_REQUEST.fetchrow(conn, request_id)
+    if not row: return None
+    invalidate_stats(*row['_audience'])
+    return {k: v for k, v in row.items() if k != '_audience'}
+
+Q_REJECT_REQUEST = query('reject_request', '''
+    WITH req AS (
+        UPDATE "LessonRequest" SET status = 'rejected'
+        WHERE id = $1 AND status = 'pending'
+        RETURNING *
+    ), lesson AS (
+        UPDATE "Lesson" l SET status = 'confirmed'
+        FROM req WHERE l.id = req."lessonId"
+    )
+    SELECT * FROM req
+''')
 
 async def reject_lesson_request(pool, request_id):
     async with pool.acquire() as conn:
-        lr = await conn.fetchrow('SELECT * FROM "LessonRequest" WHERE id = $1', request_id)
-        if not lr: return None
-        
-        await conn.execute('UPDATE "LessonRequest" SET status = $1 WHERE id = $2', 'rejected', request_id)
-        await conn.execute('UPDATE "Lesson" SET status = $1 WHERE id = $2', 'confirmed', lr['lessonId'])
-        
-        return lr
+        return await Q_REJECT_REQUEST.fetchrow(conn, request_id)
+
+Q_CREATE_LESSON_REQUEST = query('create_lesson_request', '''
+    WITH req AS (
+        INSERT INTO "LessonRequest" (id, "lessonId", "userId", type, "newDate", reason, status, "createdAt", "updatedAt")
+        VALUES ($1, $2, $3, $4, $5, $6, 'pending', NOW(), NOW())
+    )
+    UPDATE "Lesson" SET status = $7 WHERE id = $2
+''')
 
 async def create_lesson_request(pool, lesson_id, user_id, request_type, new_date=None, reason=None):
     import uuid
+    request_id = str(uuid.uuid4())
+    new_status = 'pending_cancel' if request_type == 'cancel' else 'pending_reschedule'
+    async with pool.acquire() as conn:
+        await Q_CREATE_LESSON_REQUEST.execute(conn, request_id, lesson_id, user_id, request_type, new_date, reason, new_status)
+    return request_id
+
+# --- Reminders ---
+# Read by reminders.ReminderScheduler. "updatedAt" is maintained by Prisma on
+# every write from the web app (and set explicitly by the bot's own lesson
+# updates above), so polling it picks up new, moved and canceled lessons.
+Q_LESSONS_IN_WINDOW = query('lessons_in_window', '''
+    SELECT id, date, "isCanceled", "updatedAt" FROM "Lesson"
+    WHERE date > $1 AND date <= $2 AND "isCanceled" = false
+''')
+Q_LESSONS_CHANGED_SINCE = query('lessons_changed_since', '''
+    SELECT id, date, "isCanceled", "updatedAt" FROM "Lesson"
+    WHERE "updatedAt" > $1
+    ORDER BY "updatedAt" ASC
+    LIMIT $2
+''')
+
+async def get_lessons_in_window(pool, after, until):
+    async with pool.acquire() as conn:
+        return await Q_LESSONS_IN_WINDOW.fetch(conn, after, until)
+
+async def get_lessons_changed_since(pool, since, limit=1000):
+    async with pool.acquire() as conn:
+        return await Q_LESSONS_CHANGED_SINCE.fetch(conn, since, limit)
+
+# Everyone who should get a reminder for the lesson: the owner and linked
+# students, with reminders enabled and no reminder recorded yet (the web
+# app's cron records the same notifications). Nothing is returned if the
+# lesson was canceled, deleted or moved away from $2 since it was scheduled.
+Q_REMINDER_RECIPIENTS = query('reminder_recipients', '''
+    WITH lesson AS (
+        SELECT l.id, l.date, l.duration, l."ownerId", l."studentId", l."groupId",
+               COALESCE(s.name, l."subjectName") AS "subjectName", st.name AS "studentName",
+               COALESCE(sg.name, l."groupName") AS "groupName",
+               COALESCE(u."firstName", u.name) AS "teacherName"
+        FROM "Lesson" l
+        JOIN "User" u ON u.id = l."ownerId"
+        LEFT JOIN "Subject" s ON s.id = l."subjectId"
+        LEFT JOIN "Student" st ON st.id = l."studentId"
+        LEFT JOIN "Group" sg ON sg.id = l."groupId"
+        WHERE l.id = $1 AND l.date = $2 AND l."isCanceled" = false
+    ), audience AS (
+        SELECT "ownerId" AS "userId" FROM lesson
+        UNION
+        SELECT st."linkedUserId" FROM lesson
+        JOIN "Student" st ON st.id = lesson."studentId"
+        WHERE st."linkedUserId" IS NOT NULL
+        UNION
+        SELECT st."linkedUserId" FROM lesson
+        JOIN "_GroupToStudent" gs ON gs."A" = lesson."groupId"
+        JOIN "Student" st ON st.id = gs."B"
+        WHERE st."linkedUserId" IS NOT NULL
+    )
+    SELECT u.id AS "userId", u.role, u.timezone, u."telegramChatId",
+           COALESCE(ns."deliveryWeb", true) AS "deliveryWeb",
+           COALESCE(ns."quietHoursEnabled", false) AS "quietHoursEnabled",
+           ns."quietHoursStart", ns."quietHoursEnd",
+           lesson.date, lesson.duration, lesson."studentId", lesson."subjectName",
+           lesson."studentName", lesson."groupName", lesson."teacherName"
+    FROM audience a
+    JOIN "User" u ON u.id = a."userId"
+    CROSS JOIN lesson
+    LEFT JOIN "NotificationSettings" ns ON ns."userId" = u.id
+    WHERE COALESCE(ns."lessonReminders", true)
+      AND NOT EXISTS (
+          SELECT 1 FROM "Notification" n
+          WHERE n."userId" = u.id AND n.type = 'lesson_reminder' AND n.data LIKE '%' || $3 || '%'
+      )
+''')
+# Records the reminders and returns the users whose row was inserted here.
+# The unique ("userId", "dedupeKey") key makes a concurrent sender (another
+# replica, or the cron) wait for this insert and then skip the row, so each
+# reminder is recorded, and sent, once. The LIKE check covers reminders
+# recorded before "dedupeKey" existed.
+Q_RECORD_REMINDERS = query('record_reminders', '''
+    INSERT INTO "Notification" (id, "userId", title, message, type, data, link, "isRead", "createdAt", "dedupeKey")
+    SELECT r.id, r."userId", 'Скоро занятие', r.message, 'lesson_reminder', $5, r.link, r."isRead",
+           NOW() AT TIME ZONE 'UTC', $6
+    FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $7::bool[]) AS r(id, "userId", message, link, "isRead")
+    WHERE NOT EXISTS (
+        SELECT 1 FROM "Notification" n
+        WHERE n."userId" = r."userId" AND n.type = 'lesson_reminder' AND n.data LIKE '%' || $6 || '%'
+    )
+    ON CONFLICT ("userId", "dedupeKey") DO NOTHING
+    RETURNING "userId"
+''')
+
+async def get_reminder_recipients(pool, lesson_id, date, key):
+    async with pool.acquire() as conn:
+        return await Q_REMINDER_RECIPIENTS.fetch(conn, lesson_id, date, key)
+
+async def record_reminders(pool, lesson_id, key, notifications):
+    """`notifications`: (user_id, message, link, is_read) tuples. Returns the
+    ids of users a reminder was recorded for."""
+    data = json.dumps({"key": key, "lessonId": lesson_id}, separators=(',', ':'))
+    ids = [str(uuid.uuid4()) for _ in notifications]
+    user_ids, messages, links, is_read = (list(col) for col in zip(*notifications))
     async with pool.acquire() as conn:
-        request_id = str(uuid.uuid4())
-        await conn.execute('''
-            INSERT INTO "LessonRequest" (id, "lessonId", "userId", type, "newDate", reason, status, "createdAt", "updatedAt")
-            VALUES ($1, $2, $3, $4, $5, $6, 'pending', NOW(), NOW())
-        ''', request_id, lesson_id, user_id, request_type, new_date, reason)
-        
-        new_status = 'pending_cancel' if request_type == 'cancel' else 'pending_reschedule'
-        await conn.execute('UPDATE "Lesson" SET status = $1 WHERE id = $2', new_status, lesson_id)
-        
-        return request_id
+        rows = await Q_RECORD_REMINDERS.fetch(conn, ids, user_ids, messages, links, data, key, is_read)
+    return {row['userId'] for row in rows}
+
+# --- Change notifications ---
+# Applied by invalidation.ChangeListener for changes published by the triggers
+# in sql/change_notifications.sql, whichever side made them.
+def flush_caches():
+    USER_CACHE.clear()
+    STATS_CACHE.clear()
+    SCOPE_CACHE.clear()
+
+# Users whose figures depend on the given users/students/groups/lessons
+Q_CHANGE_AUDIENCE = query('change_audience', '''
+    SELECT ARRAY(
+        SELECT unnest($1::text[])
+        UNION
+        SELECT "ownerId" FROM "Lesson" WHERE id = ANY($4)
+        UNION
+        SELECT "linkedUserId" FROM "Student"
+        WHERE "linkedUserId" IS NOT NULL AND id = ANY($2)
+        UNION
+        SELECT st."linkedUserId" FROM "_GroupToStudent" gs
+        JOIN "Student" st ON st.id = gs."B"
+        WHERE st."linkedUserId" IS NOT NULL AND gs."A" = ANY($3)
+    )
+''')
+
+async def apply_change(pool, change):
+    """Drop cache entries made stale by one row change; returns the User ids
+    whose stats were invalidated."""
+    table = change.get('t')
+    rows = [row for row in (change.get('old'), change.get('new')) if row]
+    if table == 'User':
+        for row in rows:
+            invalidate_user(telegram_id=row.get('telegramId'), user_id=row['id'])
+        user_ids = {row['id'] for row in rows}
+    elif table == 'Student':
+        user_ids = {row[k] for row in rows for k in ('ownerId', 'linkedUserId') if row.get(k)}
+        for row in rows:
+            if row.get('linkedUserId'):
+                SCOPE_CACHE.invalidate(row['linkedUserId'])
+    else:
+        if table == 'Lesson':
+            users = [row['ownerId'] for row in rows]
+            students = [row['studentId'] for row in rows if row.get('studentId')]
+            groups = [row['groupId'] for row in rows if row.get('groupId')]
+            lessons = []
+        elif table == 'LessonPayment':
+            users, groups = [], []
+            students = [row['studentId'] for row in rows]
+            lessons = [row['lessonId'] for row in rows]
+        elif table == '_GroupToStudent':
+            users, groups, lessons = [], [], []
+            students = [row['B'] for row in rows]
+        else:
+            return set()
+        async with pool.acquire() as conn:
+            user_ids = set(await Q_CHANGE_AUDIENCE.fetchval(conn, users, students, groups, lessons))
+        if table == '_GroupToStudent':
+            for user_id in user_ids:
+                SCOPE_CACHE.invalidate(user_id)
+    invalidate_stats(*user_ids)
+    return user_ids
@@ -0,0 +1,105 @@
+"""Cache invalidation driven by Postgres LISTEN/NOTIFY.
+
+Triggers from sql/change_notifications.sql publish row changes made by the
+web app (or the bot) on the "bot_cache" channel. ChangeListener holds its own
+asyncpg connection, outside the pool, LISTENs on that channel and hands each
+decoded change to `on_change`. LISTEN needs a session, so DB_LISTEN_URL must
+point at Postgres directly, never at PgBouncer in transaction mode; main.py
+doesn't start the listener without it.
+
+Notifications sent while the listener is disconnected are lost, so on every
+(re)connect `on_reconnect` is called first, which should flush the caches.
+A lost connection is detected by asyncpg's termination callback or by a
+periodic keepalive query, and retried with exponential backoff.
+"""
+import asyncio
+import json
+import logging
+import asyncpg
+
+CHANNEL = "bot_cache"
+
+
+class ChangeListener:
+    def __init__(self, dsn, on_change, on_reconnect, keepalive=30, max_backoff=60):
+        self.dsn = dsn
+        self.on_change = on_change
+        self.on_reconnect = on_reconnect
+        self.keepalive = keepalive
+        self.max_backoff = max_backoff
+        self.received = 0
+        self.errors = 0
+        self.connects = 0
+        self.connected = False
+        self._task = None
+        self._handlers = set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        backoff = 1
+        while True:
+            lost = asyncio.Event()
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(CHANNEL, self._notify)
+                self.connected = True
+                self.connects += 1
+                backoff = 1
+                logging.info("Cache invalidation listener connected")
+                self.on_reconnect()
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        await conn.fetchval("SELECT 1", timeout=10)
+                logging.warning("Cache invalidation listener lost its connection")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Cache invalidation listener error: {e}")
+            finally:
+                self.connected = False
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _notify(self, conn, pid, channel, payload):
+        self.received += 1
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            self.errors += 1
+            return
+        task = asyncio.ensure_future(self.on_change(change))
+        self._handlers.add(task)
+        task.add_done_callback(self._handled)
+
+    def _handled(self, task):
+        self._handlers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+            logging.error(f"Cache invalidation failed: {task.exception()}")
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "received": self.received,
+            "errors": self.errors,
+            "connects": self.connects,
+            "in_flight": len(self._handlers)
+        }
@@ -0,0 +1,119 @@
+"""Keyboard factory.
+
+PTB markups are immutable once built, so one instance can be sent to any
+number of chats. Static menus are built once at import; pickers that depend
+on a lesson or date are kept in bounded LRU caches. The `_build_*` functions
+do the actual construction (benchmarks/keyboards.py compares against them).
+"""
+from datetime import timedelta
+from functools import lru_cache
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+import localtime
+
+PICKER_CACHE_SIZE = 2048
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+TIME_SLOTS = ["09:00", "10:00", "11:00", "12:00", "13:00", "14:00", "15:00", "16:00", "17:00", "18:00", "19:00", "20:00"]
+
+
+def _build_main_reply_keyboard(role):
+    if role == 'student':
+        return ReplyKeyboardMarkup([
+            ["📅 Расписание", "📉 Оплата"],
+            ["⚙️ Настройки", "🏠 Главное меню"],
+            ["📎 Справка"]
+        ], resize_keyboard=True)
+    return ReplyKeyboardMarkup([
+        ["📅 Расписание", "👥 Ученики"],
+        ["💰 Финансы", "📉 Должники"],
+        ["⚙️ Настройки", "🏠 Главное меню"],
+        ["📎 Справка"]
+    ], resize_keyboard=True)
+
+
+def _build_main_menu_keyboard(role):
+    if role == 'student':
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton("📅 Расписание", callback_data='menu_schedule'), InlineKeyboardButton("💰 Оплата", callback_data='menu_finance')],
+            [InlineKeyboardButton("⚙️ Настройки", callback_data='menu_settings')]
+        ])
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📅 Расписание", callback_data='menu_schedule'), InlineKeyboardButton("👥 Ученики", callback_data='menu_students')],
+        [InlineKeyboardButton("💰 Финансы", callback_data='menu_finance'), InlineKeyboardButton("⚙️ Настройки", callback_data='menu_settings')],
+        [InlineKeyboardButton("📉 Должники", callback_data='menu_debtors')]
+    ])
+
+
+def _build_date_picker(lesson_id, action_prefix, today):
+    keyboard = []
+    row = []
+    for i in range(7):
+        day = today + timedelta(days=i)
+        label = f"{WEEKDAYS[day.weekday()]} {day.strftime('%d.%m')}"
+        row.append(InlineKeyboardButton(label, callback_data=f"{action_prefix}_{lesson_id}_d_{day.isoformat()}"))
+        if len(row) == 4:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("🔙 Отмена", callback_data=f"l_{lesson_id}")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _build_time_picker(lesson_id, date_str, action_prefix):
+    """Generate a keyboard with time slots"""
+    keyboard = []
+    row = []
+    for t in TIME_SLOTS:
+        row.append(InlineKeyboardButton(t, callback_data=f"{action_prefix}_{lesson_id}_t_{date_str}_{t}"))
+        if len(row) == 4:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("🔙 Назад к дате", callback_data=f"{action_prefix}_{lesson_id}")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+_REPLY_KEYBOARDS = {role: _build_main_reply_keyboard(role) for role in ('teacher', 'student')}
+_MENU_KEYBOARDS = {role: _build_main_menu_keyboard(role) for role in ('teacher', 'student')}
+SCHEDULE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Сегодня", callback_data='sched_today'), InlineKeyboardButton("Завтра", callback_data='sched_tomorrow')],
+    [InlineKeyboardButton("🔙 Назад", callback_data='menu_main')]
+])
+
+
+def main_reply_keyboard(role='teacher'):
+    return _REPLY_KEYBOARDS['student' if role == 'student' else 'teacher']
+
+
+def main_menu_keyboard(role='teacher'):
+    return _MENU_KEYBOARDS['student' if role == 'student' else 'teacher']
+
+
+@lru_cache(maxsize=64)
+def back_button(data='menu_main'):
+    return InlineKeyboardButton("🔙 Назад", callback_data=data)
+
+
+@lru_cache(maxsize=64)
+def back_markup(data='menu_main'):
+    """A keyboard holding just the back button."""
+    return InlineKeyboardMarkup([[back_button(data)]])
+
+
+_date_picker = lru_cache(maxsize=PICKER_CACHE_SIZE)(_build_date_picker)
+generate_time_picker = lru_cache(maxsize=PICKER_CACHE_SIZE)(_build_time_picker)
+
+
+def generate_date_picker(lesson_id, action_prefix, user_tz="Europe/Moscow"):
+    """Generate a keyboard with next 7 days for date selection"""
+    # Keyed by the user's local date, so the picker moves on at local midnight
+    return _date_picker(lesson_id, action_prefix, localtime.local_today(user_tz))
+
+
+def cache_stats():
+    return {
+        "date_picker": _date_picker.cache_info()._asdict(),
+        "time_picker": generate_time_picker.cache_info()._asdict(),
+        "back_markup": back_markup.cache_info()._asdict()
+    }
@@ -0,0 +1,68 @@
+"""Users' local days and months as naive-UTC windows for Lesson.date queries.
+
+Lesson dates are stored as naive UTC. A local day is [local midnight, next
+local midnight), built with `localize` from the calendar date, so a DST
+switch day is 23 or 25 hours long rather than a fixed 24. Timezone objects
+and windows are cached per (timezone, local date); "today" is recomputed
+on every call, so the windows roll over at each user's local midnight.
+"""
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+import pytz
+
+DEFAULT_TZ = "Europe/Moscow"
+
+
+@lru_cache(maxsize=1024)
+def get_tz(name):
+    try:
+        return pytz.timezone(name or DEFAULT_TZ)
+    except pytz.UnknownTimeZoneError:
+        return pytz.timezone(DEFAULT_TZ)
+
+
+def utc_now():
+    """Current time as naive UTC, comparable with Lesson.date."""
+    return datetime.now(pytz.utc).replace(tzinfo=None)
+
+
+def local_today(tz_name):
+    return datetime.now(get_tz(tz_name)).date()
+
+
+def local_date(value, tz_name):
+    """Calendar date of `value` for the user: aware datetimes are converted,
+    naive ones are taken as local wall time, dates pass through."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(get_tz(tz_name))
+        return value.date()
+    return value
+
+
+def _midnight_utc(tz, day):
+    return tz.localize(datetime.combine(day, time.min)).astimezone(pytz.utc).replace(tzinfo=None)
+
+
+@lru_cache(maxsize=4096)
+def day_window(tz_name, day):
+    """(start, end) of the local calendar day `day` in naive UTC."""
+    tz = get_tz(tz_name)
+    return _midnight_utc(tz, day), _midnight_utc(tz, day + timedelta(days=1))
+
+
+@lru_cache(maxsize=4096)
+def month_start(tz_name, day):
+    """Start of the local month containing `day`, in naive UTC."""
+    return _midnight_utc(get_tz(tz_name), day.replace(day=1))
+
+
+def today_window(tz_name):
+    return day_window(tz_name, local_today(tz_name))
+
+
+def to_local(dt, tz_name):
+    """Convert a naive-UTC (or aware) datetime to the user's timezone."""
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return dt.astimezone(get_tz(tz_name))
@@ -1,17 +1,32 @@
 import logging
 import os
-import asyncio
-from datetime import datetime, timedelta
-import pytz
+import importlib.util
+from datetime import timedelta
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+from update_processor import ChatOrderedUpdateProcessor
+import localtime
+from subscription import SubscriptionCache
+from send_queue import OutboundRateLimiter, PRIORITY_BULK, PRIORITY_NAMES
+from reminders import ReminderScheduler
+from invalidation import ChangeListener
+from state import open_state_store
+from sharding import run_sharded
+from tracing import Tracer, install_log_filter
+from metrics import Exposition, MetricsServer
+from keyboards import (
+    main_reply_keyboard, main_menu_keyboard, back_button, back_markup, SCHEDULE_MENU
+)
 from db import (
-    get_db_pool, get_user_by_telegram_id, link_user_telegram, verify_telegram_code,
-    toggle_lesson_paid, toggle_lesson_cancel, get_all_students, 
+    get_db_pool, get_user_by_telegram_id, get_dashboard_stats, link_user_telegram, verify_telegram_code,
+    toggle_lesson_paid, toggle_lesson_cancel,
     get_student_details, get_unpaid_lessons, get_group_lesson_payments,
     toggle_student_payment, get_student_dashboard_stats, get_student_lessons_by_date,
-    get_lesson_request, approve_lesson_request, reject_lesson_request, create_lesson_request
+    get_lesson_request, approve_lesson_request, reject_lesson_request, create_lesson_request,
+    get_lesson_by_id, get_lessons_by_date, settle_student_debts, settle_group_lesson,
+    get_students_page, get_unpaid_lessons_page, apply_change, flush_caches, get_query_stats,
+    start_slow_query_log, stop_slow_query_log, USER_CACHE, STATS_CACHE, SCOPE_CACHE
 )
 
 # Load environment variables
@@ -19,69 +34,77 @@ load_dotenv()
 
 # Logging setup
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s',
     level=logging.INFO
 )
+install_log_filter()
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 CHANNEL_ID = os.getenv("TELEGRAM_CHANNEL_ID", "@tuterra")
-PENDING_LINK = set()
-# State for reschedule flow: {user_id: {'lesson_id': str, 'date': datetime, 'role': str}}
-PENDING_RESCHEDULE = {}
+# Update delivery: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public URL registered with Telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Worker processes (see sharding.py); 1 = everything in this process
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Updates from different chats run in parallel; 1 = strictly sequential
+CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "16"))
+API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+API_BASE_FILE_URL = os.getenv("TELEGRAM_API_BASE_FILE_URL")
+# Rows per page in the students and debtors lists
+PAGE_SIZE = 15
+# Channel membership, see subscription.py
+SUBSCRIPTIONS = SubscriptionCache(
+    CHANNEL_ID,
+    maxsize=int(os.getenv("SUB_CACHE_SIZE", "50000")),
+    positive_ttl=float(os.getenv("SUB_CACHE_TTL", "3600")),
+    negative_ttl=float(os.getenv("SUB_CACHE_NEGATIVE_TTL", "30")),
+    refresh_ahead=float(os.getenv("SUB_REFRESH_AHEAD", "300")),
+    refresh_batch=int(os.getenv("SUB_REFRESH_BATCH", "50"))
+)
+SUB_REFRESH_INTERVAL = float(os.getenv("SUB_REFRESH_INTERVAL", "60"))
+# Outbound Bot API limits, see send_queue.py
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_RATE_PER_MIN = float(os.getenv("SEND_GROUP_RATE_PER_MIN", "20"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+# Lesson reminders sent by the bot itself, see reminders.py
+REMINDERS_ENABLED = os.getenv("REMINDERS_ENABLED", "1") == "1"
+REMINDER_LEAD_MINUTES = int(os.getenv("REMINDER_LEAD_MINUTES", "45"))
+REMINDER_HORIZON_HOURS = float(os.getenv("REMINDER_HORIZON_HOURS", "6"))
+REMINDER_POLL_INTERVAL = float(os.getenv("REMINDER_POLL_INTERVAL", "30"))
+# Cache invalidation from Postgres notifications, see invalidation.py
+DB_CHANGE_LISTENER = os.getenv("DB_CHANGE_LISTENER", "1") == "1"
+# Never defaults to DATABASE_URL: LISTEN through PgBouncer in transaction mode
+# silently receives nothing, so the direct Postgres URL must be given explicitly
+DB_LISTEN_URL = os.getenv("DB_LISTEN_URL")
+# Conversation state, see state.py: "memory", "sqlite" or "postgres".
+# bot_data['pending_link']: users asked to send their e-mail, {telegram_id: True}
+# bot_data['pending_reschedule']: reschedule flow, {telegram_id: {'lesson_id': str, 'date': ISO str, 'role': str}}
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "bot_state.sqlite3")
+STATE_MAX_SIZE = int(os.getenv("STATE_MAX_SIZE", "10000"))
+STATE_PURGE_INTERVAL = float(os.getenv("STATE_PURGE_INTERVAL", "300"))
+PENDING_LINK_TTL = float(os.getenv("PENDING_LINK_TTL", "86400"))
+PENDING_RESCHEDULE_TTL = float(os.getenv("PENDING_RESCHEDULE_TTL", "3600"))
+
+# Per-update tracing and the Prometheus endpoint, see tracing.py
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)  # 0 = no endpoint
+TRACE_LOG = os.getenv("TRACE_LOG", "0") == "1"
+TRACER = Tracer(log_updates=TRACE_LOG)
 
 # --- Helpers ---
-async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    try:
-        member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        if member.status in ['left', 'kicked']: return False
-        return True
-    except Exception as e:
-        if "Chat not found" not in str(e): logging.error(f"Subscription check error: {e}")
-        return True
+async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, recheck=False):
+    # recheck: the user says they just subscribed, so don't trust a cached "no"
+    return await SUBSCRIPTIONS.is_subscribed(context.bot, update.effective_user.id, recheck_negative=recheck)
 
 def to_local_time(dt, zone="Europe/Moscow"):
     if not dt: return None
-    if dt.tzinfo is None: dt = pytz.utc.localize(dt)
-    try: tz = pytz.timezone(zone)
-    except: tz = pytz.timezone("Europe/Moscow")
-    return dt.astimezone(tz)
-
-def generate_date_picker(lesson_id, action_prefix, user_tz="Europe/Moscow"):
-    """Generate a keyboard with next 7 days for date selection"""
-    tz = pytz.timezone(user_tz)
-    now = datetime.now(tz)
-    keyboard = []
-    row = []
-    for i in range(7):
-        day = now + timedelta(days=i)
-        day_str = day.strftime("%d.%m")
-        day_name = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][day.weekday()]
-        label = f"{day_name} {day_str}"
-        date_iso = day.strftime("%Y-%m-%d")
-        row.append(InlineKeyboardButton(label, callback_data=f"{action_prefix}_{lesson_id}_d_{date_iso}"))
-        if len(row) == 4:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("🔙 Отмена", callback_data=f"l_{lesson_id}")])
-    return InlineKeyboardMarkup(keyboard)
-
-def generate_time_picker(lesson_id, date_str, action_prefix):
-    """Generate a keyboard with time slots"""
-    keyboard = []
-    times = ["09:00", "10:00", "11:00", "12:00", "13:00", "14:00", "15:00", "16:00", "17:00", "18:00", "19:00", "20:00"]
-    row = []
-    for t in times:
-        row.append(InlineKeyboardButton(t, callback_data=f"{action_prefix}_{lesson_id}_t_{date_str}_{t}"))
-        if len(row) == 4:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("🔙 Назад к дате", callback_data=f"{action_prefix}_{lesson_id}")])
-    return InlineKeyboardMarkup(keyboard)
+    return localtime.to_local(dt, zone)
 
 async def send_subscription_wall(update: Update):
     channel_url = f"https://t.me/{CHANNEL_ID.replace('@', '')}"
@@ -93,36 +116,6 @@ async def send_subscription_wall(update: Update):
     else:
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
-# --- Keyboards ---
-def main_reply_keyboard(role='teacher'):
-    if role == 'student':
-        return ReplyKeyboardMarkup([
-            ["📅 Расписание", "📉 Оплата"],
-            ["⚙️ Настройки", "🏠 Главное меню"],
-            ["📎 Справка"]
-        ], resize_keyboard=True)
-    return ReplyKeyboardMarkup([
-        ["📅 Расписание", "👥 Ученики"],
-        ["💰 Финансы", "📉 Должники"],
-        ["⚙️ Настройки", "🏠 Главное меню"],
-        ["📎 Справка"]
-    ], resize_keyboard=True)
-
-def main_menu_keyboard(role='teacher'):
-    if role == 'student':
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("📅 Расписание", callback_data='menu_schedule'), InlineKeyboardButton("💰 Оплата", callback_data='menu_finance')],
-            [InlineKeyboardButton("⚙️ Настройки", callback_data='menu_settings')]
-        ])
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📅 Расписание", callback_data='menu_schedule'), InlineKeyboardButton("👥 Ученики", callback_data='menu_students')],
-        [InlineKeyboardButton("💰 Финансы", callback_data='menu_finance'), InlineKeyboardButton("⚙️ Настройки", callback_data='menu_settings')],
-        [InlineKeyboardButton("📉 Должники", callback_data='menu_debtors')]
-    ])
-
-def back_button(data='menu_main'):
-    return InlineKeyboardButton("🔙 Назад", callback_data=data)
-
 # --- Action Logic Functions ---
 
 async def action_show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, user, is_start=False):
@@ -158,20 +151,30 @@ async def action_show_main_menu(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text(text, reply_markup=main_reply_keyboard(role), parse_mode='Markdown')
 
 async def action_show_schedule_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [[InlineKeyboardButton("Сегодня", callback_data='sched_today'), InlineKeyboardButton("Завтра", callback_data='sched_tomorrow')], [back_button()]]
     text = "📅 **Расписание: выберите день**"
-    if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-    else: await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=SCHEDULE_MENU, parse_mode='Markdown')
+    else: await update.message.reply_text(text, reply_markup=SCHEDULE_MENU, parse_mode='Markdown')
 
-async def action_show_students_list(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
+def page_nav_row(prefix, first_key, last_key, has_prev, has_next):
+    row = []
+    if has_prev: row.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{prefix}_p_{first_key}"))
+    if has_next: row.append(InlineKeyboardButton("Дальше ➡️", callback_data=f"{prefix}_n_{last_key}"))
+    return row
+
+async def action_show_students_list(update: Update, context: ContextTypes.DEFAULT_TYPE, user, cursor=None, direction='next'):
     pool = context.bot_data['pool']
-    students = await get_all_students(pool, user['id'])
+    students, has_prev, has_next = await get_students_page(pool, user['id'], cursor, direction, limit=PAGE_SIZE)
+    if not students and cursor:
+        # Cursor row is gone (student deleted) - start over
+        students, has_prev, has_next = await get_students_page(pool, user['id'], limit=PAGE_SIZE)
     if not students:
         msg = "У вас пока нет учеников."
-        if update.callback_query: await update.callback_query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup([[back_button()]]))
+        if update.callback_query: await update.callback_query.edit_message_text(msg, reply_markup=back_markup())
         else: await update.message.reply_text(msg, reply_markup=main_reply_keyboard())
         return
-    keyboard = [[InlineKeyboardButton(s['name'], callback_data=f"student_{s['id']}")] for s in students[:15]]
+    keyboard = [[InlineKeyboardButton(s['name'], callback_data=f"student_{s['id']}")] for s in students]
+    nav = page_nav_row('stl', students[0]['id'], students[-1]['id'], has_prev, has_next)
+    if nav: keyboard.append(nav)
     keyboard.append([back_button()])
     text = "👥 **Ваши ученики:**"
     if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
@@ -212,30 +215,35 @@ async def action_show_finance_menu(update: Update, context: ContextTypes.DEFAULT
     if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
     else: await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
-async def action_show_debtors(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
+async def action_show_debtors(update: Update, context: ContextTypes.DEFAULT_TYPE, user, cursor=None, direction='next'):
     pool = context.bot_data['pool']
-    unpaid = await get_unpaid_lessons(pool, user['id'])
+    unpaid, has_prev, has_next = await get_unpaid_lessons_page(pool, user['id'], cursor, direction, limit=PAGE_SIZE)
+    if not unpaid and cursor:
+        unpaid, has_prev, has_next = await get_unpaid_lessons_page(pool, user['id'], limit=PAGE_SIZE)
     if not unpaid:
         text = "🎉 Должников нет."
-        if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[back_button()]]))
+        if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=back_markup())
         else: await update.message.reply_text(text)
         return
     text = "📉 **Должники:**\n\nНажмите на урок, чтобы отметить оплату."
     keyboard = []
-    for l in unpaid[:15]:
+    for l in unpaid:
         if l['groupName']:
             display_name = f"👤 {l['studentName']} (👥 {l['groupName']})"
         else:
             display_name = f"👤 {l['studentName']}"
         keyboard.append([InlineKeyboardButton(f"{display_name} — {l['price']}₽", callback_data=f"l_{l['id']}")])
+    first, last = unpaid[0], unpaid[-1]
+    nav = page_nav_row('dbt', f"{first['id']}_{first['studentId']}", f"{last['id']}_{last['studentId']}", has_prev, has_next)
+    if nav: keyboard.append(nav)
     keyboard.append([back_button()])
     if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
     else: await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
 async def action_show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
     text = f"⚙️ **Настройки**\n\nEmail: {user['email']}\nЧасовой пояс: {user.get('timezone', 'Europe/Moscow')}\nУведомления: ✅\nID Чата: `{update.effective_chat.id}`"
-    if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[back_button()]]), parse_mode='Markdown')
-    else: await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup([[back_button()]]), parse_mode='Markdown')
+    if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=back_markup(), parse_mode='Markdown')
+    else: await update.message.reply_text(text, reply_markup=back_markup(), parse_mode='Markdown')
 
 # --- Handlers ---
 
@@ -252,7 +260,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             display_name = linked_user['email'] or linked_user['firstName'] or linked_user['name'] or "Пользователь"
             await update.message.reply_text(f"🚀 Аккаунт **{display_name}** успешно привязан!", parse_mode='Markdown')
             # Show menu immediately
-            await action_show_main_menu(update, context, dict(linked_user), is_start=True)
+            await action_show_main_menu(update, context, linked_user, is_start=True)
         else:
             await update.message.reply_text("❌ **Ошибка привязки**\nСсылка недействительна или срок её действия истек (код не найден в базе).", parse_mode='Markdown')
         return  # STOP HERE to prevent double messages
@@ -260,26 +268,25 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 2. SCENARIO: Just opened the bot (Regular Flow)
     user_rec = await get_user_by_telegram_id(pool, user_id)
     if user_rec: 
-        await action_show_main_menu(update, context, dict(user_rec), is_start=True)
+        await action_show_main_menu(update, context, user_rec, is_start=True)
     else:
         await update.message.reply_text("🔒 **Авторизация**\nПривяжите аккаунт на сайте или отправьте Email здесь.", parse_mode='Markdown')
-        PENDING_LINK.add(user_id)
+        await context.bot_data['pending_link'].set(user_id, True)
 
 async def check_sub_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    if await check_subscription(update, context):
+    if await check_subscription(update, context, recheck=True):
         await query.answer("Спасибо за подписку! 🎉")
         user_rec = await get_user_by_telegram_id(context.bot_data['pool'], update.effective_user.id)
-        if user_rec: await action_show_main_menu(update, context, dict(user_rec), is_start=True)
+        if user_rec: await action_show_main_menu(update, context, user_rec, is_start=True)
         else: await query.edit_message_text("🔒 Авторизуйтесь на сайте.")
     else: await query.answer("Вы все еще не подписаны 😢", show_alert=True)
 
 async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_rec = await get_user_by_telegram_id(context.bot_data['pool'], update.effective_user.id)
-    if not user_rec: return
-    user = dict(user_rec)
+    user = await get_user_by_telegram_id(context.bot_data['pool'], update.effective_user.id)
+    if not user: return
     data = query.data
     if data == 'menu_main': await action_show_main_menu(update, context, user)
     elif data == 'menu_schedule': await action_show_schedule_menu(update, context)
@@ -288,15 +295,27 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == 'menu_debtors': await action_show_debtors(update, context, user)
     elif data == 'menu_settings': await action_show_settings(update, context, user)
 
-async def schedule_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # stl_{n|p}_{studentId} / dbt_{n|p}_{lessonId}_{studentId}
     query = update.callback_query
     await query.answer()
     user_rec = await get_user_by_telegram_id(context.bot_data['pool'], update.effective_user.id)
-    if not user_rec: return
-    user = dict(user_rec)
+    if not user_rec or user_rec['role'] == 'student': return
+    parts = query.data.split('_')
+    direction = 'prev' if parts[1] == 'p' else 'next'
+    if parts[0] == 'stl':
+        await action_show_students_list(update, context, user_rec, parts[2], direction)
+    elif parts[0] == 'dbt' and len(parts) == 4:
+        await action_show_debtors(update, context, user_rec, (parts[2], parts[3]), direction)
+
+async def schedule_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = await get_user_by_telegram_id(context.bot_data['pool'], update.effective_user.id)
+    if not user: return
     user_tz = user.get('timezone', 'Europe/Moscow')
     role = user.get('role', 'teacher')
-    target_date = datetime.now(pytz.timezone(user_tz))
+    target_date = localtime.local_today(user_tz)
     title = "Сегодня"
     if query.data == 'sched_tomorrow': target_date += timedelta(days=1); title = "Завтра"
     
@@ -308,7 +327,7 @@ async def schedule_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lessons = await get_lessons_by_date(context.bot_data['pool'], user['id'], target_date, user_tz)
 
     if not lessons:
-        await query.edit_message_text(f"📅 **{title}:** Занятий нет. 🏖", reply_markup=InlineKeyboardMarkup([[back_button('menu_schedule')]]), parse_mode='Markdown')
+        await query.edit_message_text(f"📅 **{title}:** Занятий нет. 🏖", reply_markup=back_markup('menu_schedule'), parse_mode='Markdown')
         return
     text = f"📅 **Расписание на {title}:**"
     keyboard = []
@@ -327,9 +346,10 @@ async def lesson_details_callback(update: Update, context: ContextTypes.DEFAULT_
     data_parts = query.data.split('_')
     lesson_id = data_parts[1]
     pool = context.bot_data['pool']
+    user_rec = await get_user_by_telegram_id(pool, update.effective_user.id)
+    notice = ""
     if len(data_parts) > 2:
         action = data_parts[2]
-        user_rec_check = await get_user_by_telegram_id(pool, update.effective_user.id)
         
         if action == 'p': await toggle_lesson_paid(pool, lesson_id, True)
         elif action == 'up': await toggle_lesson_paid(pool, lesson_id, False)
@@ -339,11 +359,14 @@ async def lesson_details_callback(update: Update, context: ContextTypes.DEFAULT_
         elif action == 'ups':
             student_id = data_parts[3]
             await toggle_student_payment(pool, lesson_id, student_id, False)
+        elif action == 'pall' and user_rec and user_rec['role'] != 'student':
+            settled = await settle_group_lesson(pool, lesson_id, user_rec['id'])
+            notice = f"✅ Отмечено оплат: **{settled['count']}** на сумму **{settled['amount']} ₽**\n\n"
         elif action == 'tc':
             l = await get_lesson_by_id(pool, lesson_id)
             if l: await toggle_lesson_cancel(pool, lesson_id, not l['isCanceled'])
         # Student actions
-        elif action == 'spaid' and user_rec_check and user_rec_check['role'] == 'student':
+        elif action == 'spaid' and user_rec and user_rec['role'] == 'student':
             # Student claims they paid - notify teacher
             lesson = await get_lesson_by_id(pool, lesson_id)
             if lesson:
@@ -351,15 +374,14 @@ async def lesson_details_callback(update: Update, context: ContextTypes.DEFAULT_
                 # Could add a more sophisticated notification here
         elif action == 'sreq' and len(data_parts) > 3:
             req_type = data_parts[3]  # 'reschedule' or 'cancel'
-            if user_rec_check and user_rec_check['role'] == 'student':
-                await create_lesson_request(pool, lesson_id, user_rec_check['id'], req_type)
+            if user_rec and user_rec['role'] == 'student':
+                await create_lesson_request(pool, lesson_id, user_rec['id'], req_type)
                 type_label = "перенос" if req_type == 'reschedule' else "отмену"
                 await query.answer(f"✅ Заявка на {type_label} отправлена преподавателю!", show_alert=True)
 
     lesson = await get_lesson_by_id(pool, lesson_id)
     if not lesson: return
-    user_rec = await get_user_by_telegram_id(pool, update.effective_user.id)
-    user_tz = dict(user_rec).get('timezone', 'Europe/Moscow') if user_rec else 'Europe/Moscow'
+    user_tz = user_rec.get('timezone', 'Europe/Moscow') if user_rec else 'Europe/Moscow'
     time_str = to_local_time(lesson['date'], user_tz).strftime("%d.%m %H:%M")
     
     if lesson['groupId']:
@@ -377,7 +399,7 @@ async def lesson_details_callback(update: Update, context: ContextTypes.DEFAULT_
     if user_rec['role'] == 'student':
         entity_label = f"👨‍🏫 Преподаватель: **{teacher_name}**"
 
-    text = f"📚 **Занятие**\n{entity_label}\n📖 Предмет: **{lesson['subjectName'] or '---'}**\n📅 Время: **{time_str}**\n💰 Стоимость: **{lesson['price']} ₽**\n📊 Статус: {status}"
+    text = f"{notice}📚 **Занятие**\n{entity_label}\n📖 Предмет: **{lesson['subjectName'] or '---'}**\n📅 Время: **{time_str}**\n💰 Стоимость: **{lesson['price']} ₽**\n📊 Статус: {status}"
     
     keyboard = []
     
@@ -392,6 +414,8 @@ async def lesson_details_callback(update: Update, context: ContextTypes.DEFAULT_
                 btn_action = 'ups' if p['hasPaid'] else 'ps'
                 btn_text = f"{'🔄' if p['hasPaid'] else '✅'} {p['studentName']}"
                 keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"l_{lesson_id}_{btn_action}_{p['studentId']}")])
+            if not lesson['isCanceled'] and not all(p['hasPaid'] for p in group_payments):
+                keyboard.append([InlineKeyboardButton("💰 Оплатили все", callback_data=f"l_{lesson_id}_pall")])
 
     btns = []
     if user_rec['role'] != 'student' and not lesson['isCanceled']: 
@@ -418,8 +442,16 @@ async def lesson_details_callback(update: Update, context: ContextTypes.DEFAULT_
 async def student_details_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    student_id = query.data.split('_')[1]
+    data_parts = query.data.split('_')
+    student_id = data_parts[1]
     pool = context.bot_data['pool']
+    notice = ""
+    
+    if len(data_parts) > 2 and data_parts[2] == 'payall':
+        user_rec = await get_user_by_telegram_id(pool, update.effective_user.id)
+        if user_rec and user_rec['role'] != 'student':
+            settled = await settle_student_debts(pool, student_id, user_rec['id'])
+            notice = f"✅ Отмечено оплаченными: **{settled['count']}** на сумму **{settled['amount']} ₽**\n\n"
     
     details = await get_student_details(pool, student_id)
     if not details: return
@@ -431,7 +463,7 @@ async def student_details_callback(update: Update, context: ContextTypes.DEFAULT
     groups_str = ", ".join(details['groups']) or "Нет"
     
     text = (
-        f"👤 **Карточка ученика: {info['name']}**\n\n"
+        f"{notice}👤 **Карточка ученика: {info['name']}**\n\n"
         f"📱 Контакт: `{info['contact'] or '---'}`\n"
         f"📖 Предметы: {subjects_str}\n"
         f"👥 Группы: {groups_str}\n\n"
@@ -442,19 +474,21 @@ async def student_details_callback(update: Update, context: ContextTypes.DEFAULT
         f"📝 Заметка: {info['note'] or '---'}"
     )
     
-    keyboard = [[back_button('menu_students')]]
+    keyboard = []
+    if stats['unpaid']:
+        keyboard.append([InlineKeyboardButton(f"💰 Погасить долг ({stats['debt']} ₽)", callback_data=f"student_{student_id}_payall")])
+    keyboard.append([back_button('menu_students')])
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip()
     pool = context.bot_data['pool']
-    user_rec = await get_user_by_telegram_id(pool, user_id)
+    user = await get_user_by_telegram_id(pool, user_id)
 
     # Menu checks
     if text in ["📅 Расписание", "👥 Ученики", "💰 Финансы", "📉 Должники", "⚙️ Настройки", "🏠 Главное меню", "📉 Оплата", "💰 Оплата"]:
-        if not user_rec: return await update.message.reply_text("🔒 Авторизуйтесь.")
-        user = dict(user_rec)
+        if not user: return await update.message.reply_text("🔒 Авторизуйтесь.")
         if text == "📅 Расписание": await action_show_schedule_menu(update, context)
         elif text == "👥 Ученики" and user['role'] != 'student': await action_show_students_list(update, context, user)
         elif text in ["💰 Финансы", "📉 Оплата", "💰 Оплата"]: await action_show_finance_menu(update, context, user)
@@ -466,10 +500,10 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text == "📎 Справка":
         return await update.message.reply_text("📚 **Справка**\nЭтот бот синхронизирован с вашим сайтом. Все изменения (оплаты, отмены) сразу видны везде.", parse_mode='Markdown')
 
-    if user_id in PENDING_LINK:
+    if await context.bot_data['pending_link'].get(user_id):
         user = await link_user_telegram(pool, text, user_id, update.effective_chat.id)
         if user: 
-            PENDING_LINK.remove(user_id)
+            await context.bot_data['pending_link'].delete(user_id)
             role = user.get('role', 'teacher')
             await update.message.reply_text("🎉 Готово! Аккаунт привязан.", reply_markup=main_reply_keyboard(role))
         else:
@@ -493,40 +527,217 @@ async def lesson_request_callback(update: Update, context: ContextTypes.DEFAULT_
         await query.answer("❌ Только преподаватель может обрабатывать заявки", show_alert=True)
         return
     
-    lr = await get_lesson_request(pool, request_id)
-    if not lr:
-        await query.edit_message_text("❌ Заявка не найдена или уже обработана.")
+    # Resolve first: the write only succeeds while the request is still pending,
+    # so concurrent taps can't both approve/reject it
+    if action == 'lr_approve':
+        lr = await approve_lesson_request(pool, request_id)
+    elif action == 'lr_reject':
+        lr = await reject_lesson_request(pool, request_id)
+    else:
         return
-    
-    if lr['status'] != 'pending':
-        await query.edit_message_text(f"ℹ️ Эта заявка уже обработана (статус: {lr['status']}).")
+
+    if not lr:
+        current = await get_lesson_request(pool, request_id)
+        if not current:
+            await query.edit_message_text("❌ Заявка не найдена или уже обработана.")
+        else:
+            await query.edit_message_text(f"ℹ️ Эта заявка уже обработана (статус: {current['status']}).")
         return
     
+    type_label = "отмену" if lr['type'] == 'cancel' else "перенос"
     if action == 'lr_approve':
-        await approve_lesson_request(pool, request_id)
-        type_label = "отмену" if lr['type'] == 'cancel' else "перенос"
         await query.edit_message_text(f"✅ **Заявка одобрена!**\n\nВы одобрили {type_label} занятия.\nУченик получит уведомление.", parse_mode='Markdown')
-    elif action == 'lr_reject':
-        await reject_lesson_request(pool, request_id)
-        type_label = "отмену" if lr['type'] == 'cancel' else "перенос"
+    else:
         await query.edit_message_text(f"❌ **Заявка отклонена.**\n\nВы отклонили {type_label} занятия.\nУченик получит уведомление.", parse_mode='Markdown')
 
-if __name__ == '__main__':
-    if not TOKEN: exit(1)
-    app = ApplicationBuilder().token(TOKEN).build()
-    async def post_init(a): 
-        a.bot_data['pool'] = await get_db_pool()
-        db_url = os.getenv("DATABASE_URL", "Nodes not found")
-        masked_url = db_url.split('@')[-1] if '@' in db_url else "Unknown"
-        print(f"Bot ready! Connected to DB host: {masked_url}")
-
-    app.post_init = post_init
+async def on_db_change(a, change):
+    await apply_change(a.bot_data['pool'], change)
+    if change.get('t') == 'Lesson' and 'reminders' in a.bot_data:
+        a.bot_data['reminders'].lesson_changed(change)
+
+async def open_state_stores(a):
+    if STATE_BACKEND == 'sqlite': options = {'path': STATE_SQLITE_PATH}
+    elif STATE_BACKEND == 'postgres': options = {'pool': a.bot_data['pool']}
+    else: options = {}
+    for name, ttl in (('pending_link', PENDING_LINK_TTL), ('pending_reschedule', PENDING_RESCHEDULE_TTL)):
+        a.bot_data[name] = open_state_store(STATE_BACKEND, name, ttl, STATE_MAX_SIZE, **options)
+        await a.bot_data[name].start()
+
+async def purge_state_job(context: ContextTypes.DEFAULT_TYPE):
+    for name in ('pending_link', 'pending_reschedule'):
+        try: await context.bot_data[name].purge()
+        except Exception as e: logging.error(f"State purge failed for {name}: {e}")
+
+def render_metrics(a):
+    out = Exposition()
+    TRACER.export(out)
+    if 'pool' in a.bot_data:
+        pool = a.bot_data['pool']
+        stats = pool.stats()
+        for key in ('size', 'idle', 'in_use', 'waiting'):
+            out.gauge(f'bot_db_pool_{key}', stats[key])
+        out.counter('bot_db_pool_acquires_total', stats['acquires'])
+        out.counter('bot_db_pool_timeouts_total', stats['timeouts'])
+        out.histogram('bot_db_pool_acquire_wait_seconds', pool.acquire_wait)
+    queries = get_query_stats()
+    for name, q in queries.items():
+        out.counter('bot_db_query_calls_total', q['calls'], 'Statements run', query=name)
+    for name, q in queries.items():
+        out.counter('bot_db_query_errors_total', q['errors'], query=name)
+    for name, q in queries.items():
+        out.counter('bot_db_query_seconds_total', q['total_ms'] / 1000, query=name)
+    caches = {
+        'user': USER_CACHE.stats(), 'stats': STATS_CACHE.stats(), 'student_scope': SCOPE_CACHE.stats(),
+        'subscription': SUBSCRIPTIONS.stats()
+    }
+    for cache, stats in caches.items():
+        out.gauge('bot_cache_size', stats['size'], cache=cache)
+    for cache, stats in caches.items():
+        out.counter('bot_cache_hits_total', stats['hits'], cache=cache)
+    for cache, stats in caches.items():
+        out.counter('bot_cache_misses_total', stats['misses'], cache=cache)
+    processor = a.update_processor
+    if hasattr(processor, 'stats'):
+        stats = processor.stats()
+        out.gauge('bot_updates_pending', stats['pending'])
+        out.gauge('bot_updates_running', stats['running'])
+        out.histogram('bot_update_queue_wait_seconds', processor.queue_wait, 'Per-chat ordering wait')
+    limiter = a.bot.rate_limiter
+    if limiter is not None:
+        stats = limiter.stats()
+        out.counter('bot_api_sent_total', stats['sent'])
+        out.counter('bot_api_failed_total', stats['failed'])
+        out.counter('bot_api_retries_total', stats['retries'])
+        for priority, hist in limiter.queue_wait.items():
+            out.histogram('bot_api_queue_wait_seconds', hist, 'Outbound rate limiter wait', priority=PRIORITY_NAMES[priority])
+    if 'slow_log' in a.bot_data:
+        stats = a.bot_data['slow_log'].stats()
+        out.counter('bot_db_slow_queries_total', stats['slow'])
+        out.counter('bot_db_slow_queries_captured_total', stats['captured'])
+    if 'reminders' in a.bot_data:
+        stats = a.bot_data['reminders'].stats()
+        out.gauge('bot_reminders_scheduled', stats['scheduled'])
+        out.counter('bot_reminders_sent_total', stats['sent'])
+        out.counter('bot_reminders_errors_total', stats['errors'])
+    if 'listener' in a.bot_data:
+        stats = a.bot_data['listener'].stats()
+        out.gauge('bot_db_listener_connected', int(stats['connected']))
+        out.counter('bot_db_listener_received_total', stats['received'])
+        out.counter('bot_db_listener_errors_total', stats['errors'])
+    return out.render()
+
+async def post_init(a):
+    a.bot_data['pool'] = await get_db_pool()
+    warmed = await a.bot_data['pool'].warm_up()
+    print(f"DB pool warmed up: {warmed} connections")
+    slow_log = start_slow_query_log(a.bot_data['pool'])
+    if slow_log:
+        a.bot_data['slow_log'] = slow_log
+        print(f"Slow query log: {slow_log.path} (>= {slow_log.threshold * 1000:g} ms)")
+    await open_state_stores(a)
+    if a.job_queue:
+        a.job_queue.run_repeating(
+            SUBSCRIPTIONS.refresh_job, interval=SUB_REFRESH_INTERVAL, first=SUB_REFRESH_INTERVAL, data=PRIORITY_BULK
+        )
+        a.job_queue.run_repeating(purge_state_job, interval=STATE_PURGE_INTERVAL, first=STATE_PURGE_INTERVAL)
+        if REMINDERS_ENABLED:
+            a.bot_data['reminders'] = ReminderScheduler(
+                a.bot_data['pool'], lead_minutes=REMINDER_LEAD_MINUTES,
+                horizon_hours=REMINDER_HORIZON_HOURS, poll_interval=REMINDER_POLL_INTERVAL
+            )
+            await a.bot_data['reminders'].start(a.job_queue)
+            print(f"Lesson reminders: {a.bot_data['reminders'].stats()['scheduled']} scheduled")
+    if DB_CHANGE_LISTENER and not DB_LISTEN_URL:
+        logging.error("DB_CHANGE_LISTENER=1 needs DB_LISTEN_URL (a direct Postgres URL, not PgBouncer); "
+                      "cache invalidation from the database is off, TTLs bound staleness")
+    elif DB_CHANGE_LISTENER:
+        a.bot_data['listener'] = ChangeListener(DB_LISTEN_URL, lambda change: on_db_change(a, change), flush_caches)
+        a.bot_data['listener'].start()
+    if METRICS_PORT:
+        a.bot_data['metrics'] = MetricsServer(lambda: render_metrics(a), METRICS_HOST, METRICS_PORT)
+        await a.bot_data['metrics'].start()
+        print(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    db_url = os.getenv("DATABASE_URL", "Nodes not found")
+    masked_url = db_url.split('@')[-1] if '@' in db_url else "Unknown"
+    print(f"Bot ready! Connected to DB host: {masked_url}")
+
+async def post_shutdown(a):
+    if 'metrics' in a.bot_data: await a.bot_data['metrics'].stop()
+    if 'listener' in a.bot_data: await a.bot_data['listener'].stop()
+    for name in ('pending_link', 'pending_reschedule'):
+        if name in a.bot_data: await a.bot_data[name].close()
+    await stop_slow_query_log()
+    if 'pool' in a.bot_data: await a.bot_data['pool'].close()
+
+def build_application(token=TOKEN):
+    builder = ApplicationBuilder().token(token).post_init(post_init).post_shutdown(post_shutdown)
+    builder = builder.rate_limiter(OutboundRateLimiter(
+        global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, group_rate=SEND_GROUP_RATE_PER_MIN / 60,
+        max_retries=SEND_MAX_RETRIES
+    ))
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+    if API_BASE_URL:
+        # Local Bot API server or a fake one for testing
+        builder = builder.base_url(API_BASE_URL).base_file_url(API_BASE_FILE_URL or API_BASE_URL)
+    app = builder.build()
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CallbackQueryHandler(check_sub_callback, pattern='^check_sub'))
     app.add_handler(CallbackQueryHandler(menu_callback, pattern='^menu_'))
     app.add_handler(CallbackQueryHandler(schedule_callback, pattern='^sched_'))
+    app.add_handler(CallbackQueryHandler(page_callback, pattern='^(stl|dbt)_'))
     app.add_handler(CallbackQueryHandler(lesson_details_callback, pattern='^l_'))
     app.add_handler(CallbackQueryHandler(student_details_callback, pattern='^student_'))
     app.add_handler(CallbackQueryHandler(lesson_request_callback, pattern='^lr_'))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), text_handler))
+    TRACER.instrument(app)
+    return app
+
+def webhook_enabled():
+    if BOT_MODE != 'webhook':
+        return False
+    if not WEBHOOK_SECRET:
+        logging.error("BOT_MODE=webhook requires WEBHOOK_SECRET; falling back to polling")
+        return False
+    if importlib.util.find_spec("tornado") is None:
+        logging.error("Webhook mode needs python-telegram-bot[webhooks]; falling back to polling")
+        return False
+    return True
+
+def run_application(app):
+    if webhook_enabled():
+        # Telegram sends WEBHOOK_SECRET in X-Telegram-Bot-Api-Secret-Token;
+        # PTB rejects requests without it with 403.
+        print(f"Starting webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL or None,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        return
     app.run_polling()
+
+def run_workers(count):
+    webhook = None
+    if webhook_enabled():
+        print(f"Starting webhook ingress on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        webhook = dict(
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL or None, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES
+        )
+    print(f"Starting {count} bot workers")
+    run_sharded(count, TOKEN, webhook=webhook, base_url=API_BASE_URL, base_file_url=API_BASE_FILE_URL)
+
+if __name__ == '__main__':
+    if not TOKEN: exit(1)
+    workers = BOT_WORKERS
+    if workers > 1 and not (DB_CHANGE_LISTENER and DB_LISTEN_URL):
+        # Each worker has its own caches; a write handled by one worker only
+        # clears them there, so the others need the database's change notifications
+        logging.error("BOT_WORKERS > 1 requires the change listener (DB_LISTEN_URL); starting a single process")
+        workers = 1
+    if workers > 1: run_workers(workers)
+    else: run_application(build_application())
@@ -0,0 +1,135 @@
+import asyncio
+import bisect
+import logging
+
+# Seconds; tuned for DB/API waits in an interactive bot
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        out = []
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+    def quantile(self, q):
+        """Upper bucket bound containing the q-th quantile (0 if empty)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Exposition:
+    """Prometheus text format (0.0.4). Samples of one metric must be added
+    consecutively; HELP/TYPE are written before the first of them."""
+
+    def __init__(self):
+        self.lines = []
+        self._declared = set()
+
+    def _declare(self, name, kind, help_text):
+        if name not in self._declared:
+            self._declared.add(name)
+            if help_text:
+                self.lines.append(f"# HELP {name} {help_text}")
+            self.lines.append(f"# TYPE {name} {kind}")
+
+    def gauge(self, name, value, help_text='', **labels):
+        self._declare(name, 'gauge', help_text)
+        self.lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    def counter(self, name, value, help_text='', **labels):
+        self._declare(name, 'counter', help_text)
+        self.lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    def histogram(self, name, hist, help_text='', **labels):
+        self._declare(name, 'histogram', help_text)
+        for bound, total in hist.cumulative():
+            self.lines.append(f"{name}_bucket{_labels({**labels, 'le': _number(bound)})} {total}")
+        self.lines.append(f"{name}_sum{_labels(labels)} {_number(float(hist.sum))}")
+        self.lines.append(f"{name}_count{_labels(labels)} {hist.count}")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class MetricsServer:
+    """Serves GET /metrics on the bot's event loop. `render()` returns the
+    exposition text; it runs on every scrape, so it must be cheap."""
+
+    def __init__(self, render, host="127.0.0.1", port=9108):
+        self.render = render
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logging.warning(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
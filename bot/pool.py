@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from metrics import Histogram
+import tracing
+
+
+class InstrumentedPool:
+    """asyncpg pool wrapper that bounds and measures waits in acquire().
+
+    Exposes the same `async with pool.acquire() as conn` interface db.py uses,
+    plus acquire-wait histogram, in-use/idle/waiting gauges and timeout counts.
+    """
+
+    def __init__(self, pool, acquire_timeout=None):
+        self._pool = pool
+        self.acquire_timeout = acquire_timeout
+        self.acquire_wait = Histogram()
+        self.acquires = 0
+        self.timeouts = 0
+        self.in_use = 0
+        self.waiting = 0
+
+    def acquire(self, *, timeout=None):
+        return _PoolAcquireContext(self, timeout if timeout is not None else self.acquire_timeout)
+
+    async def warm_up(self):
+        # Open and check min_size connections up front so the first taps after
+        # a deploy don't pay for connection setup (and statement preparation)
+        count = self._pool.get_min_size()
+
+        async def ping():
+            async with self.acquire() as conn:
+                await conn.fetchval('SELECT 1')
+
+        results = await asyncio.gather(*[ping() for _ in range(count)], return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            logging.warning(f"Pool warm-up: {len(failed)}/{count} connections failed: {failed[0]}")
+        return count - len(failed)
+
+    def stats(self):
+        return {
+            "size": self._pool.get_size(),
+            "min_size": self._pool.get_min_size(),
+            "max_size": self._pool.get_max_size(),
+            "idle": self._pool.get_idle_size(),
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "acquires": self.acquires,
+            "timeouts": self.timeouts,
+            "acquire_wait": self.acquire_wait.stats()
+        }
+
+    async def close(self):
+        await self._pool.close()
+
+    def __getattr__(self, name):
+        # Everything else (execute, fetch, get_size, ...) goes to the asyncpg pool
+        return getattr(self._pool, name)
+
+
+class _PoolAcquireContext:
+    __slots__ = ('_owner', '_timeout', '_conn')
+
+    def __init__(self, owner, timeout):
+        self._owner = owner
+        self._timeout = timeout
+        self._conn = None
+
+    async def __aenter__(self):
+        owner = self._owner
+        owner.waiting += 1
+        started = time.perf_counter()
+        try:
+            self._conn = await owner._pool.acquire(timeout=self._timeout)
+        except asyncio.TimeoutError:
+            owner.timeouts += 1
+            raise
+        finally:
+            owner.waiting -= 1
+            waited = time.perf_counter() - started
+            owner.acquire_wait.observe(waited)
+            tracing.record_pool_wait(waited)
+        owner.acquires += 1
+        owner.in_use += 1
+        return self._conn
+
+    async def __aexit__(self, *exc):
+        conn, self._conn = self._conn, None
+        try:
+            await self._owner._pool.release(conn)
+        finally:
+            self._owner.in_use -= 1
@@ -0,0 +1,129 @@
+"""Named SQL statements used by db.py.
+
+Every statement is registered once under a stable name, and per-name
+execution counts and timings are collected.
+
+By default (DB_PREPARED_STATEMENTS=0) asyncpg's statement cache is disabled
+(statement_cache_size=0) and every query is sent as an unnamed statement that
+lives for a single execution. That is what PgBouncer in transaction pooling
+mode, which production runs behind, requires: it does not keep a server
+connection for the client between transactions, so a statement prepared on
+one backend may be missing on the next.
+
+With a direct Postgres connection, DB_PREPARED_STATEMENTS=1 keeps every
+statement prepared in asyncpg's per-connection cache after its first use, so
+later executions skip the Parse/Describe round trip, and `validate_connection()`
+prepares each statement once at startup to report broken SQL then rather than
+on the first tap that runs it.
+
+Statements slower than the threshold of the registry's `slow_log` (see
+slow_queries.py, off unless DB_SLOW_QUERY_MS is set) are handed to it.
+"""
+import os
+import time
+import logging
+import tracing
+
+PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "0") == "1"
+
+
+class Query:
+    __slots__ = ('name', 'sql', 'record_class', 'registry', 'calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, name, sql, record_class=None, registry=None):
+        self.name = name
+        self.sql = sql
+        self.record_class = record_class
+        self.registry = registry
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    async def fetch(self, conn, *args):
+        return await self._run(conn.fetch, args, record_class=self.record_class)
+
+    async def fetchrow(self, conn, *args):
+        return await self._run(conn.fetchrow, args, record_class=self.record_class)
+
+    async def fetchval(self, conn, *args):
+        return await self._run(conn.fetchval, args)
+
+    async def execute(self, conn, *args):
+        return await self._run(conn.execute, args)
+
+    async def _run(self, method, args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(self.sql, *args, **kwargs)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            tracing.record_db(elapsed)
+            self.calls += 1
+            self.total_time += elapsed
+            if elapsed > self.max_time:
+                self.max_time = elapsed
+            slow_log = self.registry.slow_log if self.registry is not None else None
+            if slow_log is not None and elapsed >= slow_log.threshold:
+                slow_log.record(self, args, elapsed)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_ms": round(self.total_time * 1000, 3),
+            "avg_ms": round(self.total_time * 1000 / self.calls, 3) if self.calls else 0.0,
+            "max_ms": round(self.max_time * 1000, 3)
+        }
+
+
+class QueryRegistry:
+    def __init__(self, prepared=False):
+        self.prepared = prepared
+        self.queries = {}
+        self.slow_log = None
+
+    def register(self, name, sql, record_class=None):
+        if name in self.queries:
+            raise ValueError(f"Query {name!r} is already registered")
+        q = Query(name, sql, record_class, self)
+        self.queries[name] = q
+        return q
+
+    def pool_kwargs(self):
+        """Keyword arguments for asyncpg.create_pool() matching the current mode."""
+        if not self.prepared:
+            return {"statement_cache_size": 0}
+        # Keep every registered statement resident for the connection's lifetime
+        return {
+            "statement_cache_size": max(100, 2 * len(self.queries)),
+            "max_cached_statement_lifetime": 0
+        }
+
+    async def validate_connection(self, conn):
+        """Prepare every statement once on `conn` and log those the server rejects.
+
+        This only checks the SQL: conn.prepare() bypasses the statement cache,
+        which fills on each connection as the statements are first run.
+        """
+        failed = 0
+        for q in self.queries.values():
+            try:
+                await conn.prepare(q.sql, record_class=q.record_class)
+            except Exception as e:
+                logging.error(f"Failed to prepare query {q.name}: {e}")
+                failed += 1
+        return failed
+
+    def stats(self):
+        return {name: q.stats() for name, q in self.queries.items()}
+
+
+REGISTRY = QueryRegistry(prepared=PREPARED_STATEMENTS)
+
+
+def query(name, sql, record_class=None):
+    return REGISTRY.register(name, sql, record_class)
@@ -0,0 +1,237 @@
+"""Lesson reminders, scheduled inside the bot.
+
+Lessons starting within `horizon` are kept in a heap ordered by reminder
+time (`lead` before the start), and a single job-queue timer is armed for the
+earliest one. The heap is filled incrementally, never by a full rescan:
+
+* the lesson window is loaded once at start, and afterwards only the date
+  range newly covered as the horizon moves forward;
+* every `poll_interval` seconds, lessons whose "updatedAt" passed the
+  watermark are re-applied, so new, moved and canceled lessons are picked up.
+  A moved lesson gets a new heap entry; the old one (and any canceled one)
+  is recognised as superseded and skipped when it reaches the top.
+
+When a reminder fires, recipients are re-read in one statement that also
+checks the lesson is still at the scheduled time and not canceled, so a
+change the poll hasn't seen yet can't produce a wrong reminder. Reminders are
+recorded as "lesson_reminder" notifications with the same key the web app's
+cron uses, unique per user ("dedupeKey"), so whichever sender records it
+first sends it and every other one skips it. Once the bot sends reminders,
+set BOT_LESSON_REMINDERS=1 for the web app so its cron stops looking for them.
+Users with lessonReminders off get nothing; in quiet hours the notification
+is recorded but not sent to Telegram, as the web app does.
+"""
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+import localtime
+from db import get_lessons_in_window, get_lessons_changed_since, get_reminder_recipients, record_reminders
+from send_queue import PRIORITY_BULK
+
+
+def _minutes(hhmm):
+    hours, minutes = hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def in_quiet_hours(recipient, now_utc):
+    start, end = recipient['quietHoursStart'], recipient['quietHoursEnd']
+    if not recipient['quietHoursEnabled'] or not start or not end:
+        return False
+    try:
+        start, end = _minutes(start), _minutes(end)
+    except ValueError:
+        return False
+    local = localtime.to_local(now_utc, recipient['timezone'])
+    current = local.hour * 60 + local.minute
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+
+def reminder_texts(r):
+    """(web notification message, Telegram message) for one recipient."""
+    time_str = localtime.to_local(r['date'], r['timezone']).strftime('%H:%M')
+    subject = r['subjectName'] or 'Занятие'
+    teacher = r['teacherName'] or 'Преподаватель'
+    if r['role'] == 'student':
+        return (
+            f"{subject} с преподавателем {teacher} начнется в {time_str}",
+            f"🔔 **Напоминание о занятии**\n\n👨‍🏫 Преподаватель: {teacher}\n📚 Предмет: {subject}\n🕒 Время: {time_str}"
+        )
+    entity = r['studentName'] or r['groupName'] or 'Ученик'
+    return (
+        f"{subject} с {'учеником' if r['studentId'] else 'группой'} {entity} начнется в {time_str}",
+        f"🔔 **Скоро занятие**\n\n{'👤 Ученик' if r['studentId'] else '👥 Группа'}: {entity}\n"
+        f"📚 Предмет: {subject}\n🕒 Время: {time_str}\n⏳ Длительность: {r['duration']} мин"
+    )
+
+
+class ReminderScheduler:
+    def __init__(self, pool, lead_minutes=45, horizon_hours=6, poll_interval=30, overlap=60, batch=1000):
+        self.pool = pool
+        self.lead = timedelta(minutes=lead_minutes)
+        self.horizon = timedelta(hours=horizon_hours)
+        self.poll_interval = poll_interval
+        # Changes are re-read this far behind the watermark to tolerate clock
+        # skew between writers and slow-committing transactions
+        self.overlap = timedelta(seconds=overlap)
+        self.batch = batch
+        self._heap = []  # (fire_at, lesson_id, date), naive UTC
+        self._lessons = {}  # lesson_id -> date its live heap entry is for
+        self._fired = {}  # lesson_id -> date, until the lesson has started
+        self._job_queue = None
+        self._timer = None
+        self._timer_at = None
+        self.watermark = None
+        self.loaded_until = None
+        self.loaded = 0
+        self.changes = 0
+        self.fired = 0
+        self.sent = 0
+        self.quiet = 0
+        self.errors = 0
+
+    async def start(self, job_queue):
+        self._job_queue = job_queue
+        now = localtime.utc_now()
+        self.watermark = now - self.overlap
+        self.loaded_until = now
+        await self._extend_window()
+        job_queue.run_repeating(self._poll_job, interval=self.poll_interval, first=self.poll_interval, name='reminders_poll')
+        self._arm()
+
+    def _apply(self, lesson_id, date, canceled):
+        if canceled or date <= localtime.utc_now() or date > self.loaded_until or lesson_id in self._fired:
+            self._lessons.pop(lesson_id, None)
+            return
+        if self._lessons.get(lesson_id) == date:
+            return
+        self._lessons[lesson_id] = date
+        heapq.heappush(self._heap, (date - self.lead, lesson_id, date))
+
+    def lesson_changed(self, change):
+        """Apply a Lesson change notification (see invalidation.py) right away
+        instead of at the next poll."""
+        if self.loaded_until is None:
+            return
+        row = change.get('new')
+        if row is None:
+            self._lessons.pop(change['old']['id'], None)
+        else:
+            self._apply(row['id'], datetime.fromisoformat(row['date']), row['isCanceled'])
+        self._arm()
+
+    async def _extend_window(self):
+        until = localtime.utc_now() + self.horizon
+        if until <= self.loaded_until:
+            return
+        rows = await get_lessons_in_window(self.pool, self.loaded_until, until)
+        self.loaded_until = until
+        for row in rows:
+            self._apply(row['id'], row['date'], row['isCanceled'])
+        self.loaded += len(rows)
+
+    async def _load_changes(self):
+        since = self.watermark - self.overlap
+        while True:
+            rows = await get_lessons_changed_since(self.pool, since, self.batch)
+            for row in rows:
+                self._apply(row['id'], row['date'], row['isCanceled'])
+            self.changes += len(rows)
+            if rows:
+                since = rows[-1]['updatedAt']
+                self.watermark = max(self.watermark, since)
+            if len(rows) < self.batch:
+                return
+
+    async def _poll_job(self, context):
+        try:
+            await self._extend_window()
+            await self._load_changes()
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Reminder poll failed: {e}")
+        now = localtime.utc_now()
+        for lesson_id in [k for k, date in self._fired.items() if date <= now]:
+            del self._fired[lesson_id]
+        self._arm()
+
+    def _arm(self):
+        # Superseded entries are dropped here so the timer targets a live one
+        while self._heap and self._lessons.get(self._heap[0][1]) != self._heap[0][2]:
+            heapq.heappop(self._heap)
+        fire_at = self._heap[0][0] if self._heap else None
+        if fire_at == self._timer_at:
+            return
+        if self._timer is not None:
+            self._timer.schedule_removal()
+            self._timer = None
+        self._timer_at = fire_at
+        if fire_at is not None:
+            delay = max(0.0, (fire_at - localtime.utc_now()).total_seconds())
+            self._timer = self._job_queue.run_once(self._fire_job, when=delay, name='reminders_fire')
+
+    async def _fire_job(self, context):
+        self._timer = None
+        self._timer_at = None
+        now = localtime.utc_now()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, lesson_id, date = heapq.heappop(self._heap)
+            if self._lessons.get(lesson_id) != date:
+                continue
+            del self._lessons[lesson_id]
+            self._fired[lesson_id] = date
+            due.append(self._remind(context.bot, lesson_id, date))
+        self.fired += len(due)
+        for result in await asyncio.gather(*due, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.errors += 1
+                logging.error(f"Lesson reminder failed: {result}")
+        self._arm()
+
+    async def _remind(self, bot, lesson_id, date):
+        key = f"reminder_{lesson_id}"
+        recipients = await get_reminder_recipients(self.pool, lesson_id, date, key)
+        if not recipients:
+            return
+        texts = {r['userId']: reminder_texts(r) for r in recipients}
+        recorded = await record_reminders(self.pool, lesson_id, key, [
+            (r['userId'], texts[r['userId']][0],
+             f"/student/lessons/{lesson_id}" if r['role'] == 'student' else f"/lessons/{lesson_id}",
+             not r['deliveryWeb'])
+            for r in recipients
+        ])
+        now = localtime.utc_now()
+        for r in recipients:
+            if r['userId'] not in recorded or not r['telegramChatId']:
+                continue
+            if in_quiet_hours(r, now):
+                self.quiet += 1
+                continue
+            try:
+                await bot.send_message(
+                    r['telegramChatId'], texts[r['userId']][1],
+                    parse_mode='Markdown', rate_limit_args=PRIORITY_BULK
+                )
+                self.sent += 1
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Reminder to {r['userId']} failed: {e}")
+
+    def stats(self):
+        return {
+            "scheduled": len(self._lessons),
+            "heap": len(self._heap),
+            "next_at": self._timer_at.isoformat() if self._timer_at else None,
+            "loaded_until": self.loaded_until.isoformat() if self.loaded_until else None,
+            "watermark": self.watermark.isoformat() if self.watermark else None,
+            "loaded": self.loaded,
+            "changes": self.changes,
+            "fired": self.fired,
+            "sent": self.sent,
+            "quiet": self.quiet,
+            "errors": self.errors
+        }
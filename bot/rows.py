@@ -0,0 +1,53 @@
+"""Row types for the bot's per-screen queries.
+
+Each type is an asyncpg.Record subclass handed to asyncpg as `record_class`,
+so rows are still built by the protocol in C with no per-row copy, and
+`__slots__ = ()` keeps them exactly as small as a plain Record. On top of
+row['col'] / row.get('col') they allow row.col. `COLUMNS` lists the fields
+the handlers read; the matching queries in db.py select only those.
+"""
+import asyncpg
+
+
+class Row(asyncpg.Record):
+    __slots__ = ()
+    COLUMNS = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    @classmethod
+    def select_list(cls, alias):
+        return ", ".join(f'{alias}."{column}"' for column in cls.COLUMNS)
+
+
+class UserRow(Row):
+    __slots__ = ()
+    COLUMNS = ('id', 'email', 'name', 'firstName', 'role', 'timezone')
+
+
+class StudentRow(Row):
+    __slots__ = ()
+    COLUMNS = ('id', 'name', 'contact', 'linkedUserId')
+
+
+class LessonRow(Row):
+    """Lesson card: own columns plus joined display names."""
+    __slots__ = ()
+    COLUMNS = ('id', 'date', 'price', 'isPaid', 'isCanceled', 'ownerId', 'studentId', 'groupId')
+
+
+class LessonRequestRow(Row):
+    """Lesson request plus the lesson and requester fields shown with it."""
+    __slots__ = ()
+    COLUMNS = ('id', 'lessonId', 'userId', 'type', 'status', 'newDate')
+
+
+class StudentScopeRow(Row):
+    """What a student-role user can see: their linked Student ids and the
+    groups those students are in. Cached per user by db.get_student_scope()."""
+    __slots__ = ()
+    COLUMNS = ('studentIds', 'groupIds')
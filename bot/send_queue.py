@@ -0,0 +1,193 @@
+"""Outbound Bot API scheduling.
+
+Plugged into PTB as the bot's rate limiter, so every request made through
+`context.bot` / `query.edit_message_text` / `reply_text` passes through it.
+
+* A global token bucket keeps the bot under Telegram's overall send rate.
+* Message-producing calls are also limited per chat (private chats and
+  groups have different limits). A request waits for its chat before it
+  joins the global queue, so one busy chat never holds up the others.
+* The global queue is ordered by priority: PRIORITY_INTERACTIVE (the
+  default, i.e. replies to a user's own action) goes ahead of
+  PRIORITY_BULK, which notification senders request with
+  `rate_limit_args=PRIORITY_BULK`.
+* On RetryAfter the chat (or, for chat-less calls, everything) is paused for
+  the requested time and the call is re-queued, up to `max_retries` times.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from metrics import Histogram
+import tracing
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+# Calls that post or change a message in a chat count against that chat's limit
+CHAT_LIMITED_PREFIXES = ("send", "edit", "copyMessage", "forwardMessage")
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def take(self, now):
+        """Consume a token and return 0, or return how long to wait for one."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self, now):
+        return now >= self.paused_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self, global_rate=25, global_burst=5, chat_rate=1, chat_burst=3,
+                 group_rate=20 / 60, group_burst=3, max_retries=3, max_chat_buckets=10000):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+        self._chats = {}  # chat_id -> TokenBucket
+        self._queue = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.queue_wait = {p: Histogram() for p in PRIORITY_NAMES}
+
+    async def initialize(self):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, waiter in self._queue:
+            if not waiter.done():
+                waiter.cancel()
+        self._queue.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_BULK if rate_limit_args == PRIORITY_BULK else PRIORITY_INTERACTIVE
+        chat_id = data.get("chat_id") if endpoint.startswith(CHAT_LIMITED_PREFIXES) else None
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            if chat_id is not None:
+                await self._wait_chat(chat_id)
+            await self._wait_global(priority)
+            sending = time.perf_counter()
+            self.queue_wait[priority].observe(sending - started)
+            try:
+                try:
+                    result = await callback(*args, **kwargs)
+                finally:
+                    tracing.record_api(time.perf_counter() - sending, sending - started)
+            except RetryAfter as exc:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    logging.error(f"{endpoint} still flood limited after {attempt} retries")
+                    raise
+                self.retries += 1
+                retry_after = exc.retry_after  # int seconds or timedelta, depending on the PTB version
+                delay = (retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after) + 0.1
+                logging.info(f"{endpoint} flood limited, retrying in {delay:.1f}s")
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(delay)
+                else:
+                    self.global_bucket.pause(delay)
+                continue
+            self.sent += 1
+            return result
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chat_buckets:
+                now = time.monotonic()
+                for key in [k for k, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[key]
+            # Negative ids (and @usernames) are groups and channels
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(
+                self.group_rate if is_group else self.chat_rate,
+                self.group_burst if is_group else self.chat_burst
+            )
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _wait_chat(self, chat_id):
+        bucket = self._chat_bucket(chat_id)
+        while (delay := bucket.take(time.monotonic())) > 0:
+            await asyncio.sleep(delay)
+
+    async def _wait_global(self, priority):
+        if self._dispatcher is None:
+            await self.initialize()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+        self._wakeup.set()
+        await waiter
+
+    async def _dispatch(self):
+        # Hands out global tokens strictly in (priority, arrival) order
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self.global_bucket.take(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, waiter = heapq.heappop(self._queue)
+            if waiter.done():
+                # Caller went away (cancelled); give the token back
+                self.global_bucket.tokens += 1
+            else:
+                waiter.set_result(None)
+
+    def stats(self):
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _ in self._queue:
+            depth[PRIORITY_NAMES[priority]] += 1
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "queued": depth,
+            "chats_tracked": len(self._chats),
+            "queue_wait": {PRIORITY_NAMES[p]: h.stats() for p, h in self.queue_wait.items()}
+        }
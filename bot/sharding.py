@@ -0,0 +1,219 @@
+"""Multi-process mode: one ingress process, N bot worker processes.
+
+The ingress is the only process receiving updates from Telegram (polling or
+webhook, through PTB's Updater). It routes every update by a consistent hash
+of its chat id to one of the workers over a multiprocessing queue, so all
+updates of a chat land on the same worker in arrival order, where
+ChatOrderedUpdateProcessor keeps them ordered. Each worker's caches (users,
+stats, subscriptions, keyboards) then only hold its own chats, and changing
+the worker count moves only about 1/N of the chats to another worker.
+
+Every worker is a full Application built by `app_factory`
+(main.build_application by default) with its own DB pool, job queue and
+outbound rate limiter. Two settings are adjusted per worker:
+- SEND_GLOBAL_RATE is divided between the workers so that together they stay
+  under Telegram's global limit;
+- only worker 0 schedules lesson reminders.
+A worker that dies is restarted on the same queue.
+"""
+import asyncio
+import bisect
+import hashlib
+import importlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from telegram import Bot, Update
+from telegram.ext import Updater
+from update_processor import update_chat_key
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, `vnodes` points per node."""
+
+    def __init__(self, nodes, vnodes=64):
+        self._ring = sorted((_hash(f"{node}:{i}"), node) for node in nodes for i in range(vnodes))
+        self._points = [point for point, _ in self._ring]
+
+    def node_for(self, key):
+        i = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._ring[i][1]
+
+
+def _worker_main(index, count, app_factory, updates, events):
+    # Ctrl+C reaches the whole process group; the ingress stops workers itself
+    # once it has routed what it received
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ["SEND_GLOBAL_RATE"] = str(float(os.getenv("SEND_GLOBAL_RATE", "25")) / count)
+    if index:
+        os.environ["REMINDERS_ENABLED"] = "0"
+    if os.getenv("METRICS_PORT"):
+        # One scrape target per worker: METRICS_PORT, METRICS_PORT+1, ...
+        os.environ["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + index)
+    if os.getenv("DB_SLOW_QUERY_MS"):
+        # File rotation isn't safe across processes: one slow-query log per worker
+        os.environ["DB_SLOW_QUERY_LOG"] = f"{os.getenv('DB_SLOW_QUERY_LOG', 'slow_queries.log')}.{index}"
+    module, _, name = app_factory.partition(':')
+    app = getattr(importlib.import_module(module), name)()
+    asyncio.run(_run_worker(index, app, updates, events))
+
+
+async def _run_worker(index, app, updates, events):
+    loop = asyncio.get_running_loop()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    drained = asyncio.Event()
+
+    def enqueue(data):
+        if data is None:
+            drained.set()
+        else:
+            app.update_queue.put_nowait(Update.de_json(data, app.bot))
+
+    def read():
+        while True:
+            data = updates.get()
+            loop.call_soon_threadsafe(enqueue, data)
+            if data is None:
+                return
+
+    threading.Thread(target=read, name=f"bot-worker-{index}-reader", daemon=True).start()
+    events.put((index, 'ready', None))
+    await drained.wait()
+    await app.stop()
+    if app.post_stop:
+        await app.post_stop(app)
+    stats = app.update_processor.stats() if hasattr(app.update_processor, 'stats') else None
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+    events.put((index, 'stopped', stats))
+
+
+class ShardedRunner:
+    def __init__(self, count, app_factory="main:build_application", vnodes=64, queue_size=10000):
+        self.count = count
+        self.app_factory = app_factory
+        self.ring = HashRing(range(count), vnodes)
+        self._ctx = multiprocessing.get_context('spawn')
+        self.events = self._ctx.Queue()
+        self.queues = [self._ctx.Queue(queue_size) for _ in range(count)]
+        self.procs = [None] * count
+        self.routed = [0] * count
+        self.restarts = 0
+        self.worker_stats = {}
+        self._stopping = False
+
+    def start_workers(self):
+        for index in range(self.count):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        proc = self._ctx.Process(
+            target=_worker_main, name=f"bot-worker-{index}",
+            args=(index, self.count, self.app_factory, self.queues[index], self.events)
+        )
+        proc.start()
+        self.procs[index] = proc
+
+    async def wait_ready(self, timeout=60):
+        ready = set()
+        while len(ready) < self.count:
+            index, event, _ = await asyncio.to_thread(self.events.get, timeout=timeout)
+            if event == 'ready':
+                ready.add(index)
+
+    def worker_for(self, update):
+        key = update_chat_key(update)
+        return self.ring.node_for(key if key is not None else update.update_id)
+
+    async def route(self, update):
+        index = self.worker_for(update)
+        data = update.to_dict()
+        try:
+            self.queues[index].put_nowait(data)
+        except queue.Full:
+            await asyncio.to_thread(self.queues[index].put, data)
+        self.routed[index] += 1
+
+    def check_workers(self):
+        for index, proc in enumerate(self.procs):
+            if not self._stopping and not proc.is_alive():
+                logging.error(f"Bot worker {index} exited with {proc.exitcode}, restarting")
+                self.restarts += 1
+                self._spawn(index)
+
+    async def stop_workers(self, timeout=30):
+        self._stopping = True
+        for q in self.queues:
+            q.put(None)
+        for proc in self.procs:
+            await asyncio.to_thread(proc.join, timeout)
+            if proc.is_alive():
+                logging.error(f"Bot worker {proc.name} did not stop in {timeout}s, terminating")
+                proc.terminate()
+        while True:
+            try:
+                index, event, stats = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event == 'stopped':
+                self.worker_stats[index] = stats
+
+    def stats(self):
+        return {
+            "workers": self.count,
+            "alive": sum(1 for proc in self.procs if proc is not None and proc.is_alive()),
+            "routed": list(self.routed),
+            "restarts": self.restarts
+        }
+
+
+async def _serve(runner, bot, webhook):
+    runner.start_workers()
+    await runner.wait_ready()
+    logging.info(f"{runner.count} bot workers ready")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    updater = Updater(bot, asyncio.Queue())
+
+    async def route_updates():
+        while True:
+            await runner.route(await updater.update_queue.get())
+
+    async with updater:
+        if webhook:
+            await updater.start_webhook(**webhook)
+        else:
+            await updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        router = asyncio.create_task(route_updates())
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), 5)
+            except asyncio.TimeoutError:
+                runner.check_workers()
+        await updater.stop()
+        router.cancel()
+        while not updater.update_queue.empty():
+            await runner.route(updater.update_queue.get_nowait())
+    await runner.stop_workers()
+    logging.info(f"Bot workers stopped: {runner.stats()}")
+
+
+def run_sharded(count, token, webhook=None, base_url=None, base_file_url=None, app_factory="main:build_application"):
+    """Run the ingress in this process and `count` workers. `webhook` holds
+    Updater.start_webhook() arguments; without it the ingress polls."""
+    kwargs = {"base_url": base_url, "base_file_url": base_file_url or base_url} if base_url else {}
+    runner = ShardedRunner(count, app_factory)
+    asyncio.run(_serve(runner, Bot(token, **kwargs), webhook))
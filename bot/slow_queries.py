@@ -0,0 +1,142 @@
+"""Opt-in slow-query log with EXPLAIN capture.
+
+Every statement runs through queries.Query, which hands those slower than
+`threshold` to `SlowQueryLog.record()`. A background task then writes one
+JSON line to a local file: the query name, redacted parameters, duration, the
+trace id of the update that ran it and the plan of the same statement with
+the same parameters, for offline analysis.
+
+Read-only statements are re-run under EXPLAIN (ANALYZE, BUFFERS) in a
+read-only transaction that is rolled back. Statements that write are only
+EXPLAINed, not executed: running them again, even in a rolled-back
+transaction, would take row locks the original transaction may still hold.
+The plan is of a fresh unnamed statement, i.e. a custom plan for these
+parameters; a prepared statement may be on a generic plan by then.
+
+Capture is rate-limited per query name (one per `interval` seconds) and to
+one EXPLAIN at a time, so a slow database isn't loaded further by the log.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from datetime import date, datetime
+from logging.handlers import RotatingFileHandler
+import tracing
+
+READ_ONLY_PREFIXES = ("SELECT", "WITH", "VALUES")
+
+
+def _redact(value):
+    """Keep what helps reading a plan (types, sizes, dates, small numbers), drop identifying values."""
+    if value is None or isinstance(value, (bool, float)):
+        return value
+    if isinstance(value, int):
+        return value if abs(value) < 10**6 else "<int>"
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, str):
+        return f"<str:{len(value)}>"
+    if isinstance(value, (list, tuple)):
+        return f"<{type(value).__name__}:{len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def is_read_only(sql):
+    head = sql.lstrip().upper()
+    return head.startswith(READ_ONLY_PREFIXES) and not any(
+        word in head for word in ("INSERT ", "UPDATE ", "DELETE ", "FOR UPDATE", "FOR SHARE")
+    )
+
+
+class SlowQueryLog:
+    def __init__(self, pool, path, threshold, interval=300.0, explain=True, explain_timeout=10.0,
+                 max_bytes=10 * 1024 * 1024, backups=3):
+        self.pool = pool
+        self.path = path
+        self.threshold = threshold
+        self.interval = interval
+        self.explain = explain
+        self.explain_timeout = explain_timeout
+        self.logger = logging.getLogger('bot.slow_queries')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(self._handler)
+        self._last = {}  # query name -> monotonic time of the last capture
+        self._task = None
+        self.slow = 0
+        self.captured = 0
+        self.suppressed = 0
+        self.errors = 0
+
+    def record(self, query, args, elapsed):
+        self.slow += 1
+        now = time.monotonic()
+        last = self._last.get(query.name)
+        if (last is not None and now - last < self.interval) or (self._task is not None and not self._task.done()):
+            self.suppressed += 1
+            return
+        self._last[query.name] = now
+        trace = tracing.current()
+        # A fresh context, so the capture's pool wait isn't added to the update's trace
+        self._task = asyncio.get_running_loop().create_task(
+            self._capture(query.name, query.sql, args, elapsed, trace.id if trace else None),
+            context=contextvars.Context()
+        )
+
+    async def _capture(self, name, sql, args, elapsed, trace_id):
+        entry = {
+            "at": datetime.utcnow().isoformat(timespec='milliseconds') + "Z",
+            "query": name,
+            "duration_ms": round(elapsed * 1000, 2),
+            "params": [_redact(v) for v in args],
+            "trace_id": trace_id,
+            "analyzed": False,
+            "plan": None
+        }
+        if self.explain:
+            try:
+                entry["analyzed"], entry["plan"] = await self._explain(sql, args)
+            except Exception as e:
+                self.errors += 1
+                entry["explain_error"] = repr(e)
+        self.captured += 1
+        try:
+            await asyncio.to_thread(self.logger.info, json.dumps(entry, ensure_ascii=False, default=str))
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Slow query log write failed: {e}")
+
+    async def _explain(self, sql, args):
+        analyze = is_read_only(sql)
+        options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+        async with self.pool.acquire() as conn:
+            tx = conn.transaction(readonly=True)
+            await tx.start()
+            try:
+                await conn.execute(f"SET LOCAL statement_timeout = {int(self.explain_timeout * 1000)}")
+                plan = await conn.fetchval(f"EXPLAIN ({options}) {sql}", *args)
+            finally:
+                await tx.rollback()
+        return analyze, json.loads(plan)
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), self.explain_timeout)
+            except Exception:
+                self._task.cancel()
+        self.logger.removeHandler(self._handler)
+        self._handler.close()
+
+    def stats(self):
+        return {
+            "threshold_ms": round(self.threshold * 1000, 3),
+            "slow": self.slow,
+            "captured": self.captured,
+            "suppressed": self.suppressed,
+            "errors": self.errors
+        }
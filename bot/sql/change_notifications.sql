@@ -0,0 +1,56 @@
+-- Change notifications for the bot's caches (see bot/invalidation.py).
+--
+-- Every watched table gets an AFTER row trigger that publishes the changed
+-- row's relevant columns on the "bot_cache" channel:
+--   {"t": <table>, "op": INSERT|UPDATE|DELETE, "old": {...}, "new": {...}}
+-- Updates that don't touch those columns publish nothing. Notifications are
+-- delivered on commit, and identical ones within a transaction are merged.
+--
+-- Idempotent; apply with:  psql "$DATABASE_URL" -f bot/sql/change_notifications.sql
+
+CREATE OR REPLACE FUNCTION bot_notify_change() RETURNS trigger AS $$
+DECLARE
+    cols text[] := TG_ARGV;
+    old_row jsonb;
+    new_row jsonb;
+    payload jsonb := jsonb_build_object('t', TG_TABLE_NAME, 'op', TG_OP);
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        SELECT jsonb_object_agg(key, value) INTO old_row FROM jsonb_each(to_jsonb(OLD)) WHERE key = ANY(cols);
+        payload := payload || jsonb_build_object('old', old_row);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        SELECT jsonb_object_agg(key, value) INTO new_row FROM jsonb_each(to_jsonb(NEW)) WHERE key = ANY(cols);
+        payload := payload || jsonb_build_object('new', new_row);
+    END IF;
+    IF TG_OP = 'UPDATE' AND old_row = new_row THEN
+        RETURN NULL;
+    END IF;
+    PERFORM pg_notify('bot_cache', payload::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS bot_cache_lesson ON "Lesson";
+CREATE TRIGGER bot_cache_lesson AFTER INSERT OR UPDATE OR DELETE ON "Lesson"
+    FOR EACH ROW EXECUTE FUNCTION bot_notify_change('id', 'ownerId', 'studentId', 'groupId', 'date', 'price', 'isPaid', 'isCanceled');
+
+DROP TRIGGER IF EXISTS bot_cache_lesson_payment ON "LessonPayment";
+CREATE TRIGGER bot_cache_lesson_payment AFTER INSERT OR UPDATE OR DELETE ON "LessonPayment"
+    FOR EACH ROW EXECUTE FUNCTION bot_notify_change('lessonId', 'studentId', 'hasPaid');
+
+DROP TRIGGER IF EXISTS bot_cache_user ON "User";
+CREATE TRIGGER bot_cache_user AFTER INSERT OR UPDATE OR DELETE ON "User"
+    FOR EACH ROW EXECUTE FUNCTION bot_notify_change('id', 'telegramId', 'email', 'name', 'firstName', 'role', 'timezone');
+
+DROP TRIGGER IF EXISTS bot_cache_student ON "Student";
+CREATE TRIGGER bot_cache_student AFTER INSERT OR UPDATE OR DELETE ON "Student"
+    FOR EACH ROW EXECUTE FUNCTION bot_notify_change('id', 'ownerId', 'linkedUserId');
+
+DROP TRIGGER IF EXISTS bot_cache_group_students ON "_GroupToStudent";
+CREATE TRIGGER bot_cache_group_students AFTER INSERT OR UPDATE OR DELETE ON "_GroupToStudent"
+    FOR EACH ROW EXECUTE FUNCTION bot_notify_change('A', 'B');
+
+-- "LessonRequest" has no trigger: no cached value is read from it. Creating,
+-- approving or rejecting a request also updates its "Lesson" row, and the
+-- lesson trigger above covers that part.
@@ -0,0 +1,222 @@
+"""Short-lived conversation state (pending e-mail links, reschedules).
+
+Every store is split into namespaces, one per flow, and entries expire `ttl`
+seconds after they were last set. A namespace never holds more than `maxsize`
+live entries: the memory backend evicts the least recently used one on
+insert, the persistent backends drop the entries closest to expiry in
+`purge()`, which the bot runs from the job queue along with removing expired
+rows. Keys are stored as strings and values must be JSON-serialisable.
+
+* "memory" (default): per-process LRU, lost on restart.
+* "sqlite": a local file, survives restarts of a single bot process.
+* "postgres": the bot's own database, shared by every replica. The table is
+  the BotState model in prisma/schema.prisma; apply the migrations first.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from cache import TTLCache
+from queries import query
+
+
+class MemoryStateStore:
+    def __init__(self, namespace, ttl, maxsize=10000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def start(self):
+        pass
+
+    async def get(self, key, default=None):
+        return self._cache.get(str(key), default)
+
+    async def set(self, key, value):
+        self._cache.set(str(key), value)
+
+    async def delete(self, key):
+        return self._cache.invalidate(str(key)) is not None
+
+    async def purge(self):
+        # Expired entries are dropped on access and bounded by the LRU
+        return 0
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {"backend": "memory", **self._cache.stats()}
+
+
+class SQLiteStateStore:
+    """State in a local SQLite file. Calls run in a worker thread so a slow
+    disk never stalls the event loop."""
+
+    def __init__(self, namespace, ttl, maxsize=10000, path="bot_state.sqlite3"):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.path = path
+        self.purged = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    async def start(self):
+        await asyncio.to_thread(self._open)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS bot_state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS bot_state_expires ON bot_state (namespace, expires_at)')
+        self._conn = conn
+
+    async def _run(self, sql, params):
+        def run():
+            with self._lock:
+                cur = self._conn.execute(sql, params)
+                return cur.fetchone(), cur.rowcount
+        return await asyncio.to_thread(run)
+
+    async def get(self, key, default=None):
+        row, _ = await self._run(
+            'SELECT value FROM bot_state WHERE namespace = ? AND key = ? AND expires_at > ?',
+            (self.namespace, str(key), time.time())
+        )
+        return json.loads(row[0]) if row else default
+
+    async def set(self, key, value):
+        await self._run('''
+            INSERT INTO bot_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+        ''', (self.namespace, str(key), json.dumps(value), time.time() + self.ttl))
+
+    async def delete(self, key):
+        _, count = await self._run(
+            'DELETE FROM bot_state WHERE namespace = ? AND key = ? AND expires_at > ?',
+            (self.namespace, str(key), time.time())
+        )
+        return count > 0
+
+    async def purge(self):
+        now = time.time()
+        _, expired = await self._run(
+            'DELETE FROM bot_state WHERE namespace = ? AND expires_at <= ?', (self.namespace, now)
+        )
+        _, overflow = await self._run('''
+            DELETE FROM bot_state WHERE namespace = ? AND key IN (
+                SELECT key FROM bot_state WHERE namespace = ?
+                ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.namespace, self.namespace, self.maxsize))
+        self.purged += expired + overflow
+        return expired + overflow
+
+    async def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stats(self):
+        return {"backend": "sqlite", "purged": self.purged}
+
+
+Q_STATE_GET = query('state_get', '''
+    SELECT "value" FROM "BotState"
+    WHERE "namespace" = $1 AND "key" = $2 AND "expiresAt" > NOW() AT TIME ZONE 'UTC'
+''')
+Q_STATE_SET = query('state_set', '''
+    INSERT INTO "BotState" ("namespace", "key", "value", "expiresAt")
+    VALUES ($1, $2, $3, NOW() AT TIME ZONE 'UTC' + make_interval(secs => $4))
+    ON CONFLICT ("namespace", "key") DO UPDATE
+    SET "value" = EXCLUDED."value", "expiresAt" = EXCLUDED."expiresAt"
+''')
+Q_STATE_DELETE = query('state_delete', '''
+    DELETE FROM "BotState"
+    WHERE "namespace" = $1 AND "key" = $2 AND "expiresAt" > NOW() AT TIME ZONE 'UTC'
+    RETURNING 1
+''')
+Q_STATE_PURGE = query('state_purge', '''
+    WITH expired AS (
+        DELETE FROM "BotState" WHERE "namespace" = $1 AND "expiresAt" <= NOW() AT TIME ZONE 'UTC'
+        RETURNING 1
+    ), overflow AS (
+        DELETE FROM "BotState" WHERE "namespace" = $1 AND "key" IN (
+            SELECT "key" FROM "BotState"
+            WHERE "namespace" = $1 AND "expiresAt" > NOW() AT TIME ZONE 'UTC'
+            ORDER BY "expiresAt" DESC OFFSET $2
+        )
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM expired) + (SELECT COUNT(*) FROM overflow)
+''')
+
+
+class PostgresStateStore:
+    """State in the bot's database, so every replica sees the same entries.
+    The "BotState" table comes from the Prisma migrations."""
+
+    def __init__(self, namespace, ttl, maxsize=10000, pool=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.pool = pool
+        self.purged = 0
+
+    async def start(self):
+        pass
+
+    async def get(self, key, default=None):
+        async with self.pool.acquire() as conn:
+            value = await Q_STATE_GET.fetchval(conn, self.namespace, str(key))
+        return json.loads(value) if value is not None else default
+
+    async def set(self, key, value):
+        async with self.pool.acquire() as conn:
+            await Q_STATE_SET.execute(conn, self.namespace, str(key), json.dumps(value), float(self.ttl))
+
+    async def delete(self, key):
+        async with self.pool.acquire() as conn:
+            deleted = await Q_STATE_DELETE.fetchval(conn, self.namespace, str(key))
+        return deleted is not None
+
+    async def purge(self):
+        async with self.pool.acquire() as conn:
+            count = await Q_STATE_PURGE.fetchval(conn, self.namespace, self.maxsize)
+        self.purged += count
+        return count
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {"backend": "postgres", "purged": self.purged}
+
+
+BACKENDS = {
+    "memory": MemoryStateStore,
+    "sqlite": SQLiteStateStore,
+    "postgres": PostgresStateStore,
+}
+
+
+def open_state_store(backend, namespace, ttl, maxsize=10000, **options):
+    """Create a store for one flow. `options` go to the backend: `path` for
+    sqlite, `pool` for postgres."""
+    try:
+        cls = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown state backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    return cls(namespace, ttl, maxsize, **options)
@@ -0,0 +1,115 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import OrderedDict
+
+
+class SubscriptionCache:
+    """Channel membership per Telegram user, so get_chat_member isn't called
+    on every /start or "I subscribed" tap.
+
+    Members are remembered for `positive_ttl`, non-members only for
+    `negative_ttl` so a fresh subscription is noticed quickly. Failed lookups
+    fail open (as before) and are cached like a non-member result, so an
+    outage doesn't turn into one API call per update. Concurrent lookups for
+    the same user share one call. `refresh_expiring()` (run from the job
+    queue) re-checks members of recently active users shortly before their
+    entry expires, so they rarely hit a miss.
+    """
+
+    def __init__(self, channel_id, maxsize=50000, positive_ttl=3600, negative_ttl=30,
+                 refresh_ahead=300, refresh_batch=50):
+        self.channel_id = channel_id
+        self.maxsize = maxsize
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.refresh_batch = refresh_batch
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.api_calls = 0
+        self.errors = 0
+        self.refreshed = 0
+        self._entries = OrderedDict()  # user_id -> [expires_at, subscribed, last_used]
+        self._inflight = {}  # user_id -> asyncio.Task
+
+    async def is_subscribed(self, bot, user_id, recheck_negative=False):
+        entry = self._entries.get(user_id)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now and (entry[1] or not recheck_negative):
+            entry[2] = now
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return await asyncio.shield(self._lookup(bot, user_id))
+
+    def _lookup(self, bot, user_id, rate_limit_args=None):
+        task = self._inflight.get(user_id)
+        if task is not None:
+            self.coalesced += 1
+            return task
+        task = asyncio.ensure_future(self._fetch(bot, user_id, rate_limit_args))
+        self._inflight[user_id] = task
+        task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        return task
+
+    async def _fetch(self, bot, user_id, rate_limit_args):
+        self.api_calls += 1
+        try:
+            if rate_limit_args is None:
+                member = await bot.get_chat_member(chat_id=self.channel_id, user_id=user_id)
+            else:
+                member = await bot.get_chat_member(chat_id=self.channel_id, user_id=user_id, rate_limit_args=rate_limit_args)
+        except Exception as e:
+            self.errors += 1
+            if "Chat not found" not in str(e): logging.error(f"Subscription check error: {e}")
+            self._store(user_id, True, self.negative_ttl)
+            return True
+        subscribed = member.status not in ('left', 'kicked')
+        self._store(user_id, subscribed, self.positive_ttl if subscribed else self.negative_ttl)
+        return subscribed
+
+    def _store(self, user_id, subscribed, ttl):
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        last_used = entry[2] if entry is not None else now
+        self._entries[user_id] = [now + ttl, subscribed, last_used]
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    async def refresh_expiring(self, bot, rate_limit_args=None):
+        """Re-check up to `refresh_batch` members whose entries expire within
+        `refresh_ahead`, soonest first. Users idle for longer than a full TTL
+        are left to expire. `rate_limit_args` is passed to the bot's rate
+        limiter (e.g. to send these behind interactive traffic)."""
+        now = time.monotonic()
+        due = heapq.nsmallest(self.refresh_batch, (
+            (entry[0], user_id) for user_id, entry in self._entries.items()
+            if entry[1] and entry[0] - now < self.refresh_ahead and now - entry[2] < self.positive_ttl
+        ))
+        if not due:
+            return 0
+        await asyncio.gather(*(self._lookup(bot, user_id, rate_limit_args) for _, user_id in due), return_exceptions=True)
+        self.refreshed += len(due)
+        return len(due)
+
+    async def refresh_job(self, context):
+        await self.refresh_expiring(context.bot, context.job.data)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "api_calls": self.api_calls,
+            "api_calls_avoided": self.hits + self.coalesced,
+            "errors": self.errors,
+            "refreshed": self.refreshed
+        }
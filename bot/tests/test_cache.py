@@ -0,0 +1,159 @@
+"""TTLCache expiry and LRU eviction, and StaleWhileRevalidateCache serving."""
+import asyncio
+import pytest
+import cache
+from cache import TTLCache, StaleWhileRevalidateCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Only the cache module's clock: the event loop keeps the real one
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+def test_ttl_expiry(clock):
+    c = TTLCache(maxsize=10, ttl=60)
+    c.set("a", 1)
+    clock.now += 59
+    assert c.get("a") == 1
+    clock.now += 1
+    assert c.get("a") is None
+    assert len(c) == 0
+    assert c.stats() == {"size": 0, "hits": 1, "misses": 1}
+
+
+def test_lru_eviction(clock):
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    assert c.get("a") == 1  # "b" is now the least recently used
+    c.set("c", 3)
+    assert c.get("b") is None
+    assert c.get("a") == 1 and c.get("c") == 3
+
+
+def test_invalidate_where(clock):
+    c = TTLCache()
+    for i in range(5):
+        c.set(i, {"owner": i % 2})
+    assert c.invalidate_where(lambda v: v["owner"] == 1) == 2
+    assert sorted(c._data) == [0, 2, 4]
+    assert c.invalidate(0) == {"owner": 0}
+    assert c.invalidate(0) is None
+
+
+class Loader:
+    def __init__(self, *values, delay=0):
+        self.values = list(values)
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        value = self.values.pop(0)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+def test_swr_fresh_then_refreshed(clock):
+    async def scenario():
+        c = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=900, refresh_timeout=0.5)
+        load = Loader("v1", "v2")
+        assert await c.get("k", 1, load) == "v1"
+        clock.now += 30
+        assert await c.get("k", 1, load) == "v1"
+        assert load.calls == 1
+        clock.now += 60
+        # Stale, but the refresh answers within the timeout
+        assert await c.get("k", 1, load) == "v2"
+        return c.stats()
+
+    assert asyncio.run(scenario()) == {"size": 1, "hits": 1, "stale_hits": 0, "misses": 1}
+
+
+def test_swr_serves_stale_while_refresh_is_slow(clock):
+    async def scenario():
+        c = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=900, refresh_timeout=0.01)
+        assert await c.get("k", 1, Loader("v1")) == "v1"
+        clock.now += 120
+        slow = Loader("v2", delay=0.05)
+        assert await c.get("k", 1, slow) == "v1"
+        assert await c.get("k", 1, slow) == "v1"
+        assert slow.calls == 1  # the second caller joined the running refresh
+        await asyncio.sleep(0.1)
+        assert await c.get("k", 1, slow) == "v2"
+        return c.stats()
+
+    assert asyncio.run(scenario())["stale_hits"] == 2
+
+
+def test_swr_serves_stale_when_refresh_fails(clock):
+    async def scenario():
+        c = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=900)
+        assert await c.get("k", 1, Loader("v1")) == "v1"
+        clock.now += 120
+        return await c.get("k", 1, Loader(RuntimeError("db down")))
+
+    assert asyncio.run(scenario()) == "v1"
+
+
+def test_swr_too_old_or_new_version_is_a_miss(clock):
+    async def scenario():
+        c = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=900)
+        assert await c.get("k", 1, Loader("v1")) == "v1"
+        assert await c.get("k", 2, Loader("day2")) == "day2"
+        clock.now += 1000
+        assert await c.get("k", 2, Loader("later")) == "later"
+        return c.stats()
+
+    assert asyncio.run(scenario())["misses"] == 3
+
+
+def test_swr_loads_per_version_and_old_version_does_not_overwrite(clock):
+    async def scenario():
+        c = StaleWhileRevalidateCache(fresh_ttl=60, stale_ttl=900)
+        yesterday = asyncio.ensure_future(c.get("k", 1, Loader("yesterday", delay=0.05)))
+        await asyncio.sleep(0)
+        clock.now += 1
+        # A caller for the new version gets its own load, not yesterday's
+        assert await c.get("k", 2, Loader("today")) == "today"
+        assert await yesterday == "yesterday"
+        return c._data["k"][1:]
+
+    assert asyncio.run(scenario()) == (2, "today")
+
+
+def test_swr_invalidate_drops_in_flight_load(clock):
+    async def scenario():
+        c = StaleWhileRevalidateCache()
+        pending = asyncio.ensure_future(c.get("k", 1, Loader("before", delay=0.05)))
+        await asyncio.sleep(0)
+        c.invalidate("k")
+        assert await pending == "before"
+        # The detached load didn't store its result
+        assert len(c) == 0
+        assert await c.get("k", 1, Loader("after")) == "after"
+
+    asyncio.run(scenario())
+
+
+def test_swr_maxsize(clock):
+    async def scenario():
+        c = StaleWhileRevalidateCache(maxsize=2)
+        for key in "abc":
+            await c.get(key, 1, Loader(key))
+        return list(c._data)
+
+    assert asyncio.run(scenario()) == ["b", "c"]
@@ -0,0 +1,163 @@
+"""Parity of the teacher dashboard statement with the per-lesson loop it replaced.
+
+Needs a Postgres to run against; the tables are created in a throwaway
+schema that is dropped afterwards, so any database will do:
+
+    TEST_DATABASE_URL=postgres://localhost/postgres python -m pytest tests
+"""
+import asyncio
+import os
+from datetime import date, timedelta
+import pytest
+import asyncpg
+import db
+import localtime
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+TZ = "Europe/Moscow"
+TODAY = date(2026, 3, 15)
+TEACHER = "t1"
+
+SCHEMA = '''
+    CREATE TABLE "Student" (id TEXT PRIMARY KEY, "ownerId" TEXT NOT NULL);
+    CREATE TABLE "Lesson" (
+        id TEXT PRIMARY KEY, date TIMESTAMP(3) NOT NULL, price INTEGER NOT NULL,
+        "isPaid" BOOLEAN NOT NULL, "isCanceled" BOOLEAN NOT NULL,
+        "ownerId" TEXT NOT NULL, "groupId" TEXT
+    );
+    CREATE TABLE "LessonPayment" (id TEXT PRIMARY KEY, "lessonId" TEXT NOT NULL, "hasPaid" BOOLEAN NOT NULL);
+'''
+
+
+def fixture_rows():
+    today_start, today_end = localtime.day_window(TZ, TODAY)
+    month = localtime.month_start(TZ, TODAY)
+    ms = timedelta(milliseconds=1)
+    students = [("s1", TEACHER), ("s2", TEACHER), ("s3", TEACHER), ("x1", "t2")]
+    # (id, date, price, isPaid, isCanceled, ownerId, groupId)
+    lessons = [
+        # individual lessons
+        ("paid_today_start", today_start, 1000, True, False, TEACHER, None),
+        ("paid_today_last_ms", today_end - ms, 1200, True, False, TEACHER, None),
+        ("paid_today_end", today_end, 1500, True, False, TEACHER, None),  # tomorrow: month only
+        ("unpaid_today", today_start + timedelta(hours=10), 1800, False, False, TEACHER, None),
+        ("canceled_paid_today", today_start + timedelta(hours=11), 2000, True, True, TEACHER, None),
+        ("paid_month_start", month, 2500, True, False, TEACHER, None),
+        ("paid_before_month", month - ms, 3000, True, False, TEACHER, None),
+        ("other_teacher_today", today_start + timedelta(hours=9), 9999, True, False, "t2", None),
+        # group lessons
+        ("group_partial_today", today_start + timedelta(hours=12), 700, False, False, TEACHER, "g1"),
+        ("group_all_paid_month", month + timedelta(days=3), 800, True, False, TEACHER, "g1"),
+        ("group_none_paid_today", today_start + timedelta(hours=13), 900, False, False, TEACHER, "g1"),
+        ("group_paid_flag_no_payments", today_start + timedelta(hours=14), 600, True, False, TEACHER, "g2"),
+        ("group_partial_month_start", month, 500, False, False, TEACHER, "g2"),
+        ("group_partial_before_month", month - ms, 400, False, False, TEACHER, "g2"),
+        ("group_canceled_paid", today_start + timedelta(hours=15), 300, False, True, TEACHER, "g1"),
+    ]
+    payments = [
+        ("p1", "group_partial_today", True), ("p2", "group_partial_today", True), ("p3", "group_partial_today", False),
+        ("p4", "group_all_paid_month", True), ("p5", "group_all_paid_month", True), ("p6", "group_all_paid_month", True),
+        ("p7", "group_none_paid_today", False), ("p8", "group_none_paid_today", False),
+        ("p9", "group_partial_month_start", True), ("p10", "group_partial_month_start", False),
+        ("p11", "group_partial_before_month", True),
+        ("p12", "group_canceled_paid", True),
+    ]
+    return students, lessons, payments
+
+
+async def old_dashboard_stats(conn, user_id, user_tz):
+    """The loop get_dashboard_stats ran before it became one statement."""
+    today = localtime.local_today(user_tz)
+    today_start_utc, today_end_utc = localtime.day_window(user_tz, today)
+    sync_month_start = localtime.month_start(user_tz, today)
+    students = await conn.fetchval('SELECT COUNT(*) FROM "Student" WHERE "ownerId" = $1', user_id)
+    lessons_today = await conn.fetchval(
+        'SELECT COUNT(*) FROM "Lesson" WHERE "ownerId" = $1 AND date >= $2 AND date < $3 AND "isCanceled" = false',
+        user_id, today_start_utc, today_end_utc
+    )
+    lessons = await conn.fetch('''
+        SELECT l.id, l.price, l."isPaid", l."groupId", l.date
+        FROM "Lesson" l
+        WHERE l."ownerId" = $1
+          AND l.date >= $2
+          AND l."isCanceled" = false
+          AND (
+              l."isPaid" = true
+              OR EXISTS (SELECT 1 FROM "LessonPayment" lp WHERE lp."lessonId" = l.id AND lp."hasPaid" = true)
+          )
+    ''', user_id, sync_month_start)
+    income_month = 0
+    income_today = 0
+    for lesson in lessons:
+        is_today = today_start_utc <= lesson['date'] < today_end_utc
+        if lesson['groupId']:
+            paid_count = await conn.fetchval(
+                'SELECT COUNT(*) FROM "LessonPayment" WHERE "lessonId" = $1 AND "hasPaid" = true',
+                lesson['id']
+            )
+            l_income = (paid_count or 0) * lesson['price']
+        else:
+            l_income = lesson['price']
+        income_month += l_income
+        if is_today:
+            income_today += l_income
+    return {
+        "students": students,
+        "lessons_today": lessons_today,
+        "income": income_month,
+        "income_today": income_today
+    }
+
+
+class _Pool:
+    """Hands db.py the test connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+async def _compare(user_id):
+    conn = await asyncpg.connect(TEST_DATABASE_URL)
+    schema = f"dashboard_parity_{os.getpid()}"
+    try:
+        await conn.execute(f'CREATE SCHEMA "{schema}"; SET search_path TO "{schema}"')
+        await conn.execute(SCHEMA)
+        students, lessons, payments = fixture_rows()
+        await conn.copy_records_to_table("Student", records=students, schema_name=schema)
+        await conn.copy_records_to_table("Lesson", records=lessons, schema_name=schema)
+        await conn.copy_records_to_table("LessonPayment", records=payments, schema_name=schema)
+        old = await old_dashboard_stats(conn, user_id, TZ)
+        new = await db._query_dashboard_stats(_Pool(conn), user_id, TZ)
+        return old, new
+    finally:
+        await conn.execute(f'DROP SCHEMA "{schema}" CASCADE')
+        await conn.close()
+
+
+@pytest.mark.parametrize("user_id", [TEACHER, "t2", "nobody"])
+def test_dashboard_stats_match_the_per_lesson_loop(monkeypatch, user_id):
+    monkeypatch.setattr(localtime, "local_today", lambda tz_name: TODAY)
+    old, new = asyncio.run(_compare(user_id))
+    assert new == old
+
+
+def test_fixture_covers_every_income_case(monkeypatch):
+    monkeypatch.setattr(localtime, "local_today", lambda tz_name: TODAY)
+    old, _ = asyncio.run(_compare(TEACHER))
+    # today: 1000 + 1200 + group 2 paid x 700 + group with isPaid but no payments (0)
+    assert old["income_today"] == 1000 + 1200 + 2 * 700
+    # month adds tomorrow's 1500, month start 2500, 3 x 800 and 1 x 500 at the month start
+    assert old["income"] == old["income_today"] + 1500 + 2500 + 3 * 800 + 500
+    assert old["lessons_today"] == 6
+    assert old["students"] == 3
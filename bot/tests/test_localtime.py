@@ -0,0 +1,47 @@
+"""Local day and month windows around the Europe/Berlin DST switches."""
+from datetime import date, datetime, timedelta
+import localtime
+
+TZ = "Europe/Berlin"
+
+
+def test_plain_day_is_24_hours():
+    start, end = localtime.day_window(TZ, date(2026, 3, 28))
+    assert start == datetime(2026, 3, 27, 23, 0)
+    assert end - start == timedelta(hours=24)
+
+
+def test_spring_forward_day_is_23_hours():
+    # Last Sunday of March: 02:00 CET -> 03:00 CEST
+    start, end = localtime.day_window(TZ, date(2026, 3, 29))
+    assert start == datetime(2026, 3, 28, 23, 0)
+    assert end == datetime(2026, 3, 29, 22, 0)
+    assert end - start == timedelta(hours=23)
+
+
+def test_fall_back_day_is_25_hours():
+    # Last Sunday of October: 03:00 CEST -> 02:00 CET
+    start, end = localtime.day_window(TZ, date(2026, 10, 25))
+    assert start == datetime(2026, 10, 24, 22, 0)
+    assert end == datetime(2026, 10, 25, 23, 0)
+    assert end - start == timedelta(hours=25)
+
+
+def test_consecutive_days_share_their_boundary():
+    day = date(2026, 3, 27)
+    for _ in range(5):
+        assert localtime.day_window(TZ, day)[1] == localtime.day_window(TZ, day + timedelta(days=1))[0]
+        day += timedelta(days=1)
+
+
+def test_month_start_uses_the_offset_of_the_first():
+    # Both months contain a switch; their first day does not
+    assert localtime.month_start(TZ, date(2026, 3, 31)) == datetime(2026, 2, 28, 23, 0)
+    assert localtime.month_start(TZ, date(2026, 4, 1)) == datetime(2026, 3, 31, 22, 0)
+    assert localtime.month_start(TZ, date(2026, 10, 31)) == datetime(2026, 9, 30, 22, 0)
+    assert localtime.month_start(TZ, date(2026, 11, 15)) == datetime(2026, 10, 31, 23, 0)
+
+
+def test_month_start_is_the_first_day_window():
+    for day in (date(2026, 3, 29), date(2026, 10, 25)):
+        assert localtime.month_start(TZ, day) == localtime.day_window(TZ, day.replace(day=1))[0]
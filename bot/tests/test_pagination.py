@@ -0,0 +1,73 @@
+"""Keyset pagination: walking the students list forwards and back with cursors.
+
+The statements are answered by an in-memory stand-in that applies the same
+(name, id) keyset, so no database is needed.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import db
+
+OWNER = "t1"
+# Duplicate names, so the id tie-breaker matters
+STUDENTS = sorted(
+    [{"id": f"s{i:02d}", "name": ["Anna", "Boris", "Vera", "Gleb"][i % 4]} for i in range(23)],
+    key=lambda r: (r["name"], r["id"])
+)
+
+
+class StudentsConnection:
+    async def fetch(self, sql, owner, limit, cursor=None, record_class=None):
+        assert owner == OWNER
+        key = lambda r: (r["name"], r["id"])
+        if sql == db.Q_STUDENTS_PAGE.sql:
+            rows = STUDENTS
+        else:
+            at = key(next(r for r in STUDENTS if r["id"] == cursor))
+            if sql == db.Q_STUDENTS_PAGE_AFTER.sql:
+                rows = [r for r in STUDENTS if key(r) > at]
+            else:
+                assert sql == db.Q_STUDENTS_PAGE_BEFORE.sql
+                rows = [r for r in reversed(STUDENTS) if key(r) < at]
+        return rows[:limit]
+
+
+class Pool:
+    @asynccontextmanager
+    async def acquire(self):
+        yield StudentsConnection()
+
+
+def test_page_flags():
+    rows = list(range(6))
+    assert db._page(rows, 5, None, 'next') == ([0, 1, 2, 3, 4], False, True)
+    assert db._page(rows[:3], 5, None, 'next') == ([0, 1, 2], False, False)
+    assert db._page(rows, 5, "c", 'next') == ([0, 1, 2, 3, 4], True, True)
+    assert db._page(rows[:2], 5, "c", 'next') == ([0, 1], True, False)
+    # "prev" rows arrive nearest-first and are flipped back
+    assert db._page(rows, 5, "c", 'prev') == ([4, 3, 2, 1, 0], True, True)
+    assert db._page(rows[:2], 5, "c", 'prev') == ([1, 0], False, True)
+
+
+def test_students_cursor_round_trip():
+    async def walk():
+        pool = Pool()
+        pages = []
+        rows, has_prev, has_next = await db.get_students_page(pool, OWNER, limit=5)
+        pages.append(rows)
+        assert not has_prev
+        while has_next:
+            rows, has_prev, has_next = await db.get_students_page(pool, OWNER, rows[-1]["id"], 'next', limit=5)
+            assert has_prev
+            pages.append(rows)
+        back = [rows]
+        while has_prev:
+            rows, has_prev, has_next = await db.get_students_page(pool, OWNER, rows[0]["id"], 'prev', limit=5)
+            assert has_next
+            back.append(rows)
+        return pages, back
+
+    pages, back = asyncio.run(walk())
+    assert [len(p) for p in pages] == [5, 5, 5, 5, 3]
+    assert [r for page in pages for r in page] == STUDENTS
+    # Going back from the last page returns the same pages in reverse
+    assert back == pages[::-1]
@@ -0,0 +1,38 @@
+"""HashRing: stable, balanced placement that moves few keys when workers change."""
+from sharding import HashRing
+
+CHATS = range(-5000, 15000)
+
+
+def test_same_key_same_node():
+    ring = HashRing(range(4))
+    again = HashRing(range(4))
+    assert all(ring.node_for(chat) == again.node_for(chat) for chat in CHATS)
+    # Keys are hashed as strings
+    assert ring.node_for(123) == ring.node_for("123")
+
+
+def test_spread_over_all_nodes():
+    ring = HashRing(range(4))
+    counts = [0] * 4
+    for chat in CHATS:
+        counts[ring.node_for(chat)] += 1
+    share = len(CHATS) / 4
+    assert all(0.6 * share < n < 1.4 * share for n in counts)
+
+
+def test_adding_a_node_moves_about_its_share():
+    before = HashRing(range(4))
+    after = HashRing(range(5))
+    moved = [chat for chat in CHATS if before.node_for(chat) != after.node_for(chat)]
+    # Only keys taken over by the new node move, about 1/5 of them
+    assert all(after.node_for(chat) == 4 for chat in moved)
+    assert 0.1 < len(moved) / len(CHATS) < 0.3
+
+
+def test_removing_a_node_only_moves_its_keys():
+    before = HashRing(range(5))
+    after = HashRing([0, 1, 2, 4])
+    for chat in CHATS:
+        if before.node_for(chat) != 3:
+            assert after.node_for(chat) == before.node_for(chat)
@@ -0,0 +1,76 @@
+"""Per-chat ordering and cross-chat concurrency of ChatOrderedUpdateProcessor."""
+import asyncio
+from datetime import datetime, timezone
+from telegram import Chat, Message, Update
+from update_processor import ChatOrderedUpdateProcessor, update_chat_key
+
+
+def make_update(update_id, chat_id):
+    chat = Chat(chat_id, Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, datetime.now(timezone.utc), chat, text="x"))
+
+
+def test_chat_key():
+    assert update_chat_key(make_update(1, 42)) == 42
+    assert update_chat_key(object()) is None
+
+
+def test_keeps_order_per_chat_and_runs_chats_concurrently():
+    async def scenario():
+        processor = ChatOrderedUpdateProcessor(8)
+        log = []
+        running = {}
+        overlap = []
+
+        async def handle(update_id, chat_id, delay):
+            running[chat_id] = running.get(chat_id, 0) + 1
+            assert running[chat_id] == 1, "two updates of one chat ran at once"
+            if any(n for chat, n in running.items() if chat != chat_id):
+                overlap.append(update_id)
+            log.append(("start", chat_id, update_id))
+            await asyncio.sleep(delay)
+            log.append(("end", chat_id, update_id))
+            running[chat_id] -= 1
+
+        # Earlier updates of a chat are slower, so without the per-chat lock
+        # later ones would finish first
+        jobs = []
+        for i in range(5):
+            for chat_id in (1, 2, 3):
+                update_id = chat_id * 100 + i
+                coro = handle(update_id, chat_id, 0.01 * (5 - i))
+                jobs.append(processor.process_update(make_update(update_id, chat_id), coro))
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*jobs)
+        elapsed = asyncio.get_running_loop().time() - started
+        return processor, log, overlap, elapsed
+
+    processor, log, overlap, elapsed = asyncio.run(scenario())
+    for chat_id in (1, 2, 3):
+        ends = [u for event, chat, u in log if event == "end" and chat == chat_id]
+        assert ends == [chat_id * 100 + i for i in range(5)]
+    assert overlap
+    # One chat's updates take 0.15s back to back; three chats in series would take 0.45s
+    assert elapsed < 0.35
+    stats = processor.stats()
+    assert stats["processed"] == 15
+    assert stats["pending"] == stats["running"] == stats["chats_active"] == 0
+
+
+def test_concurrency_limit():
+    async def scenario():
+        processor = ChatOrderedUpdateProcessor(2)
+        running = 0
+        peak = 0
+
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(make_update(i, i), handle()) for i in range(6)))
+        return peak
+
+    assert asyncio.run(scenario()) == 2
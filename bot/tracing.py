@@ -0,0 +1,173 @@
+"""Per-update tracing.
+
+Every handler callback is wrapped (`Tracer.instrument`) so that while it runs
+a Trace for the update sits in a context variable. Pool acquires, statements
+run through queries.Query and Bot API calls made through the rate limiter add
+their time to it. Sub-tasks the handler creates inherit the context. When the
+handler returns, the trace feeds per-handler histograms (exported on the
+metrics endpoint) and, with TRACE_LOG=1, one JSON log line per update.
+
+The trace id is also the correlation id of ordinary log lines: the filter
+from `install_log_filter()` sets `%(trace_id)s` on every record.
+"""
+import contextvars
+import json
+import logging
+import time
+import uuid
+from metrics import Histogram
+
+_current = contextvars.ContextVar('bot_trace', default=None)
+TRACE_LOGGER = logging.getLogger('bot.trace')
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+
+
+class Trace:
+    __slots__ = (
+        'id', 'update_id', 'chat_id', 'handler', 'db_calls', 'db_time',
+        'pool_wait', 'api_calls', 'api_time', 'api_wait'
+    )
+
+    def __init__(self, update, handler):
+        self.id = uuid.uuid4().hex[:16]
+        self.update_id = getattr(update, 'update_id', None)
+        chat = getattr(update, 'effective_chat', None)
+        self.chat_id = chat.id if chat else None
+        self.handler = handler
+        self.db_calls = 0
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        self.api_calls = 0
+        self.api_time = 0.0
+        self.api_wait = 0.0
+
+
+def current():
+    return _current.get()
+
+
+def record_db(elapsed):
+    trace = _current.get()
+    if trace is not None:
+        trace.db_calls += 1
+        trace.db_time += elapsed
+
+
+def record_pool_wait(elapsed):
+    trace = _current.get()
+    if trace is not None:
+        trace.pool_wait += elapsed
+
+
+def record_api(elapsed, wait):
+    """`wait` is the time spent in the outbound rate limiter before the call."""
+    trace = _current.get()
+    if trace is not None:
+        trace.api_calls += 1
+        trace.api_time += elapsed
+        trace.api_wait += wait
+
+
+class HandlerMetrics:
+    __slots__ = ('updates', 'errors', 'duration', 'db_time', 'db_round_trips', 'pool_wait', 'api_time', 'api_wait', 'api_calls')
+
+    def __init__(self):
+        self.updates = 0
+        self.errors = 0
+        self.duration = Histogram()
+        self.db_time = Histogram()
+        self.db_round_trips = Histogram(ROUND_TRIP_BUCKETS)
+        self.pool_wait = Histogram()
+        self.api_time = Histogram()
+        self.api_wait = Histogram()
+        self.api_calls = Histogram(ROUND_TRIP_BUCKETS)
+
+
+class Tracer:
+    def __init__(self, log_updates=False):
+        self.log_updates = log_updates
+        self.handlers = {}  # handler name -> HandlerMetrics
+
+    def instrument(self, app):
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                handler.callback = self._wrap(handler.callback.__name__, handler.callback)
+
+    def _wrap(self, name, callback):
+        metrics = self.handlers.setdefault(name, HandlerMetrics())
+
+        async def traced(update, context):
+            trace = Trace(update, name)
+            token = _current.set(trace)
+            started = time.perf_counter()
+            error = None
+            try:
+                return await callback(update, context)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self._finish(metrics, trace, time.perf_counter() - started, error)
+                _current.reset(token)
+
+        traced.__name__ = name
+        return traced
+
+    def _finish(self, metrics, trace, elapsed, error):
+        metrics.updates += 1
+        if error is not None:
+            metrics.errors += 1
+        metrics.duration.observe(elapsed)
+        metrics.db_time.observe(trace.db_time)
+        metrics.db_round_trips.observe(trace.db_calls)
+        metrics.pool_wait.observe(trace.pool_wait)
+        metrics.api_time.observe(trace.api_time)
+        metrics.api_wait.observe(trace.api_wait)
+        metrics.api_calls.observe(trace.api_calls)
+        if self.log_updates:
+            TRACE_LOGGER.info(json.dumps({
+                "trace_id": trace.id,
+                "update_id": trace.update_id,
+                "chat_id": trace.chat_id,
+                "handler": trace.handler,
+                "duration_ms": round(elapsed * 1000, 2),
+                "db_round_trips": trace.db_calls,
+                "db_ms": round(trace.db_time * 1000, 2),
+                "pool_wait_ms": round(trace.pool_wait * 1000, 2),
+                "api_calls": trace.api_calls,
+                "api_ms": round(trace.api_time * 1000, 2),
+                "api_wait_ms": round(trace.api_wait * 1000, 2),
+                "error": repr(error) if error is not None else None
+            }, ensure_ascii=False))
+
+    def export(self, out):
+        """Write the per-handler series to a metrics.Exposition."""
+        families = (
+            ('bot_update_duration_seconds', 'duration', 'Handler time per update'),
+            ('bot_update_db_seconds', 'db_time', 'SQL time per update'),
+            ('bot_update_db_round_trips', 'db_round_trips', 'Statements sent per update'),
+            ('bot_update_pool_wait_seconds', 'pool_wait', 'DB pool acquire wait per update'),
+            ('bot_update_api_seconds', 'api_time', 'Bot API call time per update'),
+            ('bot_update_api_wait_seconds', 'api_wait', 'Outbound rate limiter wait per update'),
+            ('bot_update_api_calls', 'api_calls', 'Bot API calls per update'),
+        )
+        for name, handler in self.handlers.items():
+            out.counter('bot_updates_total', handler.updates, 'Updates handled', handler=name)
+        for name, handler in self.handlers.items():
+            out.counter('bot_update_errors_total', handler.errors, 'Updates whose handler raised', handler=name)
+        for family, attr, help_text in families:
+            for name, handler in self.handlers.items():
+                out.histogram(family, getattr(handler, attr), help_text, handler=name)
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        trace = _current.get()
+        record.trace_id = trace.id if trace is not None else '-'
+        return True
+
+
+def install_log_filter(logger=None):
+    """Add `trace_id` to records of every handler of `logger` (root by default)."""
+    for handler in (logger or logging.getLogger()).handlers:
+        handler.addFilter(TraceIdFilter())
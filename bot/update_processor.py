@@ -0,0 +1,93 @@
+import asyncio
+import time
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from metrics import Histogram
+
+
+def update_chat_key(update):
+    """The chat an update belongs to (its user for chat-less updates), or None."""
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats in parallel, but strictly one at a
+    time (in arrival order) per chat, so e.g. paid/unpaid toggles never reorder.
+
+    `max_concurrent_updates` limits handlers running at once. Updates waiting
+    behind their own chat don't hold one of those slots; PTB's semaphore (sized
+    `max_pending`) only bounds how many updates may be in the processor at all.
+    """
+
+    __slots__ = ('_limit', '_running_limit', '_chats', 'pending', 'running', 'processed', 'queue_wait')
+
+    def __init__(self, max_concurrent_updates, max_pending=1024):
+        super().__init__(max(max_pending, max_concurrent_updates))
+        self._limit = max_concurrent_updates
+        self._running_limit = asyncio.Semaphore(max_concurrent_updates)
+        self._chats = {}  # chat_id -> [lock, updates waiting or running]
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.queue_wait = Histogram()
+
+    async def do_process_update(self, update, coroutine):
+        key = update_chat_key(update)
+        entry = None
+        if key is not None:
+            entry = self._chats.get(key)
+            if entry is None:
+                entry = self._chats[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+        self.pending += 1
+        queued = True
+        started = time.perf_counter()
+        try:
+            if entry is not None:
+                await entry[0].acquire()
+            try:
+                async with self._running_limit:
+                    self.pending -= 1
+                    queued = False
+                    self.queue_wait.observe(time.perf_counter() - started)
+                    self.running += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+            finally:
+                if entry is not None:
+                    entry[0].release()
+        finally:
+            if queued:
+                self.pending -= 1
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chats[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self, top=5):
+        backlogs = sorted(((n, chat) for chat, (_, n) in self._chats.items() if n > 1), reverse=True)
+        return {
+            "max_concurrent_updates": self._limit,
+            "pending": self.pending,
+            "running": self.running,
+            "processed": self.processed,
+            "chats_active": len(self._chats),
+            "chats_with_backlog": len(backlogs),
+            "max_chat_backlog": backlogs[0][0] - 1 if backlogs else 0,
+            "top_backlogs": {chat: n - 1 for n, chat in backlogs[:top]},
+            "queue_wait": self.queue_wait.stats()
+        }
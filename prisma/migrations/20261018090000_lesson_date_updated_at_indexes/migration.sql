@@ -0,0 +1,8 @@
+-- Lesson reminders in the bot (bot/reminders.py) load lessons by date window
+-- and poll for lessons changed since a watermark every 30 s.
+
+-- CreateIndex
+CREATE INDEX "Lesson_date_idx" ON "Lesson"("date");
+
+-- CreateIndex
+CREATE INDEX "Lesson_updatedAt_idx" ON "Lesson"("updatedAt");
@@ -0,0 +1,9 @@
+-- Lesson reminders are recorded by the bot (bot/reminders.py) and, unless
+-- BOT_LESSON_REMINDERS=1, by the notifications cron; the unique key lets
+-- concurrent senders record each reminder once.
+
+-- AlterTable
+ALTER TABLE "Notification" ADD COLUMN "dedupeKey" TEXT;
+
+-- CreateIndex
+CREATE UNIQUE INDEX "Notification_userId_dedupeKey_key" ON "Notification"("userId", "dedupeKey");
@@ -0,0 +1,14 @@
+-- Conversation state of the Telegram bot (bot/state.py, STATE_BACKEND=postgres)
+
+-- CreateTable
+CREATE TABLE "BotState" (
+    "namespace" TEXT NOT NULL,
+    "key" TEXT NOT NULL,
+    "value" TEXT NOT NULL,
+    "expiresAt" TIMESTAMP(3) NOT NULL,
+
+    CONSTRAINT "BotState_pkey" PRIMARY KEY ("namespace","key")
+);
+
+-- CreateIndex
+CREATE INDEX "BotState_namespace_expiresAt_idx" ON "BotState"("namespace", "expiresAt");